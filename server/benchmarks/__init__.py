@@ -0,0 +1,3 @@
+""" Offline benchmarks for the server's hot paths.
+Run each module from the server directory, e.g. `python -m benchmarks.sql_store`.
+"""
@@ -0,0 +1,52 @@
+""" Times point-in-time optimizations (PUT /model with as_of) on synthetic
+data: the first run of each day, which stores what it downloads, and a
+re-run, which must download nothing and give the same weights.
+
+Usage: python -m benchmarks.as_of [--tickers 20] [--days 10] [--years 3]
+"""
+
+import argparse
+import os
+import tempfile
+from time import perf_counter
+import pandas as pd
+import config
+from services.providers import set_provider
+from services.portfolio import optimize_as_of
+from services.calendar import trading_window
+from services.metrics import metrics
+from .synthetic import SyntheticProvider, ticker_names
+
+
+def main():
+    """ CLI entry point """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tickers", type=int, default=20)
+    parser.add_argument("--days", type=int, default=10, help="as-of days to evaluate")
+    parser.add_argument("--years", type=int, default=3, help="history to generate")
+    args = parser.parse_args()
+
+    tickers = ticker_names(args.tickers)
+    set_provider(SyntheticProvider(days=args.years * 252 + 30))
+    today = pd.Timestamp.today().normalize()
+    # Evenly spread over the last year, so each has two years of history before it
+    days = trading_window(today, 252)[::252 // args.days][:args.days]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config.DB_PATH = os.path.join(tmp, "prices.db")
+        for label in ["first run", "re-run"]:
+            rows = metrics.counters.get("provider.rows_downloaded", 0)
+            start = perf_counter()
+            results = [optimize_as_of(tickers, day) for day in days]
+            elapsed = perf_counter() - start
+            downloaded = metrics.counters.get("provider.rows_downloaded", 0) - rows
+            print(f"{label:<10} {len(days)} days in {elapsed:.2f}s "
+                  f"({elapsed / len(days) * 1000:.0f} ms/day), {downloaded} rows downloaded")
+            if label == "first run":
+                first = [r.weights for r in results]
+            else:
+                print(f"same weights as the first run: {first == [r.weights for r in results]}")
+
+
+if __name__ == "__main__":
+    main()
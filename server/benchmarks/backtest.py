@@ -0,0 +1,53 @@
+""" Times a walk-forward backtest on synthetic data, solving the windows
+in-process and on process pools of increasing size.
+
+Usage: python -m benchmarks.backtest [--tickers 20] [--years 5] [--frequency monthly]
+                                     [--workers 0 2 4]
+"""
+
+import argparse
+import os
+import tempfile
+from time import perf_counter
+import pandas as pd
+import config
+from services.providers import set_provider
+from services.backtest import backtest, load_panel, ESTIMATION_DAYS
+from .synthetic import SyntheticProvider, ticker_names
+
+
+def main():
+    """ CLI entry point """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tickers", type=int, default=20)
+    parser.add_argument("--years", type=int, default=5)
+    parser.add_argument("--frequency", default="monthly")
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 2, 4])
+    args = parser.parse_args()
+
+    tickers = ticker_names(args.tickers)
+    days = args.years * 252 + ESTIMATION_DAYS + 30
+    set_provider(SyntheticProvider(days=days))
+    start = pd.Timestamp.today().normalize() - pd.DateOffset(years=args.years)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config.DB_PATH = os.path.join(tmp, "prices.db")
+        begin = perf_counter()
+        panel = load_panel(tickers, start)
+        print(f"load_panel (cold): {perf_counter() - begin:.2f}s, {panel.shape[0]} days")
+        begin = perf_counter()
+        panel = load_panel(tickers, start)
+        print(f"load_panel (warm): {perf_counter() - begin:.2f}s")
+
+        for workers in args.workers:
+            begin = perf_counter()
+            result = backtest(tickers, start, args.frequency, workers=workers, panel=panel)
+            elapsed = perf_counter() - begin
+            stats = result.stats()
+            print(f"workers={workers:<3} {len(result.weights)} rebalances in {elapsed:.2f}s"
+                  f"  total return {stats['total_return']:+.1%}"
+                  f"  avg turnover {stats['average_turnover']:.1%}")
+
+
+if __name__ == "__main__":
+    main()
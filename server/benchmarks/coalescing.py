@@ -0,0 +1,103 @@
+""" Simulates a burst of /model requests with overlapping tickers hitting a
+cold database, and counts what reaches the price provider with every caller
+downloading on its own versus with single-flight coalescing.
+
+Usage: python -m benchmarks.coalescing [--processes 4] [--threads 8] [--tickers 60]
+                                       [--per-request 20] [--latency 0.5]
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+import config
+from services import sql
+from services.price_fetching import fetch_prices, download_missing
+from .synthetic import SyntheticProvider, ticker_names
+
+MODES = ["independent", "coalesced"]
+
+
+class SlowProvider(SyntheticProvider):
+    """ Synthetic prices behind a fixed network latency, counting requests """
+    def __init__(self, latency, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.symbols = 0
+
+    def download(self, symbols, start, end=None):
+        with self.lock:
+            self.calls += 1
+            self.symbols += len(symbols)
+        time.sleep(self.latency)
+        return super().download(symbols, start, end)
+
+
+def run_process(mode, tmp, threads, universe, per_request, latency, start_at, seed):
+    """ Fires one request per thread at start_at. Module level so process pools can run it.
+
+    :return: Provider calls, symbols downloaded and request latencies
+    :rtype: Dict[str, Any]
+    """
+    config.DB_PATH = os.path.join(tmp, "prices.db")
+    config.FETCH_LOCK_DIR = os.path.join(tmp, "locks")
+    provider = SlowProvider(latency)
+    latencies = []
+    lock = threading.Lock()
+
+    def request(thread_seed):
+        tickers = random.Random(thread_seed).sample(universe, per_request)
+        time.sleep(max(start_at - time.time(), 0))
+        begin = time.perf_counter()
+        with sql.connection() as con:
+            if mode == "coalesced":
+                fetch_prices(con, tickers, provider)
+            else:
+                download_missing(con, tickers, provider)
+        with lock:
+            latencies.append(time.perf_counter() - begin)
+
+    workers = [threading.Thread(target=request, args=(seed * 1000 + i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return {"calls": provider.calls, "symbols": provider.symbols, "latencies": latencies}
+
+
+def main():
+    """ CLI entry point """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8, help="concurrent requests per process")
+    parser.add_argument("--tickers", type=int, default=60, help="distinct tickers requested")
+    parser.add_argument("--per-request", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds per provider call")
+    args = parser.parse_args()
+
+    universe = ticker_names(args.tickers)
+    print(f"{'mode':<13}{'provider calls':>15}{'symbols':>9}{'wall (s)':>10}"
+          f"{'request p50 (s)':>17}{'max (s)':>9}")
+    for mode in MODES:
+        with tempfile.TemporaryDirectory() as tmp:
+            with ProcessPoolExecutor(args.processes) as pool:
+                # Leave time for the pool to start, so every request fires together
+                start_at = time.time() + 2
+                runs = list(pool.map(run_process, *zip(*[
+                    (mode, tmp, args.threads, universe, args.per_request, args.latency,
+                     start_at, p)
+                    for p in range(args.processes)])))
+            wall = time.time() - start_at
+        latencies = sorted(x for r in runs for x in r["latencies"])
+        print(f"{mode:<13}{sum(r['calls'] for r in runs):>15}"
+              f"{sum(r['symbols'] for r in runs):>9}{wall:>10.2f}"
+              f"{latencies[len(latencies) // 2]:>17.2f}{latencies[-1]:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
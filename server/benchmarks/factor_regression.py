@@ -0,0 +1,64 @@
+""" Compares the batched least-squares Carhart fit against one cvxpy problem per ticker.
+
+Usage: python -m benchmarks.factor_regression [--tickers 10 100 500]
+"""
+
+import argparse
+from time import perf_counter
+import numpy as np
+import pandas as pd
+from services.returns import Carhart4FactorModel, BETAS
+
+
+def make_inputs(num_tickers, num_days=253, seed=0):
+    """ Synthetic factors, risk-free rates and 12-month asset rates
+    generated from known betas.
+
+    :rtype: Tuple[pandas.DataFrame, pandas.Series, pandas.DataFrame]
+    """
+    rng = np.random.default_rng(seed)
+    index = pd.bdate_range(end=pd.Timestamp.today().normalize(), periods=num_days)
+    factors = pd.DataFrame(rng.normal(0, 0.1, size=(num_days, len(BETAS))),
+                           index=index, columns=BETAS)
+    risk_free = pd.Series(1.04 + rng.normal(0, 0.001, num_days), index=index)
+    betas = rng.normal(1, 0.5, size=(len(BETAS), num_tickers))
+    noise = rng.normal(0, 0.02, size=(num_days, num_tickers))
+    rates = factors.to_numpy() @ betas + risk_free.to_numpy()[:, None] + noise
+    rates = pd.DataFrame(rates, index=index, columns=[f"T{i:03}" for i in range(num_tickers)])
+    return factors, risk_free, rates
+
+
+def run(num_tickers):
+    """ Times both fit methods on the same inputs.
+
+    :return: Seconds per method and the largest expected-return difference
+    :rtype: Dict[str, float]
+    """
+    factors, risk_free, rates = make_inputs(num_tickers)
+    timings = {}
+    fits = {}
+    for method in ["lstsq", "cvxpy"]:
+        model = Carhart4FactorModel(method, factors=factors, risk_free_rates=risk_free)
+        start = perf_counter()
+        fits[method] = model.fit(rates)
+        timings[method] = perf_counter() - start
+    diff = (fits["lstsq"]["expected_return"] - fits["cvxpy"]["expected_return"]).abs().max()
+    timings["max_diff"] = diff
+    return timings
+
+
+def main():
+    """ CLI entry point """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tickers", type=int, nargs="+", default=[10, 100, 500])
+    args = parser.parse_args()
+
+    print(f"{'tickers':<9}{'lstsq (s)':>12}{'cvxpy (s)':>12}{'speedup':>10}{'max diff':>12}")
+    for num_tickers in args.tickers:
+        res = run(num_tickers)
+        print(f"{num_tickers:<9}{res['lstsq']:>12.4f}{res['cvxpy']:>12.4f}"
+              f"{res['cvxpy'] / res['lstsq']:>9.0f}x{res['max_diff']:>12.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+""" Load-tests the server end to end: starts it under uWSGI (or Flask's
+threaded dev server where uWSGI isn't installed) against a temporary price
+database and synthetic market data, then drives request mixes at fixed
+concurrency and reports throughput, p50/p95/p99 latency and error rate.
+
+Market data comes from the replay provider, reading synthetic histories
+written to a temporary directory, with PRICE_REPLAY_LATENCY standing in for
+the network. "Warm" requests reuse a few universes whose prices are stored;
+"cold" ones ask for tickers the server hasn't seen yet.
+
+Usage: python -m benchmarks.loadtest [--scenario warm cold mixed] [--concurrency 1 4 16]
+                                     [--requests 200] [--processes 4] [--threads 1]
+                                     [--mix model_warm=8,model_cold=1,frontier=1]
+                                     [--output results.json] [--baseline old.json]
+"""
+
+import argparse
+import configparser
+import itertools
+import json
+import os
+import random
+import secrets
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+import numpy as np
+import requests
+from services.providers import write_replay_files
+from services.factors import factor_sets, MARKET_SYMBOL, RISK_FREE_SYMBOL
+from .pipeline import git_revision
+from .synthetic import SyntheticProvider, ticker_names
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Request kinds, mixed by weight
+SCENARIOS = {
+    "warm": {"model_warm": 1},
+    "cold": {"model_cold": 1},
+    "mixed": {"model_warm": 7, "model_cold": 1, "model_risk": 1, "frontier": 0.5, "batch": 0.5}
+    }
+
+
+class Workload:
+    """ Builds request bodies. Warm universes are a few fixed ticker lists;
+    cold universes take the next unused tickers from a pool.
+
+    :param warm: Universes that are requested over and over
+    :type warm: str[][]
+    :param cold: Tickers the server hasn't stored, used once each
+    :type cold: str[]
+    :param size: Tickers per cold universe
+    :type size: int
+    """
+    def __init__(self, warm, cold, size):
+        self.warm = warm
+        self.cold = cold
+        self.size = size
+        self.next_cold = itertools.count()
+
+    def cold_universe(self):
+        """ The next unused tickers. Once the pool runs out they repeat,
+        and are no longer cold.
+
+        :rtype: str[]
+        """
+        start = next(self.next_cold) * self.size % len(self.cold)
+        return self.cold[start:start + self.size]
+
+    def request(self, kind, rng):
+        """ Method, path and JSON body of one request
+
+        :param kind: A request kind of SCENARIOS
+        :type kind: str
+        :type rng: random.Random
+        :rtype: Tuple[str, str, Dict[str, Any]]
+        """
+        tickers = rng.choice(self.warm)
+        if kind == "model_warm":
+            return "PUT", "/model", {"value": 10000, "tickers": tickers}
+        if kind == "model_cold":
+            return "PUT", "/model", {"value": 10000, "tickers": self.cold_universe()}
+        if kind == "model_risk":
+            return "PUT", "/model", {"value": 10000, "tickers": tickers,
+                                     "risk": {"paths": 10000}}
+        if kind == "frontier":
+            return "PUT", "/frontier", {"tickers": tickers, "points": 20}
+        if kind == "batch":
+            universes = rng.sample(self.warm, min(4, len(self.warm)))
+            return "PUT", "/batch", {"portfolios": [{"value": 10000, "tickers": t}
+                                                    for t in universes]}
+        raise ValueError(f"Unknown request kind {kind}")
+
+
+def write_market_data(directory, tickers, days):
+    """ Writes synthetic histories of tickers, the factor constituents, the
+    market index and the risk-free rate for the replay provider.
+
+    :type directory: str
+    :type tickers: str[]
+    :param days: Trading days of history
+    :type days: int
+    """
+    constituents = [t for buckets in factor_sets().values() for bucket in buckets.values()
+                    for t in bucket]
+    symbols = list(dict.fromkeys([*tickers, *constituents, MARKET_SYMBOL, RISK_FREE_SYMBOL]))
+    write_replay_files(directory, SyntheticProvider(days=days).panel(symbols))
+
+
+def uwsgi_options():
+    """ The [uwsgi] section of uwsgi.ini, without its cron jobs and port
+
+    :rtype: Dict[str, str]
+    """
+    parser = configparser.ConfigParser(strict=False, interpolation=None)
+    parser.read(os.path.join(SERVER_DIR, "uwsgi.ini"))
+    return {k: v for k, v in parser["uwsgi"].items() if k not in ("http", "unique-cron")}
+
+
+def server_command(server, port, processes, threads):
+    """ Command line that starts the server
+
+    :param server: "uwsgi" or "flask"
+    :type server: str
+    :type port: int
+    :param processes: uWSGI worker processes
+    :type processes: int
+    :param threads: uWSGI threads per worker
+    :type threads: int
+    :rtype: str[]
+    """
+    if server == "flask":
+        return [sys.executable, "wsgi.py"]
+    options = {**uwsgi_options(), "processes": str(processes), "threads": str(threads),
+               "http": f"127.0.0.1:{port}", "disable-logging": "true", "die-on-term": "true"}
+    command = ["uwsgi"]
+    for key, value in options.items():
+        command += [f"--{key}"] if value == "true" else [f"--{key}", value]
+    return command
+
+
+def free_port():
+    """ A port nothing listens on
+
+    :rtype: int
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(url, processes, timeout):
+    """ Waits until enough consecutive readiness checks pass that every
+    worker has likely loaded its models.
+
+    :raises TimeoutError: if the server isn't ready in time
+    """
+    deadline = time.monotonic() + timeout
+    passed = 0
+    while passed < 2 * processes:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Server not ready after {timeout}s")
+        try:
+            ok = requests.get(f"{url}/readiness", timeout=5).status_code == 200
+        except requests.ConnectionError:
+            ok = False
+        passed = passed + 1 if ok else 0
+        if not ok:
+            time.sleep(0.2)
+
+
+def drive(url, token, workload, mix, concurrency, total, timeout=120):
+    """ Sends total requests from concurrency threads, each sending its next
+    request as soon as the last one returns.
+
+    :param mix: Request kinds mapped to their weights
+    :type mix: Dict[str, float]
+    :return: (kind, seconds, HTTP status or exception name) of every
+             request, and the wall time
+    :rtype: Tuple[List[Tuple[str, float, int | str]], float]
+    """
+    kinds, weights = list(mix), list(mix.values())
+    sent = itertools.count()
+
+    def client(seed):
+        rng = random.Random(seed)
+        samples = []
+        while next(sent) < total:
+            kind = rng.choices(kinds, weights)[0]
+            method, path, body = workload.request(kind, rng)
+            start = perf_counter()
+            try:
+                # A new connection each time: uWSGI's http router closes them
+                # without saying so, and a pooled one would be reset on reuse
+                status = requests.request(method, url + path, json=body, timeout=timeout,
+                                          headers={"Authorization": token}).status_code
+            except requests.RequestException as e:
+                status = type(e).__name__
+            samples.append((kind, perf_counter() - start, status))
+        return samples
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = [s for part in pool.map(client, range(concurrency)) for s in part]
+    return samples, perf_counter() - start
+
+
+def summarize(samples, wall):
+    """ Throughput, latency percentiles and error rate of one run
+
+    :rtype: Dict[str, float]
+    """
+    latencies = np.array([s[1] for s in samples]) * 1000
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    errors = Counter(str(s[2]) for s in samples if not isinstance(s[2], int) or s[2] >= 400)
+    return {
+        "requests": len(samples),
+        "throughput_rps": len(samples) / wall,
+        "p50_ms": p50,
+        "p95_ms": p95,
+        "p99_ms": p99,
+        "error_rate": sum(errors.values()) / len(samples),
+        # e.g. 400 for tickers without data, 500 when no asset beats the risk-free rate
+        "errors": dict(errors),
+        "kinds": dict(Counter(s[0] for s in samples))
+        }
+
+
+def parse_mix(raw):
+    """ Parses "kind=weight,kind=weight"
+
+    :rtype: Dict[str, float]
+    """
+    mix = {}
+    for part in raw.split(","):
+        kind, weight = part.split("=")
+        mix[kind.strip()] = float(weight)
+    return mix
+
+
+def compare(results, baseline, max_regression):
+    """ Prints throughput and p95 against a baseline run
+
+    :return: Whether any run's throughput fell by more than max_regression
+    :rtype: bool
+    """
+    old = {(r["scenario"], r["concurrency"]): r for r in baseline["runs"]}
+    regressed = False
+    print(f"\n{'scenario':<10}{'conc.':>6}{'baseline rps':>14}{'rps':>10}{'ratio':>8}"
+          f"{'p95 ratio':>11}")
+    for run in results["runs"]:
+        before = old.get((run["scenario"], run["concurrency"]))
+        if before is None:
+            continue
+        ratio = run["throughput_rps"] / before["throughput_rps"]
+        regressed |= max_regression is not None and ratio < 1 - max_regression
+        print(f"{run['scenario']:<10}{run['concurrency']:>6}{before['throughput_rps']:>14.1f}"
+              f"{run['throughput_rps']:>10.1f}{ratio:>8.2f}"
+              f"{run['p95_ms'] / before['p95_ms']:>11.2f}")
+    return regressed
+
+
+def main():
+    """ CLI entry point """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", nargs="+", default=["warm", "cold", "mixed"],
+                        help=f"any of {', '.join(SCENARIOS)}, or custom with --mix")
+    parser.add_argument("--mix", help="custom scenario, e.g. model_warm=8,model_cold=1,frontier=1")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=200, help="requests per run")
+    parser.add_argument("--server", default="auto", choices=["auto", "uwsgi", "flask"])
+    parser.add_argument("--processes", type=int, default=None,
+                        help="uWSGI workers, defaults to uwsgi.ini's")
+    parser.add_argument("--threads", type=int, default=1, help="uWSGI threads per worker")
+    parser.add_argument("--universe-size", type=int, default=10, help="tickers per universe")
+    parser.add_argument("--warm-universes", type=int, default=8)
+    parser.add_argument("--cold-tickers", type=int, default=None,
+                        help="pool of tickers for cold requests, defaults to enough "
+                             "for every cold request to be cold")
+    parser.add_argument("--days", type=int, default=800, help="trading days of history")
+    parser.add_argument("--latency", type=float, default=0.2,
+                        help="seconds per market data download")
+    parser.add_argument("--startup-timeout", type=float, default=300)
+    parser.add_argument("--output", help="Write results JSON here")
+    parser.add_argument("--baseline", help="Results JSON from another run to compare against")
+    parser.add_argument("--max-regression", type=float, default=None,
+                        help="exit 1 if throughput falls by more than this fraction "
+                             "of the baseline's")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.scenario if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+    scenarios = {name: SCENARIOS[name] for name in args.scenario}
+    if args.mix:
+        scenarios["custom"] = parse_mix(args.mix)
+    server = args.server
+    if server == "auto":
+        server = "uwsgi" if shutil.which("uwsgi") else "flask"
+    processes = args.processes or int(uwsgi_options().get("processes", 1))
+    if server == "flask":
+        print("uWSGI not used: one process, a thread per request; "
+              "--processes and --threads are ignored", file=sys.stderr)
+        processes = 1
+
+    # Same secret for the server and the tokens minted here
+    os.environ.setdefault("JWT_SECRET", secrets.token_hex(16))
+    from services.auth import create_jwt # pylint: disable=import-outside-toplevel
+    token = create_jwt()
+
+    warm_tickers = ticker_names(args.warm_universes * args.universe_size)
+    cold_share = sum(mix.get("model_cold", 0) / sum(mix.values()) for mix in scenarios.values())
+    cold_requests = cold_share * args.requests * len(args.concurrency)
+    num_cold = args.cold_tickers or (int(cold_requests * 1.2) + 1) * args.universe_size
+    cold_tickers = [f"C{i:05}" for i in range(num_cold)]
+    rng = random.Random(0)
+    warm = [rng.sample(warm_tickers, args.universe_size) for _ in range(args.warm_universes)]
+    workload = Workload(warm, cold_tickers, args.universe_size)
+
+    runs = []
+    with tempfile.TemporaryDirectory() as tmp:
+        replay = os.path.join(tmp, "replay")
+        write_market_data(replay, [*warm_tickers, *cold_tickers], args.days)
+        port = free_port()
+        env = {**os.environ, "PORT": str(port), "PRICE_DB": os.path.join(tmp, "prices.db"),
+               "PRICE_PROVIDER": "replay", "PRICE_REPLAY_DIR": replay,
+               "PRICE_REPLAY_LATENCY": str(args.latency),
+               "FACTOR_CACHE_DIR": os.path.join(tmp, "factor_cache"),
+               "FETCH_LOCK_DIR": os.path.join(tmp, "fetch_locks"),
+               "JOB_DIR": os.path.join(tmp, "jobs"), "METRICS_DIR": os.path.join(tmp, "metrics"),
+               "PREWARM_UNIVERSES_PATH": ""}
+        url = f"http://127.0.0.1:{port}"
+        log_path = os.path.join(tmp, "server.log")
+        with open(log_path, "w", encoding="utf-8") as log:
+            proc = subprocess.Popen(server_command(server, port, processes, args.threads),
+                                    cwd=SERVER_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            wait_ready(url, processes, args.startup_timeout)
+            # Store the warm universes' prices; every worker then has them
+            drive(url, token, workload, {"model_warm": 1}, processes, 2 * len(warm) * processes)
+
+            print(f"{'scenario':<10}{'conc.':>6}{'requests':>10}{'rps':>9}{'p50 ms':>10}"
+                  f"{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+            for name, mix in scenarios.items():
+                for concurrency in args.concurrency:
+                    samples, wall = drive(url, token, workload, mix, concurrency, args.requests)
+                    run = {"scenario": name, "concurrency": concurrency,
+                           **summarize(samples, wall)}
+                    runs.append(run)
+                    print(f"{name:<10}{concurrency:>6}{run['requests']:>10}"
+                          f"{run['throughput_rps']:>9.1f}{run['p50_ms']:>10.0f}"
+                          f"{run['p95_ms']:>10.0f}{run['p99_ms']:>10.0f}"
+                          f"{run['error_rate']:>8.1%}  "
+                          f"{' '.join(f'{k}x{v}' for k, v in run['errors'].items())}")
+            server_metrics = requests.get(f"{url}/metrics", timeout=10).json()
+        except Exception:
+            # The server's output usually says why
+            with open(log_path, encoding="utf-8") as log:
+                sys.stderr.write(log.read()[-4000:])
+            raise
+        finally:
+            proc.terminate()
+            proc.wait(timeout=30)
+
+    results = {
+        "revision": git_revision(),
+        "params": {"server": server, "processes": processes, "threads": args.threads,
+                   "requests": args.requests, "universe_size": args.universe_size,
+                   "latency": args.latency, "scenarios": scenarios},
+        "runs": runs,
+        "server_metrics": server_metrics
+        }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            if compare(results, json.load(f), args.max_regression):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+""" Times max_sharpe solves of same-sized universes: pypfopt, which builds
+and compiles a new problem each time, against the cached parameterized
+problems of services.optimizer, with and without constraints.
+
+Usage: python -m benchmarks.optimizer [--tickers 10 25 50 100] [--solves 20]
+"""
+
+import argparse
+import types
+from time import perf_counter
+import pandas as pd
+from pypfopt.efficient_frontier import EfficientFrontier
+from services.covariance import CovarianceCache
+from services.model import Model
+from services.optimizer import PortfolioConstraints
+from .covariance import make_inputs
+
+
+def constraints_for(tickers):
+    """ A 20% cap per ticker, two sectors capped at 60% and a 50% turnover
+    limit against equal weights
+
+    :rtype: PortfolioConstraints
+    """
+    return PortfolioConstraints(
+        bounds={t: (0, 0.2) for t in tickers},
+        sectors={t: f"S{i % 2}" for i, t in enumerate(tickers)},
+        sector_caps={"S0": 0.6, "S1": 0.6},
+        holdings={t: 1 / len(tickers) for t in tickers},
+        max_turnover=0.5
+        )
+
+
+def run(num_tickers, solves):
+    """ Mean ms per solve of each method, over universes with new
+    expected returns and covariances each time
+
+    :rtype: Dict[str, float]
+    """
+    returns_model = types.SimpleNamespace(risk_free_rates=pd.Series([1.0]))
+    universes = []
+    for seed in range(solves):
+        prices, _, expected = make_inputs(num_tickers, 500, seed)
+        universes.append((prices, expected, CovarianceCache().covariance(prices)))
+    tickers = list(universes[0][0].columns)
+    methods = {
+        "pypfopt": lambda p, e, c: EfficientFrontier(e, c).max_sharpe(1.0),
+        "cached": lambda p, e, c: Model(returns_model, tickers, (p, e, c)).max_sharpe(1.0),
+        "cached + constraints": lambda p, e, c: Model(returns_model, tickers, (p, e, c))
+            .max_sharpe(1.0, constraints_for(tickers))
+        }
+    results = {}
+    for name, solve in methods.items():
+        # The first solve of a shape compiles it; time it on its own
+        start = perf_counter()
+        solve(*universes[0])
+        first = perf_counter() - start
+        start = perf_counter()
+        for universe in universes[1:]:
+            solve(*universe)
+        results[name] = (first * 1000, (perf_counter() - start) / (solves - 1) * 1000)
+    return results
+
+
+def main():
+    """ CLI entry point """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tickers", type=int, nargs="+", default=[10, 25, 50, 100])
+    parser.add_argument("--solves", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'tickers':>8}  {'method':<22}{'first (ms)':>12}{'later (ms)':>12}")
+    for num_tickers in args.tickers:
+        for name, (first, later) in run(num_tickers, args.solves).items():
+            print(f"{num_tickers:>8}  {name:<22}{first:>12.1f}{later:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+""" Compares reading prices from SQLite with reading them from the shared
+memory-mapped panel: latency per read, and the private memory each of
+several worker processes needs to hold the whole universe.
+
+Usage: python -m benchmarks.panel [--tickers 2000] [--days 750] [--request 50]
+                                  [--processes 4]
+"""
+
+import argparse
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+import numpy as np
+import config
+from services import sql, panel
+from .sql_store import make_prices
+
+SOURCES = ["sql", "panel"]
+
+
+def private_mb():
+    """ Anonymous memory of this process, from /proc. Pages of the panel's
+    mapping are file-backed and shared, so they don't count.
+
+    :rtype: float
+    """
+    with open("/proc/self/smaps_rollup", encoding="utf-8") as f:
+        fields = dict(line.split(":", 1) for line in f if ":" in line)
+    return int(fields["Anonymous"].split()[0]) / 1024
+
+
+def read(source, con, tickers):
+    """ One read of tickers' prices from a source """
+    if source == "sql":
+        return sql.get_price_panel(con, tickers)
+    return panel.read_prices(con, tickers)
+
+
+def hold_universe(source, path, tickers):
+    """ Reads every ticker, like a worker serving a large universe, and
+    reports the private memory that added. Module level so process pools can run it.
+
+    :rtype: float
+    """
+    config.DB_PATH = path
+    with sql.connection() as con:
+        read(source, con, tickers[:1])
+        before = private_mb()
+        frame = read(source, con, tickers)
+        # Touch every price, as an optimization would
+        frame.to_numpy().sum()
+        return private_mb() - before
+
+
+def main():
+    """ CLI entry point """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tickers", type=int, default=2000)
+    parser.add_argument("--days", type=int, default=750)
+    parser.add_argument("--request", type=int, default=50, help="tickers per request")
+    parser.add_argument("--processes", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "prices.db")
+        config.DB_PATH = path
+        prices = make_prices(args.tickers, args.days)
+        tickers = list(prices.columns)
+        with sql.connection() as con:
+            sql.insert_price_data(con, prices)
+            start = perf_counter()
+            panel.rebuild(con)
+            built = perf_counter() - start
+            directory = panel.panel_dir()
+            values = os.path.join(directory, panel.current_version(directory), "values.npy")
+            print(f"panel build: {built:.2f}s, {os.path.getsize(values) / 2**20:.0f} MB")
+
+            rng = np.random.default_rng(0)
+            requests = [list(rng.choice(tickers, args.request, replace=False)) for _ in range(50)]
+            print(f"{'source':<8}{f'{args.request} tickers (ms)':>20}{'all tickers (ms)':>18}"
+                  f"{'private MB/worker':>19}")
+            for source in SOURCES:
+                start = perf_counter()
+                for r in requests:
+                    read(source, con, r)
+                small = (perf_counter() - start) / len(requests) * 1000
+                start = perf_counter()
+                read(source, con, tickers)
+                full = (perf_counter() - start) * 1000
+                with ProcessPoolExecutor(args.processes) as pool:
+                    memory = list(pool.map(hold_universe, [source] * args.processes,
+                                           [path] * args.processes, [tickers] * args.processes))
+                print(f"{source:<8}{small:>20.2f}{full:>18.1f}{np.mean(memory):>19.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+""" Times every stage of the /model pipeline on synthetic data, without network access.
+Writes wall time and peak memory per stage as JSON, for diffing between commits.
+
+Usage: python -m benchmarks.pipeline [--tickers 50] [--days 800] [--repeat 3]
+                                     [--output results.json] [--baseline old.json]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from contextlib import closing, redirect_stdout
+from statistics import median
+from time import perf_counter
+import config
+from services import sql
+from services.providers import set_provider
+from services.price_fetching import fetch_prices
+from services.factors import FactorModel, m12_return_rate
+from services.returns import Carhart4FactorModel
+from services.model import Model
+from .synthetic import SyntheticProvider, ticker_names
+
+
+def measure(func, repeat, setup=None):
+    """ Runs func repeat times, after setup() each time if given.
+
+    :return: Wall times in seconds, peak traced memory in MB, and func's last result
+    :rtype: Tuple[float[], float, Any]
+    """
+    times = []
+    peak = 0
+    res = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        tracemalloc.start()
+        start = perf_counter()
+        res = func()
+        times.append(perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] / 2**20)
+        tracemalloc.stop()
+    return times, peak, res
+
+
+def run(num_tickers, days, repeat, seed=0):
+    """ Times each pipeline stage in a temporary database and factor cache.
+
+    :rtype: Dict[str, Dict[str, Any]]
+    """
+    tickers = ticker_names(num_tickers)
+    set_provider(SyntheticProvider(days=days, seed=seed))
+    stages = {}
+
+    def record(name, func, setup=None):
+        times, peak, res = measure(func, repeat, setup)
+        stages[name] = {"wall_s": times, "median_s": median(times), "peak_mb": peak}
+        return res
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config.DB_PATH = os.path.join(tmp, "prices.db")
+        config.FACTOR_CACHE_DIR = os.path.join(tmp, "factor_cache")
+
+        cold_runs = iter(range(repeat))
+
+        def reset_db():
+            # A new file rather than deleting the old one, which the pooled
+            # connections and the writer thread still have open
+            config.DB_PATH = os.path.join(tmp, f"prices-{next(cold_runs)}.db")
+
+        def fetch():
+            with closing(sql.get_connection()) as con:
+                return fetch_prices(con, tickers)
+
+        record("fetch_prices_cold", fetch, reset_db)
+        prices = record("fetch_prices_warm", fetch)
+        rates = record("m12_return_rate", lambda: m12_return_rate(prices))
+        record("factor_model", FactorModel)
+        returns_model = record("carhart_snapshot_cold", Carhart4FactorModel,
+                               lambda: reset_dir(config.FACTOR_CACHE_DIR))
+        record("carhart_call", lambda: [returns_model(rates[t]) for t in tickers])
+        record("carhart_fit", lambda: returns_model.fit(rates))
+        model = record("model_init", lambda: Model(returns_model, tickers))
+        inputs = (model.prices, model.returns, model.risk_matrix)
+
+        def max_sharpe():
+            fresh = Model(returns_model, tickers, inputs)
+            return fresh.max_sharpe(risk_free_rate=fresh.risk_free_rate)
+
+        weights = record("max_sharpe", max_sharpe)
+        record("historical_performance", lambda: model.historical_performance(weights))
+
+    return stages
+
+
+def reset_dir(path):
+    """ Deletes a directory if it exists. """
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def git_revision():
+    """ Current commit hash, or None outside a git checkout. """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """ CLI entry point """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tickers", type=int, default=50)
+    parser.add_argument("--days", type=int, default=800)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write results JSON here instead of stdout")
+    parser.add_argument("--baseline", help="Results JSON from another commit to compare against")
+    args = parser.parse_args()
+
+    # Keep stdout for the JSON results only
+    with redirect_stdout(sys.stderr):
+        stages = run(args.tickers, args.days, args.repeat, args.seed)
+    results = {
+        "revision": git_revision(),
+        "params": {"tickers": args.tickers, "days": args.days,
+                   "repeat": args.repeat, "seed": args.seed},
+        "stages": stages
+        }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["stages"]
+        print(f"{'stage':<24}{'baseline (s)':>14}{'current (s)':>14}{'ratio':>8}")
+        for name, stage in results["stages"].items():
+            if name in baseline:
+                old = baseline[name]["median_s"]
+                print(f"{name:<24}{old:>14.4f}{stage['median_s']:>14.4f}"
+                      f"{stage['median_s'] / old:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+""" Measures risk simulation throughput against a per-path Python loop.
+
+Usage: python -m benchmarks.risk [--paths 10000 100000 1000000] [--horizon 21] [--workers 0]
+"""
+
+import argparse
+from time import perf_counter
+import numpy as np
+from services import risk
+
+
+def loop_bootstrap(returns, paths, horizon, block, rng):
+    """ The same circular block bootstrap, one path and one day at a time """
+    losses = np.empty(paths)
+    drawdowns = np.empty(paths)
+    for p in range(paths):
+        wealth, peak, drawdown = 1.0, 1.0, 0.0
+        day = 0
+        while day < horizon:
+            start = rng.integers(0, len(returns))
+            for i in range(min(block, horizon - day)):
+                wealth *= 1 + returns[(start + i) % len(returns)]
+                peak = max(peak, wealth)
+                drawdown = max(drawdown, 1 - wealth / peak)
+            day += block
+        losses[p] = 1 - wealth
+        drawdowns[p] = drawdown
+    return losses, drawdowns
+
+
+def main():
+    """ CLI entry point """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--paths", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--horizon", type=int, default=21)
+    parser.add_argument("--workers", type=int, default=0)
+    args = parser.parse_args()
+
+    returns = np.random.default_rng(0).normal(4e-4, 0.012, 750)
+    volatility = returns.std() * np.sqrt(risk.TRADEDAYS_IN_YEAR)
+
+    start = perf_counter()
+    loop_paths = 2_000
+    loop_bootstrap(returns, loop_paths, args.horizon, 5, np.random.default_rng(0))
+    loop_rate = loop_paths / (perf_counter() - start)
+    print(f"python loop bootstrap: {loop_rate:,.0f} paths/s")
+
+    print(f"{'paths':<11}{'method':<12}{'seconds':>10}{'paths/s':>14}{'vs loop':>10}")
+    for paths in args.paths:
+        for method in ["bootstrap", "normal"]:
+            start = perf_counter()
+            risk.risk_report(returns, volatility, [method], paths, args.horizon,
+                             seed=0, workers=args.workers)
+            elapsed = perf_counter() - start
+            print(f"{paths:<11}{method:<12}{elapsed:>10.3f}{paths / elapsed:>14,.0f}"
+                  f"{paths / elapsed / loop_rate:>9.0f}x")
+
+
+if __name__ == "__main__":
+    main()
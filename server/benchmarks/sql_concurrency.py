@@ -0,0 +1,161 @@
+""" Hammers the price store with concurrent readers and writers, comparing
+a fresh rollback-journal connection per operation (the old setup) against
+pooled WAL connections with the per-process writer thread.
+
+Reports read and write latency percentiles, "database is locked" failures
+and, for the pooled store, the time writes waited for the write lock.
+
+Usage: python -m benchmarks.sql_concurrency [--processes 4] [--readers 8] [--writers 4]
+                                            [--seconds 5] [--tickers 200]
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+from time import perf_counter
+import numpy as np
+import config
+from services import sql
+from services.metrics import metrics, summarize
+from .sql_store import make_prices
+
+MODES = ["legacy", "pooled"]
+
+
+def legacy_read(path, tickers):
+    """ A read the old way: a new connection per operation """
+    with closing(sqlite3.connect(path)) as con:
+        return sql.get_price_panel(con, tickers)
+
+
+def legacy_write(path, df):
+    """ A write the old way: a new connection and commit per operation """
+    rows = sql.price_rows(df)
+    with closing(sqlite3.connect(path)) as con, con:
+        con.executemany(f"INSERT OR REPLACE INTO {sql.PRICE_TABLE} VALUES (?, ?, ?)", rows)
+
+
+def pooled_read(tickers):
+    """ A read through this thread's pooled connection """
+    with sql.connection() as con:
+        return sql.get_price_panel(con, tickers)
+
+
+def run_process(mode, path, readers, writers, seconds, tickers, seed):
+    """ Runs reader and writer threads against the store for a while.
+    Module level so process pools can run it.
+
+    :return: Read and write latencies in seconds, failures,
+             and this process's db.lock_wait histogram (pooled only)
+    :rtype: Dict[str, Any]
+    """
+    config.DB_PATH = path
+    metrics.histograms.pop("db.lock_wait", None)
+    prices = make_prices(tickers, 30, seed)
+    deadline = perf_counter() + seconds
+    results = {"read": [], "write": [], "failed": 0}
+    lock = threading.Lock()
+
+    def loop(kind, thread_seed):
+        rng = random.Random(thread_seed)
+        latencies = []
+        failed = 0
+        while perf_counter() < deadline:
+            names = rng.sample(list(prices.columns), 20 if kind == "read" else 10)
+            start = perf_counter()
+            try:
+                if kind == "read":
+                    if mode == "legacy":
+                        legacy_read(path, names)
+                    else:
+                        pooled_read(names)
+                else:
+                    # Overwrite a few recent days, like a price refresh does
+                    df = prices[names].tail(5) * rng.uniform(0.99, 1.01)
+                    if mode == "legacy":
+                        legacy_write(path, df)
+                    else:
+                        sql.write_prices(df)
+            except sqlite3.OperationalError:
+                failed += 1
+                continue
+            latencies.append(perf_counter() - start)
+        with lock:
+            results[kind].extend(latencies)
+            results["failed"] += failed
+
+    threads = [threading.Thread(target=loop, args=("read", seed * 1000 + i))
+               for i in range(readers)]
+    threads += [threading.Thread(target=loop, args=("write", seed * 1000 + readers + i))
+                for i in range(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    results["lock_wait"] = metrics.histograms.get("db.lock_wait")
+    return results
+
+
+def setup_db(path, mode, tickers, days):
+    """ Creates a store with history for every ticker, in the mode's journal mode """
+    if mode == "pooled":
+        con = sql.get_connection(path)
+    else:
+        con = sqlite3.connect(path)
+        sql.init_db(con)
+    with closing(con):
+        sql.insert_price_data(con, make_prices(tickers, days))
+
+
+def percentiles(latencies):
+    """ p50/p95/p99 in milliseconds """
+    if not latencies:
+        return "-"
+    p = np.percentile(latencies, [50, 95, 99]) * 1000
+    return f"{p[0]:7.2f} {p[1]:7.2f} {p[2]:8.2f}"
+
+
+def main():
+    """ CLI entry point """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=8, help="reader threads per process")
+    parser.add_argument("--writers", type=int, default=4, help="writer threads per process")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--tickers", type=int, default=200)
+    parser.add_argument("--days", type=int, default=730)
+    args = parser.parse_args()
+
+    print(f"{'mode':<8}{'reads/s':>9}{'writes/s':>10}{'failed':>8}"
+          f"   read ms p50/p95/p99      write ms p50/p95/p99   lock wait")
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in MODES:
+            path = os.path.join(tmp, f"{mode}.db")
+            setup_db(path, mode, args.tickers, args.days)
+            with ProcessPoolExecutor(args.processes) as pool:
+                runs = list(pool.map(run_process, *zip(*[
+                    (mode, path, args.readers, args.writers, args.seconds, args.tickers, p)
+                    for p in range(args.processes)])))
+
+            reads = [x for r in runs for x in r["read"]]
+            writes = [x for r in runs for x in r["write"]]
+            failed = sum(r["failed"] for r in runs)
+            lock_wait = "-"
+            waits = [r["lock_wait"] for r in runs if r["lock_wait"]]
+            if waits:
+                merged = {"count": sum(w["count"] for w in waits),
+                          "sum": sum(w["sum"] for w in waits),
+                          "buckets": [sum(b) for b in zip(*[w["buckets"] for w in waits])]}
+                summary = summarize(merged)
+                lock_wait = f"mean {summary['mean'] * 1000:.2f}ms p99 <={summary['p99']}s"
+            print(f"{mode:<8}{len(reads) / args.seconds:>9.0f}{len(writes) / args.seconds:>10.0f}"
+                  f"{failed:>8}   {percentiles(reads):<24} {percentiles(writes):<24} {lock_wait}")
+
+
+if __name__ == "__main__":
+    main()
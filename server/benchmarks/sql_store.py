@@ -0,0 +1,115 @@
+""" Compares the legacy per-ticker price tables against the long-format price store.
+
+Usage: python -m benchmarks.sql_store [--tickers 50] [--days 730]
+"""
+
+import argparse
+import os
+import sqlite3
+import tempfile
+from contextlib import closing
+from time import perf_counter
+import numpy as np
+import pandas as pd
+from services import sql
+
+
+def legacy_insert(con, df):
+    """ The original row-by-row insert, one table and commit per ticker. """
+    with closing(con.cursor()) as cur:
+        for ticker in df:
+            cur.execute(f"CREATE TABLE IF NOT EXISTS {ticker} (t INTEGER PRIMARY KEY, price REAL)")
+            for t, price in df[ticker].items():
+                cur.execute(f"INSERT OR REPLACE INTO {ticker} VALUES (?, ?)",
+                            (int(t.timestamp()), price))
+            con.commit()
+
+
+def legacy_recent_entry(con, ticker, today, limit=750):
+    """ The original day-by-day probe for the latest entry. """
+    with closing(con.cursor()) as cur:
+        while limit > 0:
+            cur.execute(f"SELECT price FROM {ticker} WHERE t={int(today.timestamp())}")
+            if cur.fetchone():
+                return today
+            today = today - pd.Timedelta(1, "day")
+            limit -= 1
+        return None
+
+
+def legacy_price_data(con, ticker, start, days=750):
+    """ The original day-by-day read, growing a Series one entry at a time. """
+    with closing(con.cursor()) as cur:
+        day_to_get = start - pd.Timedelta(days, "d")
+        data = pd.Series()
+        while day_to_get <= start:
+            res = cur.execute(f"SELECT * FROM {ticker} WHERE t={day_to_get.timestamp()}").fetchone()
+            if res:
+                data[pd.Timestamp(res[0], unit="s")] = res[1]
+            day_to_get = day_to_get + pd.Timedelta(1, "day")
+        data.name = ticker
+        return data
+
+
+def make_prices(num_tickers, num_days, seed=0):
+    """ Random-walk closes for tickers T000, T001, ... over business days. """
+    rng = np.random.default_rng(seed)
+    index = pd.bdate_range(end=pd.Timestamp.today().normalize(), periods=num_days)
+    steps = rng.normal(0.0003, 0.02, size=(num_days, num_tickers))
+    prices = 100 * np.exp(np.cumsum(steps, axis=0))
+    return pd.DataFrame(prices, index=index, columns=[f"T{i:03}" for i in range(num_tickers)])
+
+
+def timed(func, *args):
+    """ Runs func and returns (result, seconds). """
+    start = perf_counter()
+    res = func(*args)
+    return res, perf_counter() - start
+
+
+def run(num_tickers, num_days):
+    """ Times insert, latest-entry lookup and full read on both layers.
+
+    :rtype: Dict[str, Dict[str, float]]
+    """
+    df = make_prices(num_tickers, num_days)
+    tickers = list(df.columns)
+    end = df.index[-1]
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with closing(sqlite3.connect(os.path.join(tmp, "legacy.db"))) as con:
+            _, insert = timed(legacy_insert, con, df)
+            _, recent = timed(lambda: [legacy_recent_entry(con, t, end) for t in tickers])
+            old, read = timed(lambda: pd.concat([legacy_price_data(con, t, end) for t in tickers],
+                                                axis=1))
+            results["legacy"] = {"insert": insert, "recent": recent, "read": read}
+
+        with closing(sqlite3.connect(os.path.join(tmp, "store.db"))) as con:
+            sql.init_db(con)
+            _, insert = timed(sql.insert_price_data, con, df)
+            _, recent = timed(sql.find_recent_entries, con, tickers)
+            new, read = timed(sql.get_price_panel, con, tickers, end - pd.Timedelta(750, "d"), end)
+            results["store"] = {"insert": insert, "recent": recent, "read": read}
+
+    pd.testing.assert_frame_equal(old, new, check_freq=False)
+    return results
+
+
+def main():
+    """ CLI entry point """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tickers", type=int, default=50)
+    parser.add_argument("--days", type=int, default=2 * 252)
+    args = parser.parse_args()
+
+    results = run(args.tickers, args.days)
+    print(f"{args.tickers} tickers x {args.days} trading days")
+    print(f"{'stage':<8}{'legacy (s)':>12}{'store (s)':>12}{'speedup':>10}")
+    for stage in results["legacy"]:
+        old, new = results["legacy"][stage], results["store"][stage]
+        print(f"{stage:<8}{old:>12.4f}{new:>12.4f}{old / new:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
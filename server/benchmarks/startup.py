@@ -0,0 +1,79 @@
+""" Profiles server startup: import time of wsgi, time to the first health
+check and time until the models are loaded.
+
+Runs the server module in a fresh interpreter with -X importtime, so point
+it at offline data (PRICE_PROVIDER=replay) for repeatable numbers.
+
+Usage: python -m benchmarks.startup [--mode background|prefork|lazy] [--server-dir DIR]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+PROBE = """
+import json, os, time
+start = time.perf_counter()
+import wsgi
+imported = time.perf_counter()
+client = wsgi.server.test_client()
+client.get("/healthcheck")
+healthy = time.perf_counter()
+# Servers without a readiness endpoint (404) are ready once imported.
+# In lazy mode nothing loads until a request needs it, so load it here.
+if os.environ["WARMUP"] == "lazy" and client.get("/readiness").status_code == 503:
+    from services.warmup import warmup
+    warmup()
+while client.get("/readiness").status_code == 503 and \\
+        client.get("/readiness").get_json()["status"] == "LOADING":
+    time.sleep(0.01)
+ready = time.perf_counter()
+print(json.dumps({"import_s": imported - start, "healthcheck_s": healthy - start,
+                  "ready_s": ready - start}))
+"""
+
+
+def profile(server_dir, mode, top=10):
+    """ Starts the server module in a subprocess and times it.
+
+    :param server_dir: Directory containing wsgi.py
+    :type server_dir: str
+    :param mode: WARMUP mode
+    :type mode: str
+    :param top: Number of slowest imports to report, from the first
+                three levels of the import tree
+    :type top: int
+
+    :rtype: Dict[str, Any]
+    """
+    env = {**os.environ, "WARMUP": mode}
+    res = subprocess.run([sys.executable, "-X", "importtime", "-c", PROBE], cwd=server_dir,
+                         env=env, capture_output=True, text=True, check=True)
+    timings = json.loads(res.stdout.strip().splitlines()[-1])
+
+    imports = []
+    for line in res.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth <= 2:
+            imports.append((name.strip(), int(cumulative) / 1e6))
+    imports.sort(key=lambda i: i[1], reverse=True)
+    timings["slowest_imports_s"] = dict(imports[:top])
+    return timings
+
+
+def main():
+    """ CLI entry point """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", default="background", choices=["background", "prefork", "lazy"])
+    parser.add_argument("--server-dir", default=os.getcwd())
+    args = parser.parse_args()
+    print(json.dumps(profile(args.server_dir, args.mode), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+""" Reproducible synthetic market data, served through the PriceProvider interface
+so the whole pipeline can run without network access.
+"""
+
+import zlib
+import numpy as np
+import pandas as pd
+from services.providers import PriceProvider
+
+RATE_SYMBOLS = ["^IRX"]
+
+
+def ticker_names(num_tickers):
+    """ Synthetic ticker names S0000, S0001, ...
+
+    :rtype: str[]
+    """
+    return [f"S{i:04}" for i in range(num_tickers)]
+
+
+class SyntheticProvider(PriceProvider):
+    """ Generates correlated daily closes on demand. Every symbol loads on a
+    shared market path plus its own noise, both seeded, so a symbol's history
+    is the same no matter which other symbols are requested with it.
+
+    :param days: Trading days of history, ending today
+    :type days: int
+    :param seed: Seed for the market path and every symbol
+    :type seed: int
+    :param vol: Daily volatility of the market path
+    :type vol: float
+    """
+    def __init__(self, days=800, seed=0, vol=0.01):
+        self.seed = seed
+        self.index = pd.bdate_range(end=pd.Timestamp.today().normalize(), periods=days)
+        rng = np.random.default_rng(seed)
+        self.market = np.cumsum(rng.normal(0.0003, vol, days))
+        self.vol = vol
+        self.cache = {}
+
+    def closes(self, symbol):
+        """ The full generated history of one symbol.
+
+        :rtype: numpy.ndarray
+        """
+        if symbol not in self.cache:
+            rng = np.random.default_rng([self.seed, zlib.crc32(symbol.encode())])
+            days = len(self.index)
+            if symbol in RATE_SYMBOLS:
+                path = 4 + np.cumsum(rng.normal(0, 0.02, days))
+            else:
+                beta = rng.uniform(0.5, 1.5)
+                noise = np.cumsum(rng.normal(0, 2 * self.vol, days))
+                path = rng.uniform(20, 500) * np.exp(beta * self.market + noise)
+            self.cache[symbol] = path
+        return self.cache[symbol]
+
+    def download(self, symbols, start, end=None):
+        keep = self.index >= pd.Timestamp(start)
+        if end is not None:
+            keep &= self.index < pd.Timestamp(end)
+        data = {s: self.closes(s)[keep] for s in symbols}
+        return pd.DataFrame(data, index=self.index[keep], columns=symbols)
+
+    def panel(self, symbols):
+        """ The full generated history of many symbols.
+
+        :rtype: pandas.DataFrame, indexed by pandas.Timestamp
+        """
+        return self.download(symbols, self.index[0])
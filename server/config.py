@@ -3,3 +3,68 @@
 import os
 
 PORT = os.environ.get("PORT", 5000)
+DB_PATH = os.environ.get("PRICE_DB", "prices.db")
+# Seconds a connection waits for another process's write lock before failing
+DB_BUSY_TIMEOUT = float(os.environ.get("DB_BUSY_TIMEOUT", 30))
+
+# Memory-mapped matrix of every stored price next to the database, shared by
+# all workers ("on" or "off"), see services.panel
+PRICE_PANEL = os.environ.get("PRICE_PANEL", "on") == "on"
+
+# Market data source: "yfinance" or "replay" (reads <PRICE_REPLAY_DIR>/<TICKER>.csv)
+PRICE_PROVIDER = os.environ.get("PRICE_PROVIDER", "yfinance")
+PRICE_REPLAY_DIR = os.environ.get("PRICE_REPLAY_DIR", "replay")
+# Seconds each replay download waits, so load tests pay for cold tickers like the network
+PRICE_REPLAY_LATENCY = float(os.environ.get("PRICE_REPLAY_LATENCY", 0))
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", 4))
+FETCH_BATCH_SIZE = int(os.environ.get("FETCH_BATCH_SIZE", 50))
+# Per-ticker lease files so only one process downloads a ticker at a time,
+# and the longest a request waits on another process's download before doing its own
+FETCH_LOCK_DIR = os.environ.get("FETCH_LOCK_DIR", "fetch_locks")
+FETCH_LEASE_TIMEOUT = float(os.environ.get("FETCH_LEASE_TIMEOUT", 120))
+
+# Nightly prewarm.py: JSON file of named ticker lists to keep stored and fit,
+# and tickers per provider download
+PREWARM_UNIVERSES_PATH = os.environ.get("PREWARM_UNIVERSES_PATH", "")
+PREWARM_BATCH_SIZE = int(os.environ.get("PREWARM_BATCH_SIZE", 200))
+
+# Factor snapshots shared by all workers, rebuilt once per trading day
+FACTOR_CACHE_DIR = os.environ.get("FACTOR_CACHE_DIR", "factor_cache")
+# Optional JSON file of extra named factor sets, see services.factors.factor_sets
+FACTOR_SETS_PATH = os.environ.get("FACTOR_SETS_PATH", "")
+
+# Optimization results cached per (ticker set, trading day)
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 256))
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", 60 * 60))
+
+# Background optimization jobs (POST /jobs)
+JOB_DIR = os.environ.get("JOB_DIR", "jobs")
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+JOB_TTL = float(os.environ.get("JOB_TTL", 10 * 60))
+
+# Covariance model: "sample", "factor" (B·F·Bᵀ + D from the Carhart factors), or
+# "auto" for factor covariance on universes of FACTOR_COVARIANCE_MIN_TICKERS or more
+COVARIANCE_MODE = os.environ.get("COVARIANCE_MODE", "auto")
+FACTOR_COVARIANCE_MIN_TICKERS = int(os.environ.get("FACTOR_COVARIANCE_MIN_TICKERS", 200))
+
+# Compiled max_sharpe problems kept per worker, one per universe size and
+# constraint shape, see services.optimizer
+OPTIMIZER_CACHE_SIZE = int(os.environ.get("OPTIMIZER_CACHE_SIZE", 64))
+
+# Parallel max_sharpe solves per PUT /batch request
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", 4))
+
+# Risk simulations (PUT /model "risk"): default and maximum paths per method,
+# and processes per worker to simulate in, 0 to simulate in the request thread
+RISK_PATHS = int(os.environ.get("RISK_PATHS", 100_000))
+RISK_MAX_PATHS = int(os.environ.get("RISK_MAX_PATHS", 1_000_000))
+RISK_WORKERS = int(os.environ.get("RISK_WORKERS", 0))
+
+# Processes per worker that PUT /backtest spreads rebalance windows over
+BACKTEST_WORKERS = int(os.environ.get("BACKTEST_WORKERS", 4))
+
+# How the factor model is loaded: "background", "prefork" or "lazy", see services.warmup
+WARMUP = os.environ.get("WARMUP", "background")
+
+# Per-worker latency metrics, aggregated by GET /metrics
+METRICS_DIR = os.environ.get("METRICS_DIR", "metrics")
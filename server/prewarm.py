@@ -0,0 +1,150 @@
+""" Prewarms everything the /model pipeline reads, so requests don't need the network.
+
+For the configured universes and every factor set's constituents, this
+1. downloads the missing price history in large batches into the price store,
+2. builds each factor set's snapshot for the last trading day,
+3. fits every ticker and stores its betas and expected return for that day
+   (services.sql.save_fits), which requests reuse instead of fitting.
+
+Run it after the close; uwsgi.ini schedules it every evening. A universes
+file maps names to ticker lists, e.g. {"sp500": ["AAPL", "MSFT", ...]}.
+
+Usage: python prewarm.py [--universes universes.json] [--factor-set default ...]
+                         [--batch-size 200] [--chunk 1000]
+"""
+
+import argparse
+import json
+import logging
+import sys
+from time import perf_counter
+import config
+from services import sql, panel
+from services.sql import connection
+from services.errors import TickerException
+from services.factors import factor_sets, m12_return_rate, RISK_FREE_SYMBOL, MARKET_SYMBOL
+from services.price_fetching import fetch_prices
+from services.returns import Carhart4FactorModel
+from services.calendar import trading_days_before
+from services.metrics import metrics
+
+logger = logging.getLogger("prewarm")
+
+
+def load_universes(path):
+    """ Reads a universes file
+
+    :param path: JSON file mapping universe names to tickers, or "" for none
+    :type path: str
+
+    :rtype: Dict[str, str[]]
+    """
+    if not path:
+        return {}
+    with open(path, encoding="utf-8") as f:
+        universes = json.load(f)
+    return {name: [t.upper() for t in tickers] for name, tickers in universes.items()}
+
+
+def download(con, symbols, chunk):
+    """ Stores the missing price history of symbols, chunk by chunk.
+    Symbols the provider has no data for are skipped.
+
+    :param con: Active database connection.
+    :type con: sqlite3.Connection
+    :type symbols: str[]
+    :param chunk: Symbols per fetch_prices call
+    :type chunk: int
+
+    :return: Symbols that failed
+    :rtype: str[]
+    """
+    failed = []
+    for i in range(0, len(symbols), chunk):
+        pending = symbols[i:i + chunk]
+        while pending:
+            try:
+                fetch_prices(con, pending)
+                break
+            except TickerException as e:
+                bad = e.ticker if isinstance(e.ticker, list) else [e.ticker]
+                logger.warning("Skipping %s: %s", bad, e.message)
+                failed += bad
+                pending = [t for t in pending if t not in bad]
+    return failed
+
+
+def store_fits(con, tickers, factor_set):
+    """ Fits tickers on a factor set's snapshot for the last trading day and
+    stores the fits. Tickers without that day's close are left out, since
+    requests would download it and fit again.
+
+    :param con: Active database connection.
+    :type con: sqlite3.Connection
+    :type tickers: str[]
+    :type factor_set: str
+
+    :return: Number of tickers fit
+    :rtype: int
+    """
+    model = Carhart4FactorModel(factor_set=factor_set)
+    day = model.trading_day
+    recent = sql.find_recent_entries(con, tickers)
+    current = [t for t in tickers if recent[t] is not None and recent[t] >= day]
+    if not current:
+        return 0
+    prices = panel.read_prices(con, current, trading_days_before(day, sql.HISTORY_DAYS), day)
+    fits = model.fit(m12_return_rate(prices))
+    sql.save_fits(con, factor_set, day, fits)
+    return int(fits["expected_return"].notna().sum())
+
+
+def report(phase, count, seconds):
+    """ Prints one line of throughput """
+    rate = count / max(seconds, 1e-9)
+    print(f"{phase:<24}{count:>8} tickers {seconds:>9.2f}s {rate:>10.1f} tickers/s")
+
+
+def main():
+    """ CLI entry point """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--universes", default=config.PREWARM_UNIVERSES_PATH,
+                        help="JSON file of named ticker lists")
+    parser.add_argument("--factor-set", nargs="+", default=None,
+                        help="factor sets to prewarm, defaults to all")
+    parser.add_argument("--batch-size", type=int, default=config.PREWARM_BATCH_SIZE,
+                        help="tickers per provider download")
+    parser.add_argument("--chunk", type=int, default=1000, help="tickers stored per pass")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    config.FETCH_BATCH_SIZE = args.batch_size
+    sets = args.factor_set or list(factor_sets())
+    unknown = [s for s in sets if s not in factor_sets()]
+    if unknown:
+        parser.error(f"unknown factor sets: {', '.join(unknown)}")
+
+    universes = load_universes(args.universes)
+    constituents = [t for s in sets for bucket in factor_sets()[s].values() for t in bucket]
+    tickers = list(dict.fromkeys([*(t for u in universes.values() for t in u), *constituents]))
+    total = perf_counter()
+
+    with connection() as con:
+        start = perf_counter()
+        failed = download(con, [*tickers, MARKET_SYMBOL, RISK_FREE_SYMBOL], args.chunk)
+        report("download", len(tickers) + 2 - len(failed), perf_counter() - start)
+        print(f"{'':<24}{metrics.counters.get('provider.rows_downloaded', 0):>8} rows downloaded, "
+              f"{len(failed)} tickers failed")
+
+        tickers = [t for t in tickers if t not in failed]
+        for factor_set in sets:
+            start = perf_counter()
+            fit = store_fits(con, tickers, factor_set)
+            report(f"fits ({factor_set})", fit, perf_counter() - start)
+
+    report("total", len(tickers), perf_counter() - total)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,217 @@
 """ Routes for core trader functionality.
 All route responses should have a "status" field.
+
+Modules that pull in pandas, cvxpy or pypfopt are imported inside the routes
+that need them, so importing this file stays fast (see services.warmup).
 """
+# pylint: disable=import-outside-toplevel
 
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request
 from flask_cors import CORS
 from util import require_json_params, require_authentication
-from services.returns import Carhart4FactorModel
-from services.model import Model
+from services.cache import ResultCache, portfolio_key
+from services.jobs import JobQueue, JobError, DONE, ERROR
+from services.metrics import metrics, timed
 from services.errors import TickerException
 from services.auth import create_jwt
+from services.warmup import get_returns_model, status as warmup_status
+from services.encoding import negotiate, encode, JSON
+from config import RESULT_CACHE_SIZE, RESULT_CACHE_TTL, JOB_DIR, JOB_WORKERS, JOB_TTL, \
+    BATCH_WORKERS, RISK_PATHS, RISK_MAX_PATHS, RISK_WORKERS, BACKTEST_WORKERS
 
 core_blueprint = Blueprint("core", __name__, url_prefix="/")
 CORS(core_blueprint)
-returns_model = Carhart4FactorModel()
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+job_queue = JobQueue(JOB_DIR, JOB_WORKERS, JOB_TTL)
+
+
+def parse_tickers(raw):
+    """ Uppercases requested tickers and drops empty ones.
+
+    :param raw: Tickers from the request body
+    :type raw: str[]
+
+    :return: The tickers, or None if any of them are duplicates
+    :rtype: str[] | None
+    """
+    tickers = list(filter(bool, map(lambda t: t.upper(), raw)))
+    if len(tickers) > len(set(tickers)):
+        return None
+    return tickers
+
+
+def parse_risk_options(raw):
+    """ Validates the "risk" field of PUT /model.
+
+    :param raw: true for the defaults, or an object with any of "methods",
+                "paths", "horizon", "confidence" and "seed"
+    :type raw: bool | Dict[str, Any]
+
+    :return: Keyword arguments for services.risk.risk_report, or None if invalid
+    :rtype: Dict[str, Any] | None
+    """
+    if raw is True:
+        raw = {}
+    if not isinstance(raw, dict) or not set(raw) <= {"methods", "paths", "horizon",
+                                                     "confidence", "seed"}:
+        return None
+    options = {
+        "methods": raw.get("methods"),
+        "paths": raw.get("paths", RISK_PATHS),
+        "horizon": raw.get("horizon", 21),
+        "confidence": raw.get("confidence", 0.95),
+        "seed": raw.get("seed"),
+        "workers": RISK_WORKERS
+        }
+    methods = options["methods"]
+    valid = (methods is None or isinstance(methods, list) and methods
+             and set(methods) <= {"historical", "bootstrap", "normal"}) \
+        and isinstance(options["paths"], int) and 1 <= options["paths"] <= RISK_MAX_PATHS \
+        and isinstance(options["horizon"], int) and 1 <= options["horizon"] <= 252 \
+        and isinstance(options["confidence"], float) and 0.5 <= options["confidence"] < 1 \
+        and (options["seed"] is None or isinstance(options["seed"], int))
+    return options if valid else None
+
+
+def is_number(value):
+    """ Whether a JSON value is a number, and not a boolean """
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def parse_constraints(raw, tickers):
+    """ Validates the "constraints" field of PUT /model.
+
+    :param raw: An object with any of "bounds" (ticker to [min, max] weight),
+                "sectors" (ticker to sector name), "sector_caps" (sector to max
+                total weight), "holdings" (ticker to current weight) and
+                "max_turnover" (max sum of weight changes, needed with holdings)
+    :type raw: Dict[str, Any]
+    :param tickers: The requested tickers, all uppercase
+    :type tickers: str[]
+
+    :return: The constraints, or None if invalid
+    :rtype: services.optimizer.PortfolioConstraints | None
+    """
+    from services.optimizer import PortfolioConstraints
+    if not isinstance(raw, dict) or not set(raw) <= {"bounds", "sectors", "sector_caps",
+                                                     "holdings", "max_turnover"}:
+        return None
+    fields = [raw.get(name, {}) for name in ["bounds", "sectors", "sector_caps", "holdings"]]
+    if not all(isinstance(field, dict) for field in fields):
+        return None
+    bounds, sectors, caps, holdings = fields
+    bounds = {t.upper(): b for t, b in bounds.items()}
+    sectors = {t.upper(): s for t, s in sectors.items()}
+    holdings = {t.upper(): w for t, w in holdings.items()}
+    max_turnover = raw.get("max_turnover")
+    valid = set(bounds) <= set(tickers) and set(sectors) <= set(tickers) \
+        and all(isinstance(b, list) and len(b) == 2 and all(map(is_number, b))
+                and -1 <= b[0] <= b[1] <= 1 for b in bounds.values()) \
+        and all(isinstance(s, str) for s in sectors.values()) \
+        and all(is_number(c) and 0 <= c <= 1 for c in caps.values()) \
+        and all(is_number(w) and -1 <= w <= 1 for w in holdings.values()) \
+        and (max_turnover is None and not holdings
+             or is_number(max_turnover) and max_turnover >= 0)
+    if not valid:
+        return None
+    return PortfolioConstraints({t: tuple(b) for t, b in bounds.items()}, sectors, caps,
+                                holdings, max_turnover)
+
+
+def factor_set_error(factor_set):
+    """ Response for an unknown factor_set, None if it is known
+
+    :type factor_set: str
+    """
+    from services.factors import factor_sets
+    if factor_set in factor_sets():
+        return None
+    return jsonify({
+        "status": "ERROR",
+        "error": f"Factor set {factor_set} does not exist."
+        }), 400
+
+
+def format_error():
+    """ Response for an unknown ?format= """
+    return jsonify({
+        "status": "ERROR",
+        "error": "format must be one of json, columnar, msgpack or arrow."
+        }), 400
+
+
+def portfolio_response(result, tickers, value, **extra):
+    """ Serializes a PortfolioResult in the format the request asked for.
+
+    :type result: services.portfolio.PortfolioResult
+    :param extra: Extra response fields
+    """
+    fmt = negotiate(request)
+    with metrics.timer("response.serialize"):
+        if fmt == JSON:
+            return jsonify({ **result.to_response(tickers, value), **extra })
+        payload = { **result.to_response(tickers, value, columnar=True), **extra }
+        body, mimetype = encode(payload, fmt, series="performance")
+        return Response(body, mimetype=mimetype)
+
+
+def optimization_error(error, constraints=None):
+    """ Error message for a portfolio that can't be optimized, the same on
+    every route
+
+    :param error: What optimizing raised
+    :type error: ValueError | pypfopt.exceptions.OptimizationError | cvxpy.SolverError
+    :type constraints: services.optimizer.PortfolioConstraints | None
+    :rtype: str
+    """
+    if isinstance(error, ValueError):
+        # No asset's expected return exceeds the risk-free rate
+        return str(error)
+    if constraints is not None:
+        return "No portfolio meets the constraints."
+    return "No portfolio could be optimized over these tickers."
+
+
+def cached_optimize(tickers, factor_set="default", as_of=None, constraints=None):
+    """ Optimizes a portfolio over tickers, reusing cached results.
+
+    :param as_of: Trading day to optimize as of, None or the last trading day
+                  for the latest close
+    :type as_of: pandas.Timestamp | None
+    :type constraints: services.optimizer.PortfolioConstraints | None
+    """
+    from services.portfolio import optimize, optimize_as_of
+    key = portfolio_key(tickers, factor_set=factor_set)
+    # Constrained results are cached apart from the unconstrained ones /batch reads
+    extra = (constraints.key(),) if constraints is not None else ()
+    if as_of is not None and as_of != key[1]:
+        return result_cache.get_or_compute(
+            (*portfolio_key(tickers, as_of, factor_set), *extra),
+            lambda: optimize_as_of(tickers, as_of, factor_set, constraints))
+    return result_cache.get_or_compute(
+        (*key, *extra), lambda: optimize(get_returns_model(factor_set), tickers, constraints))
+
+
+def parse_as_of(raw):
+    """ Validates the "as_of" field of PUT /model.
+
+    :param raw: A date, YYYY-MM-DD
+    :type raw: str
+
+    :return: The last trading day on or before the date, or None if invalid.
+             Dates from the last trading day on are the last trading day.
+    :rtype: pandas.Timestamp | None
+    """
+    import pandas as pd
+    from services.calendar import last_trading_day, trading_day_on_or_before
+    try:
+        day = pd.Timestamp(raw)
+    except (TypeError, ValueError):
+        return None
+    latest = last_trading_day()
+    if pd.isna(day) or day < latest - pd.DateOffset(years=20):
+        return None
+    return min(trading_day_on_or_before(day), latest)
 
 
 @core_blueprint.route("healthcheck")
@@ -21,7 +220,23 @@ def healthcheck():
     return jsonify({ "status": "OK" })
 
 
+@core_blueprint.route("readiness")
+def readiness():
+    """ Returns 200 OK once this worker has loaded its models, 503 until then """
+    ready = warmup_status()
+    if ready["ready"]:
+        return jsonify({ "status": "OK", **ready })
+    return jsonify({ "status": "ERROR" if "error" in ready else "LOADING", **ready }), 503
+
+
+@core_blueprint.route("metrics")
+def get_metrics():
+    """ Latency histograms and counters summed over every worker process """
+    return jsonify({ "status": "OK", **metrics.aggregate() })
+
+
 @core_blueprint.put("model")
+@timed("request.model")
 @require_authentication
 @require_json_params(["value", "tickers"])
 def get_weights():
@@ -31,42 +246,352 @@ def get_weights():
     :type value: float
     :param tickers: The tickers to create the portfolio over
     :type tickers: str[]
+    :param factor_set: Factor set to estimate returns with, defaults to "default"
+    :type factor_set: str
+    :param risk: Adds VaR, CVaR and max drawdown from historical simulation,
+                 block bootstrap and normal Monte Carlo. true for the defaults,
+                 or an object with any of "methods", "paths" (default
+                 RISK_PATHS), "horizon" in trading days (default 21),
+                 "confidence" (default 0.95) and "seed".
+    :type risk: bool | Dict[str, Any]
+    :param as_of: Optimize as of the close of a past day (YYYY-MM-DD), using
+                  only prices up to that day. Stored prices are reused, so
+                  the same day always gives the same portfolio. The response
+                  has the trading day used as "as_of".
+    :type as_of: str
+    :param constraints: Any of "bounds" ({ticker: [min, max]} weights),
+                        "sectors" ({ticker: sector}) with "sector_caps"
+                        ({sector: max weight}), and "holdings" ({ticker:
+                        current weight}) with "max_turnover" (max sum of
+                        |new weight - current weight|)
+    :type constraints: Dict[str, Any]
+
+    The performance series is keyed by ISO-8601 date by default. Pass
+    ?format=columnar|msgpack|arrow, or Accept application/msgpack or
+    application/vnd.apache.arrow.stream, for parallel arrays instead
+    (see services.encoding).
     """
     body = request.get_json()
     value = body["value"]
-    tickers = list(filter(bool, map(lambda t: t.upper(), body["tickers"])))
+    tickers = parse_tickers(body["tickers"])
+    factor_set = body.get("factor_set", "default")
+    risk_options = parse_risk_options(body["risk"]) if body.get("risk") else {}
+    as_of = parse_as_of(body["as_of"]) if body.get("as_of") else None
 
-    if len(tickers) > len(set(tickers)):
+    if negotiate(request) is None:
+        return format_error()
+    if body.get("as_of") and as_of is None:
+        return jsonify({
+            "status": "ERROR",
+            "error": "as_of must be a date (YYYY-MM-DD) in the last 20 years."
+            }), 400
+    if risk_options is None:
+        return jsonify({
+            "status": "ERROR",
+            "error": f"risk must be true or an object with methods, paths from 1 to "
+                     f"{RISK_MAX_PATHS}, horizon from 1 to 252, confidence from 0.5 to 1 "
+                     "and seed."
+            }), 400
+    error = factor_set_error(factor_set)
+    if error is not None:
+        return error
+
+    if tickers is None:
         return jsonify({
             "status": "ERROR",
             "error": "Duplicate tickers may not exist."
             }), 400
+    constraints = parse_constraints(body["constraints"], tickers) \
+        if body.get("constraints") else None
+    if body.get("constraints") and constraints is None:
+        return jsonify({
+            "status": "ERROR",
+            "error": "constraints may have bounds of requested tickers from -1 to 1, "
+                     "sectors of requested tickers, sector_caps from 0 to 1, "
+                     "and holdings from -1 to 1 with a max_turnover."
+            }), 400
 
+    from pypfopt.exceptions import OptimizationError
     try:
-        model = Model(returns_model, tickers)
+        result = cached_optimize(tickers, factor_set, as_of, constraints)
     except TickerException as e:
         return jsonify({
             "status": "ERROR",
             "error": e.message
             }), 400
+    except (ValueError, OptimizationError) as e:
+        return jsonify({
+            "status": "ERROR",
+            "error": optimization_error(e, constraints)
+            }), 400
 
-    print(model) # NO LOGGER 💀
-    portfolio = model.max_sharpe(risk_free_rate=model.risk_free_rate)
+    extra = {"as_of": as_of.strftime("%Y-%m-%d")} if as_of is not None else {}
+    if risk_options:
+        extra["risk"] = result.risk(**risk_options)
+    return portfolio_response(result, tickers, value, **extra)
 
-    perf = model.historical_performance(portfolio)
-    perf = {f"{ts.isoformat(timespec="seconds")}Z": perf[ts] for ts in perf.index}
 
-    return jsonify({
-        "status": "OK",
-        "tickers": tickers,
-        "value": value,
-        "weights": portfolio,
-        "shares": model.share_count(value, portfolio),
-        "return": (model.portfolio_returns(portfolio) - 1) * value,
-        "volatility": model.portfolio_risk(portfolio),
-        "sharpe": model.sharpe_ratio(portfolio),
-        "performance": perf
-        })
+@core_blueprint.put("frontier")
+@timed("request.frontier")
+@require_authentication
+@require_json_params(["tickers"])
+def get_frontier():
+    """ Returns portfolios along the efficient frontier. Points the solver
+    fails on are left out and counted in "dropped"; points it only solved
+    to reduced accuracy are flagged "inaccurate".
+
+    :param tickers: The tickers to create the portfolios over
+    :type tickers: str[]
+    :param points: Number of frontier portfolios, 2 to 200, defaults to 100
+    :type points: int
+    :param target: "return" for evenly spaced returns (default),
+                   "risk" for evenly spaced volatilities
+    :type target: str
+    :param factor_set: Factor set to estimate returns with, defaults to "default"
+    :type factor_set: str
+    """
+    body = request.get_json()
+    tickers = parse_tickers(body["tickers"])
+    points = body.get("points", 100)
+    target = body.get("target", "return")
+    factor_set = body.get("factor_set", "default")
+
+    error = factor_set_error(factor_set)
+    if error is not None:
+        return error
+
+    if tickers is None:
+        return jsonify({
+            "status": "ERROR",
+            "error": "Duplicate tickers may not exist."
+            }), 400
+    if not isinstance(points, int) or not 2 <= points <= 200 or target not in ["return", "risk"]:
+        return jsonify({
+            "status": "ERROR",
+            "error": "points must be an integer from 2 to 200, target must be return or risk."
+            }), 400
+
+    from services.model import Model
+    from pypfopt.exceptions import OptimizationError
+    try:
+        model = Model(get_returns_model(factor_set), tickers)
+    except TickerException as e:
+        return jsonify({
+            "status": "ERROR",
+            "error": e.message
+            }), 400
+
+    try:
+        with metrics.timer("model.frontier"):
+            stats, weights, dropped = model.efficient_frontier(points, target)
+    except OptimizationError:
+        return jsonify({
+            "status": "ERROR",
+            "error": "The efficient frontier of these tickers can't be solved."
+            }), 400
+    frontier = [{
+        "weights": w,
+        "return": s["return"],
+        "volatility": s["volatility"],
+        "sharpe": s["sharpe"],
+        "inaccurate": s["inaccurate"]
+        } for w, s in zip(weights.to_dict("records"), stats.to_dict("records"))]
+
+    with metrics.timer("response.serialize"):
+        return jsonify({
+            "status": "OK",
+            "tickers": tickers,
+            "target": target,
+            "frontier": frontier,
+            "dropped": dropped
+            })
+
+
+@core_blueprint.put("backtest")
+@timed("request.backtest")
+@require_authentication
+@require_json_params(["tickers"])
+def get_backtest():
+    """ Walk-forward backtest of the max sharpe portfolio: at every rebalance
+    day the model is re-estimated from the prices known on that day.
+
+    :param tickers: The tickers to invest in
+    :type tickers: str[]
+    :param start: First day of the backtest (YYYY-MM-DD), defaults to 5 years ago
+    :type start: str
+    :param frequency: "weekly", "monthly" (default) or "quarterly"
+    :type frequency: str
+    :param factor_set: Factor set to estimate returns with, defaults to "default"
+    :type factor_set: str
+    """
+    import pandas as pd
+    from services.backtest import backtest, FREQUENCIES
+    body = request.get_json()
+    tickers = parse_tickers(body["tickers"])
+    frequency = body.get("frequency", "monthly")
+    factor_set = body.get("factor_set", "default")
+    today = pd.Timestamp.today().normalize()
+    try:
+        start = pd.Timestamp(body.get("start") or today - pd.DateOffset(years=5))
+    except (TypeError, ValueError):
+        start = None
+
+    if tickers is None:
+        return jsonify({
+            "status": "ERROR",
+            "error": "Duplicate tickers may not exist."
+            }), 400
+    if start is None or not today - pd.DateOffset(years=20) <= start < today \
+            or frequency not in FREQUENCIES:
+        return jsonify({
+            "status": "ERROR",
+            "error": "start must be a date in the last 20 years, "
+                     "frequency must be weekly, monthly or quarterly."
+            }), 400
+    error = factor_set_error(factor_set)
+    if error is not None:
+        return error
+
+    try:
+        result = backtest(tickers, start, frequency, factor_set, BACKTEST_WORKERS)
+    except TickerException as e:
+        return jsonify({
+            "status": "ERROR",
+            "error": e.message
+            }), 400
+    if result is None:
+        return jsonify({
+            "status": "ERROR",
+            "error": "There is not enough price history to backtest from start."
+            }), 400
+
+    with metrics.timer("response.serialize"):
+        return jsonify({ **result.to_response(tickers), "frequency": frequency })
+
+
+@core_blueprint.put("batch")
+@timed("request.batch")
+@require_authentication
+@require_json_params(["portfolios"])
+def get_batch_weights():
+    """ Optimizes many portfolios in one request. Each result is the same as
+    the PUT /model response for that portfolio, in the order given;
+    a failing portfolio gets an error result without failing the others.
+
+    :param portfolios: Portfolios to optimize, each with "value" and "tickers"
+    :type portfolios: Dict[str, Any][]
+    :param factor_set: Factor set to estimate returns with, defaults to "default"
+    :type factor_set: str
+    """
+    from services.batch import optimize_batch
+    body = request.get_json()
+    specs = body["portfolios"]
+    factor_set = body.get("factor_set", "default")
+    error = factor_set_error(factor_set)
+    if error is not None:
+        return error
+
+    results = [None] * len(specs)
+    universes = {}
+    for i, spec in enumerate(specs):
+        if not isinstance(spec, dict) or spec.get("value") is None or not spec.get("tickers"):
+            results[i] = { "status": "ERROR", "error": "Each portfolio needs value and tickers." }
+            continue
+        tickers = parse_tickers(spec["tickers"])
+        if tickers is None:
+            results[i] = { "status": "ERROR", "error": "Duplicate tickers may not exist." }
+            continue
+        cached = result_cache.get(portfolio_key(tickers, factor_set=factor_set))
+        if cached is not None:
+            results[i] = cached.to_response(tickers, spec["value"])
+        else:
+            universes[i] = tickers
+
+    try:
+        solved = optimize_batch(get_returns_model(factor_set), list(universes.values()),
+                                BATCH_WORKERS)
+    except TickerException as e:
+        return jsonify({
+            "status": "ERROR",
+            "error": e.message
+            }), 400
+    for (i, tickers), result in zip(universes.items(), solved):
+        if isinstance(result, TickerException):
+            results[i] = { "status": "ERROR", "error": result.message }
+        elif isinstance(result, Exception):
+            results[i] = { "status": "ERROR", "error": optimization_error(result) }
+        else:
+            result_cache.put(portfolio_key(tickers, factor_set=factor_set), result)
+            results[i] = result.to_response(tickers, specs[i]["value"])
+
+    with metrics.timer("response.serialize"):
+        return jsonify({ "status": "OK", "results": results })
+
+
+@core_blueprint.post("jobs")
+@require_authentication
+@require_json_params(["value", "tickers"])
+def submit_job():
+    """ Starts optimizing a portfolio in the background.
+    Poll GET /jobs/<job_id> for the result.
+
+    :param value: The total value of the portfolio in USD
+    :type value: float
+    :param tickers: The tickers to create the portfolio over
+    :type tickers: str[]
+    :param factor_set: Factor set to estimate returns with, defaults to "default"
+    :type factor_set: str
+    """
+    body = request.get_json()
+    tickers = parse_tickers(body["tickers"])
+    factor_set = body.get("factor_set", "default")
+
+    if tickers is None:
+        return jsonify({
+            "status": "ERROR",
+            "error": "Duplicate tickers may not exist."
+            }), 400
+    error = factor_set_error(factor_set)
+    if error is not None:
+        return error
+
+    ticker_set, day, _ = portfolio_key(tickers, factor_set=factor_set)
+    task_key = f"{','.join(ticker_set)}@{day:%Y-%m-%d}/{factor_set}"
+    def compute():
+        from pypfopt.exceptions import OptimizationError
+        try:
+            return cached_optimize(tickers, factor_set)
+        except (ValueError, OptimizationError) as e:
+            raise JobError(optimization_error(e)) from e
+
+    job_id = job_queue.submit(task_key, compute, tickers=tickers, value=body["value"])
+    return jsonify({ "status": "OK", "job": job_id }), 202
+
+
+@core_blueprint.get("jobs/<job_id>")
+@require_authentication
+def get_job(job_id):
+    """ Returns a job's progress, PENDING or RUNNING, and once it is done,
+    the same response as PUT /model, in the same formats.
+
+    :param job_id: Id returned by POST /jobs
+    :type job_id: str
+    """
+    if negotiate(request) is None:
+        return format_error()
+
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({
+            "status": "ERROR",
+            "error": f"Job {job_id} does not exist or has expired."
+            }), 404
+
+    if job["status"] == DONE:
+        return portfolio_response(job["result"], job["tickers"], job["value"], job=job_id)
+    if job["status"] == ERROR:
+        return jsonify({ "status": "ERROR", "error": job["error"], "job": job_id }), 400
+    return jsonify({ "status": job["status"], "job": job_id }), 202
 
 
 @core_blueprint.route("jwt")
@@ -1,3 +1,12 @@
 """ Each file contains functions that completes an assignment requirement. """
 
-from .model import *
+from importlib import import_module
+from importlib.util import find_spec
+
+
+def __getattr__(name):
+    # Submodules import as usual, e.g. "from services import sql"
+    if find_spec(f"{__name__}.{name}") is not None:
+        return import_module(f".{name}", __name__)
+    # The model pulls in pandas, cvxpy and pypfopt, so it is only imported on first use
+    return getattr(import_module(".model", __name__), name)
@@ -0,0 +1,272 @@
+""" Walk-forward backtests of the max sharpe strategy.
+
+At every rebalance day the factors, betas and covariance are estimated from
+the two years of prices ending on that day, and the max sharpe portfolio is
+held until the next rebalance day. Each estimate only needs its own window,
+so windows are solved independently: contiguous runs of them are sliced out
+of one shared price panel and spread over a process pool. Within a run,
+consecutive windows slide the same covariance sums (see services.covariance).
+"""
+
+import numpy as np
+import pandas as pd
+from pypfopt.exceptions import OptimizationError
+from .sql import connection
+from .price_fetching import backfill_prices
+from .factors import factor_sets, m12_return_rate, TRADEDAYS_IN_YEAR, RISK_FREE_SYMBOL, \
+    MARKET_SYMBOL
+from .returns import Carhart4FactorModel, factors_from_prices
+from .covariance import CovarianceCache
+from .model import Model
+from .encoding import iso_series
+from .calendar import trading_days_before
+from .processes import process_executor
+
+# The 2 years of prices m12_return_rate needs for a year of 12-month rates
+ESTIMATION_DAYS = 2 * TRADEDAYS_IN_YEAR + 1
+FREQUENCIES = {"weekly": "W", "monthly": "M", "quarterly": "Q"}
+
+
+def load_panel(tickers, start, factor_set="default", end=None):
+    """ Loads every price a backtest from start needs, in one panel: the
+    tickers, the factor set's constituents and the market and risk-free
+    series, from ESTIMATION_DAYS trading days before start until end.
+
+    :param tickers: Tickers to backtest, all uppercase
+    :type tickers: str[]
+    :type start: pandas.Timestamp
+    :type factor_set: str
+    :param end: Last day, defaults to today
+    :type end: pandas.Timestamp | None
+
+    :return: Prices carried forward over days a symbol has no close
+    :rtype: pandas.DataFrame, indexed by pandas.Timestamp
+    """
+    constituents = [t for bucket in factor_sets()[factor_set].values() for t in bucket]
+    symbols = list(dict.fromkeys([*tickers, *constituents, MARKET_SYMBOL, RISK_FREE_SYMBOL]))
+    with connection() as con:
+        return backfill_prices(con, symbols, trading_days_before(start, ESTIMATION_DAYS),
+                               end=end).ffill()
+
+
+def rebalance_days(index, start, frequency="monthly"):
+    """ The last trading day of every period from start on that has a full
+    estimation window before it.
+
+    :param index: Trading days of the price panel
+    :type index: pandas.DatetimeIndex
+    :type start: pandas.Timestamp
+    :param frequency: One of FREQUENCIES
+    :type frequency: str
+
+    :return: Positions in index
+    :rtype: numpy.ndarray
+    """
+    positions = pd.Series(np.arange(len(index)), index=index)
+    positions = positions[(index >= start) & (positions >= ESTIMATION_DAYS - 1)]
+    periods = positions.index.to_period(FREQUENCIES[frequency])
+    return positions.groupby(periods).max().to_numpy()
+
+
+def estimate_weights(window, tickers, factor_set="default", covariances=None):
+    """ The max sharpe portfolio as of the last day of window.
+
+    :param window: ESTIMATION_DAYS of prices, see load_panel
+    :type window: pandas.DataFrame, indexed by pandas.Timestamp
+    :param tickers: Tickers to invest in
+    :type tickers: str[]
+    :type factor_set: str
+    :param covariances: Cache to slide covariance sums between windows
+    :type covariances: services.covariance.CovarianceCache | None
+
+    :return: Weights ordered like tickers, and how they were chosen:
+             "max_sharpe", "min_volatility" if no asset beat the risk-free
+             rate, or "cash" if fewer than 2 tickers have a full window
+    :rtype: Tuple[numpy.ndarray, str]
+    """
+    covariances = covariances or CovarianceCache(maxsize=1)
+    weights = np.zeros(len(tickers))
+    prices = window[tickers]
+    usable = [t for t, full in prices.notna().all().items() if full]
+    if len(usable) < 2:
+        return weights, "cash"
+
+    factors, risk_free, factor_returns = factors_from_prices(window, factor_set)
+    returns_model = Carhart4FactorModel(factors=factors, risk_free_rates=risk_free,
+                                        factor_returns=factor_returns)
+    prices = prices[usable]
+    returns = returns_model.fit(m12_return_rate(prices))["expected_return"]
+    inputs = (prices, returns, covariances.covariance(prices))
+    try:
+        model = Model(returns_model, usable, inputs)
+        chosen = model.max_sharpe(risk_free_rate=model.risk_free_rate)
+        method = "max_sharpe"
+    except (ValueError, OptimizationError):
+        chosen = Model(returns_model, usable, inputs).min_volatility()
+        method = "min_volatility"
+
+    positions = {t: i for i, t in enumerate(tickers)}
+    for t, w in chosen.items():
+        weights[positions[t]] = w
+    return weights, method
+
+
+def solve_windows(panel, ends, tickers, factor_set="default"):
+    """ Runs estimate_weights on consecutive windows of one panel.
+    Module level so process pools can run it.
+
+    :param panel: Prices covering every window
+    :type panel: pandas.DataFrame, indexed by pandas.Timestamp
+    :param ends: Position in panel of each window's last day, ascending
+    :type ends: numpy.ndarray
+
+    :rtype: List[Tuple[numpy.ndarray, str]]
+    """
+    covariances = CovarianceCache(maxsize=1)
+    return [estimate_weights(panel.iloc[end - ESTIMATION_DAYS + 1:end + 1], tickers,
+                             factor_set, covariances)
+            for end in ends]
+
+
+class BacktestResult:
+    """ Outcome of a walk-forward backtest
+
+    :param equity: Portfolio value on every trading day, starting at 1
+                   on the first rebalance day
+    :type equity: pandas.Series, indexed by pandas.Timestamp
+    :param weights: Target weights set on each rebalance day
+    :type weights: pandas.DataFrame, indexed by pandas.Timestamp
+    :param turnover: Fraction of the portfolio traded on each rebalance day,
+                     half the summed absolute change from the drifted weights.
+                     The initial allocation counts as 0.
+    :type turnover: pandas.Series, indexed by pandas.Timestamp
+    :param methods: How each rebalance's weights were chosen, see estimate_weights
+    :type methods: str[]
+    """
+    def __init__(self, equity, weights, turnover, methods):
+        self.equity = equity
+        self.weights = weights
+        self.turnover = turnover
+        self.methods = methods
+
+    def stats(self):
+        """ Summary of the equity curve
+
+        :return: "total_return", "annual_return", "annual_volatility",
+                 "sharpe" (without a risk-free rate), "max_drawdown"
+                 and "average_turnover"
+        :rtype: Dict[str, float]
+        """
+        daily = self.equity.pct_change().dropna().to_numpy()
+        years = len(daily) / TRADEDAYS_IN_YEAR
+        total = self.equity.iloc[-1] / self.equity.iloc[0]
+        annual_return = total ** (1 / years) - 1 if years else 0.0
+        volatility = daily.std() * np.sqrt(TRADEDAYS_IN_YEAR) if len(daily) > 1 else 0.0
+        drawdown = 1 - (self.equity / self.equity.cummax()).min()
+        return {
+            "total_return": float(total - 1),
+            "annual_return": float(annual_return),
+            "annual_volatility": float(volatility),
+            "sharpe": float(annual_return / volatility) if volatility else 0.0,
+            "max_drawdown": float(drawdown),
+            "average_turnover": float(self.turnover.iloc[1:].mean()) if len(self.turnover) > 1
+                                else 0.0
+            }
+
+    def to_response(self, tickers):
+        """ The /backtest response body
+
+        :param tickers: Tickers in the order they were requested
+        :type tickers: str[]
+
+        :rtype: Dict[str, Any]
+        """
+        rebalances = [{
+            "date": day.strftime("%Y-%m-%d"),
+            "weights": {t: float(w[t]) for t in tickers},
+            "turnover": float(self.turnover[day]),
+            "method": method
+            } for (day, w), method in zip(self.weights.iterrows(), self.methods)]
+        return {
+            "status": "OK",
+            "tickers": tickers,
+            **self.stats(),
+            "rebalances": rebalances,
+            "equity": iso_series(self.equity)
+            }
+
+
+def compound(prices, ends, weights):
+    """ Holds each rebalance's weights until the next rebalance day.
+    Weights that sum to less than 1 keep the rest in cash.
+
+    :param prices: Prices of the backtested tickers
+    :type prices: pandas.DataFrame, indexed by pandas.Timestamp
+    :param ends: Position in prices of each rebalance day, ascending
+    :type ends: numpy.ndarray
+    :param weights: Target weights of each rebalance, shape (len(ends), n)
+    :type weights: numpy.ndarray
+
+    :return: (equity from the first rebalance day on, turnover per rebalance)
+    :rtype: Tuple[numpy.ndarray, numpy.ndarray]
+    """
+    values = prices.to_numpy()
+    bounds = [*ends, len(values) - 1]
+    equity = [np.ones(1)]
+    turnover = np.zeros(len(ends))
+    drifted = weights[0]
+    for k, w in enumerate(weights):
+        turnover[k] = np.abs(w - drifted).sum() / 2 if k else 0.0
+        start, end = bounds[k], bounds[k + 1]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            growth = np.nan_to_num(values[start:end + 1] / values[start])
+        value = growth @ w + 1 - w.sum()
+        equity.append(equity[-1][-1] * value[1:])
+        drifted = w * growth[-1] / value[-1]
+    return np.concatenate(equity), turnover
+
+
+def backtest(tickers, start, frequency="monthly", factor_set="default", workers=0, panel=None):
+    """ Walk-forward backtest of the max sharpe portfolio over tickers.
+
+    :param tickers: Tickers to invest in, all uppercase
+    :type tickers: str[]
+    :param start: First day of the backtest
+    :type start: pandas.Timestamp
+    :param frequency: How often to rebalance, one of FREQUENCIES
+    :type frequency: str
+    :param factor_set: Factor set to estimate returns with
+    :type factor_set: str
+    :param workers: Processes to spread the windows over, 0 or 1 to solve them here
+    :type workers: int
+    :param panel: Prices from load_panel(), loaded if None
+    :type panel: pandas.DataFrame, indexed by pandas.Timestamp | None
+
+    :return: The result, or None if no rebalance day has a full estimation window
+    :rtype: BacktestResult | None
+    """
+    if panel is None:
+        panel = load_panel(tickers, start, factor_set)
+    ends = rebalance_days(panel.index, start, frequency)
+    if len(ends) == 0:
+        return None
+
+    runs = [run for run in np.array_split(ends, max(min(workers, len(ends)), 1)) if len(run)]
+    slices = [panel.iloc[run[0] - ESTIMATION_DAYS + 1:run[-1] + 1] for run in runs]
+    local_ends = [run - (run[0] - ESTIMATION_DAYS + 1) for run in runs]
+    if len(runs) > 1:
+        solved = process_executor("backtest", workers).map(
+            solve_windows, slices, local_ends, [tickers] * len(runs), [factor_set] * len(runs))
+    else:
+        solved = [solve_windows(slices[0], local_ends[0], tickers, factor_set)]
+    solved = [s for run in solved for s in run]
+
+    weights = np.array([w for w, _ in solved])
+    equity, turnover = compound(panel[tickers], ends, weights)
+    days = panel.index[ends]
+    return BacktestResult(
+        pd.Series(equity, index=panel.index[ends[0]:]),
+        pd.DataFrame(weights, index=days, columns=tickers),
+        pd.Series(turnover, index=days),
+        [m for _, m in solved]
+        )
@@ -0,0 +1,79 @@
+""" Optimizes many ticker universes at once, sharing the data loading between them. """
+
+from concurrent.futures import ThreadPoolExecutor
+import cvxpy as cp
+from pypfopt.exceptions import OptimizationError
+from .covariance import FactorCovariance
+from .errors import TickerException
+from .model import (Model, model_inputs, sub_inputs, estimate_covariance,
+                    use_factor_covariance)
+from .portfolio import PortfolioResult
+from .metrics import metrics
+
+
+def union_inputs(returns_model, tickers):
+    """ Runs model_inputs() over a union of tickers, dropping tickers
+    that have no price data instead of failing.
+
+    :raises TickerException: if a ticker outside tickers fails, such as a
+                             factor's constituent; dropping tickers can't fix that
+    :return: The inputs for every usable ticker, and each dropped ticker
+             mapped to the error it raised
+    :rtype: Tuple[Tuple[pandas.DataFrame, pandas.Series, pandas.DataFrame] | None,
+                  Dict[str, str]]
+    """
+    tickers = list(tickers)
+    failed = {}
+    while tickers:
+        try:
+            return model_inputs(returns_model, tickers), failed
+        except TickerException as e:
+            bad = set(e.ticker if isinstance(e.ticker, list) else [e.ticker]) & set(tickers)
+            if not bad:
+                raise
+            failed.update(dict.fromkeys(bad, e.message))
+            tickers = [t for t in tickers if t not in failed]
+    return None, failed
+
+
+def optimize_batch(returns_model, universes, workers=4):
+    """ Finds the max sharpe portfolio of every universe. Prices are fetched,
+    betas are fit and the covariance is computed once over the union of all
+    tickers; each universe uses its slice. A universe whose size picks the
+    other covariance mode than the union's gets its own, as PUT /model
+    would estimate it. The solves run in parallel.
+
+    :param returns_model: Calculates annualized return rates for assets
+    :type returns_model: services.returns.Carhart4FactorModel
+    :param universes: Ticker lists, all uppercase
+    :type universes: str[][]
+    :param workers: Max solves running at once
+    :type workers: int
+
+    :raises TickerException: if a ticker no universe holds fails
+    :return: For each universe, in order, its result or the error it raised
+    :rtype: List[PortfolioResult | TickerException | ValueError | OptimizationError
+                 | cvxpy.SolverError]
+    """
+    union = list(dict.fromkeys(t for tickers in universes for t in tickers))
+    inputs, failed = union_inputs(returns_model, union)
+
+    def solve(tickers):
+        bad = [t for t in tickers if t in failed]
+        if bad:
+            return TickerException(failed[bad[0]], bad[0])
+        try:
+            prices, returns, cov = sub_inputs(inputs, tickers)
+            factored = use_factor_covariance(len(tickers)) \
+                and returns_model.factor_returns is not None
+            if isinstance(cov, FactorCovariance) != factored:
+                cov = estimate_covariance(returns_model, prices)
+            model = Model(returns_model, tickers, (prices, returns, cov))
+            with metrics.timer("model.solver"):
+                portfolio = model.max_sharpe(risk_free_rate=model.risk_free_rate)
+        except (TickerException, ValueError, OptimizationError, cp.SolverError) as e:
+            return e
+        return PortfolioResult.from_model(model, portfolio)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(solve, universes))
@@ -0,0 +1,82 @@
+""" In-process cache for optimization results. """
+
+from threading import Lock
+from cachetools import TTLCache
+from .metrics import metrics
+
+
+def portfolio_key(tickers, day=None, factor_set="default"):
+    """ Cache key for a ticker universe: the sorted tickers plus the trading
+    day the prices are as of, so results expire when a new close lands,
+    and the factor set the returns were estimated with.
+
+    :param tickers: Tickers in the portfolio, all uppercase
+    :type tickers: str[]
+    :param day: Trading day, defaults to the last trading day
+    :type day: pandas.Timestamp | None
+    :param factor_set: Name of the factor set
+    :type factor_set: str
+
+    :rtype: Tuple[Tuple[str, ...], pandas.Timestamp, str]
+    """
+    from .calendar import last_trading_day # pylint: disable=import-outside-toplevel
+    return tuple(sorted(tickers)), last_trading_day() if day is None else day, factor_set
+
+
+class ResultCache:
+    """ Thread-safe LRU cache with a time-to-live and hit/miss counters
+
+    :param maxsize: Max number of results kept, least recently used are evicted first
+    :type maxsize: int
+    :param ttl: Seconds a result stays valid
+    :type ttl: float
+    :param name: Counters are reported as cache.<name>.hit and cache.<name>.miss
+    :type name: str
+    """
+    def __init__(self, maxsize, ttl, name="result"):
+        self.name = name
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """ Returns the cached value for key, or None on a miss. """
+        with self.lock:
+            value = self.cache.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        metrics.incr(f"cache.{self.name}.{'miss' if value is None else 'hit'}")
+        return value
+
+    def put(self, key, value):
+        """ Stores value under key. """
+        with self.lock:
+            self.cache[key] = value
+
+    def get_or_compute(self, key, compute):
+        """ Returns the cached value for key, calling compute() and caching
+        its result on a miss. Exceptions from compute() are not cached.
+
+        :type compute: Callable[[], Any]
+        """
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def stats(self):
+        """ Cache counters
+
+        :rtype: Dict[str, int]
+        """
+        with self.lock:
+            return {
+                "size": len(self.cache),
+                "maxsize": int(self.cache.maxsize),
+                "hits": self.hits,
+                "misses": self.misses
+                }
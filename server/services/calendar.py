@@ -0,0 +1,99 @@
+""" Trading day helpers.
+
+trading_days() is the NYSE calendar as one precomputed DatetimeIndex, so
+"n trading days before" and "the last trading day on or before" are binary
+searches instead of walks over calendar days.
+"""
+
+from functools import lru_cache
+import pandas as pd
+from pandas.tseries.holiday import AbstractHolidayCalendar, Holiday, GoodFriday, \
+    USMartinLutherKingJr, USPresidentsDay, USMemorialDay, USLaborDay, USThanksgivingDay, \
+    nearest_workday, sunday_to_monday
+
+TRADEDAYS_IN_YEAR = 252
+MARKET_TZ = "America/New_York"
+# Closes are settled a little after the 4pm bell
+MARKET_CLOSE = pd.Timedelta(hours=16, minutes=30)
+FIRST_DAY = pd.Timestamp("1980-01-01")
+
+
+class NYSEHolidayCalendar(AbstractHolidayCalendar):
+    """ Full-day NYSE closures. A Saturday New Year's Day is not made up on the Friday. """
+    rules = [
+        Holiday("New Year's Day", month=1, day=1, observance=sunday_to_monday),
+        USMartinLutherKingJr,
+        USPresidentsDay,
+        GoodFriday,
+        USMemorialDay,
+        Holiday("Juneteenth", month=6, day=19, start_date="2022-01-01",
+                observance=nearest_workday),
+        Holiday("Independence Day", month=7, day=4, observance=nearest_workday),
+        USLaborDay,
+        USThanksgivingDay,
+        Holiday("Christmas Day", month=12, day=25, observance=nearest_workday)
+        ]
+
+
+@lru_cache(maxsize=1)
+def trading_days():
+    """ Every trading day from FIRST_DAY until two years from now
+
+    :rtype: pandas.DatetimeIndex
+    """
+    last = pd.Timestamp.today().normalize() + pd.DateOffset(years=2)
+    holidays = NYSEHolidayCalendar().holidays(FIRST_DAY, last)
+    return pd.bdate_range(FIRST_DAY, last, freq="C", holidays=holidays)
+
+
+def trading_day_on_or_before(day):
+    """ The last trading day on or before a day
+
+    :type day: pandas.Timestamp
+    :rtype: pandas.Timestamp
+    """
+    days = trading_days()
+    return days[days.searchsorted(day.normalize(), side="right") - 1]
+
+
+def trading_window(end, num_days):
+    """ The last num_days trading days up to and including end
+
+    :param end: Last day, rolled back to a trading day
+    :type end: pandas.Timestamp
+    :type num_days: int
+    :rtype: pandas.DatetimeIndex
+    """
+    days = trading_days()
+    last = days.searchsorted(end.normalize(), side="right")
+    return days[max(last - num_days, 0):last]
+
+
+def trading_days_before(day, num_days):
+    """ The trading day num_days trading days before a day
+
+    :param day: Rolled back to a trading day first
+    :type day: pandas.Timestamp
+    :type num_days: int
+    :rtype: pandas.Timestamp
+    """
+    return trading_window(day, num_days + 1)[0]
+
+
+def last_trading_day(now=None):
+    """ Gives the most recent trading day whose close is available.
+    Before the close, that is the previous trading day.
+
+    :param now: Current time, defaults to now in the market's timezone
+    :type now: pandas.Timestamp | None
+
+    :return: Midnight of the trading day, timezone-naive
+    :rtype: pandas.Timestamp
+    """
+    now = pd.Timestamp.now(tz=MARKET_TZ) if now is None else now
+    if now.tzinfo is not None:
+        now = now.tz_convert(MARKET_TZ).tz_localize(None)
+    day = now.normalize()
+    if now - day < MARKET_CLOSE:
+        day -= pd.Timedelta(1, "d")
+    return trading_day_on_or_before(day)
@@ -0,0 +1,274 @@
+""" Incrementally maintained sample covariance over a sliding window of daily returns,
+and the factor-structured covariance used for large universes.
+
+For every pair of tickers (i, j) we keep, over the days both have data,
+the number of days, the sum of i's returns and the sum of i * j. Adding or
+dropping a day updates them in O(n²), and the pairwise sample covariance
+(the same one pandas.DataFrame.cov() gives) is assembled from them directly.
+"""
+
+from threading import Lock
+import cvxpy as cp
+import numpy as np
+import pandas as pd
+from cachetools import LRUCache
+from pypfopt.expected_returns import returns_from_prices
+from pypfopt.risk_models import fix_nonpositive_semidefinite
+from .returns import fit_lstsq
+from .calendar import TRADEDAYS_IN_YEAR
+
+
+class RollingCovariance:
+    """ Covariance statistics of one ticker universe over a window of days
+
+    :param returns: Daily returns, one column per ticker, NaN where missing
+    :type returns: pandas.DataFrame, indexed by pandas.Timestamp
+    :param rebuild_every: Recompute the sums from scratch after this many
+                          updates, to stop rounding errors building up
+    :type rebuild_every: int
+    """
+    def __init__(self, returns, rebuild_every=250):
+        self.tickers = list(returns.columns)
+        self.positions = {t: i for i, t in enumerate(self.tickers)}
+        self.rebuild_every = rebuild_every
+        self.rebuild(returns.index, returns.to_numpy(dtype=float))
+
+    def rebuild(self, days, values):
+        """ Recomputes every sum from the window's returns.
+
+        :type days: pandas.DatetimeIndex
+        :type values: numpy.ndarray
+        """
+        self.days = list(days)
+        self.rows = list(values)
+        has_data = (~np.isnan(values)).astype(float)
+        filled = np.nan_to_num(values)
+        self.count = has_data.T @ has_data
+        self.sums = filled.T @ has_data
+        self.cross = filled.T @ filled
+        self.updates = 0
+
+    def _update(self, row, sign):
+        has_data = (~np.isnan(row)).astype(float)
+        filled = np.nan_to_num(row)
+        self.count += sign * np.outer(has_data, has_data)
+        self.sums += sign * np.outer(filled, has_data)
+        self.cross += sign * np.outer(filled, filled)
+        self.updates += 1
+
+    def add_day(self, day, row):
+        """ Appends a day of returns to the end of the window.
+
+        :type day: pandas.Timestamp
+        :param row: Returns ordered like self.tickers
+        :type row: numpy.ndarray
+        """
+        self.days.append(day)
+        self.rows.append(row)
+        self._update(row, 1)
+
+    def drop_day(self):
+        """ Removes the oldest day from the window. """
+        self.days.pop(0)
+        self._update(self.rows.pop(0), -1)
+
+    def sync(self, returns):
+        """ Slides the window to match returns, which must have the same
+        tickers. Days before its first day are dropped, days after the
+        window's last day are added and days whose returns changed, such as
+        after a late or corrected close, are replaced; any other difference
+        rebuilds the sums.
+
+        :type returns: pandas.DataFrame, indexed by pandas.Timestamp
+        """
+        index = returns.index
+        values = returns[self.tickers].to_numpy(dtype=float)
+        if not self.days or not len(index) or index[0] not in self.days \
+                or self.days[-1] not in index:
+            self.rebuild(index, values)
+            return
+
+        while self.days[0] < index[0]:
+            self.drop_day()
+        kept = len(self.days)
+        if not index[:kept].equals(pd.DatetimeIndex(self.days)):
+            self.rebuild(index, values)
+            return
+
+        old, new = np.array(self.rows), values[:kept]
+        changed = (old != new) & ~(np.isnan(old) & np.isnan(new))
+        for k in np.flatnonzero(changed.any(axis=1)):
+            self._update(self.rows[k], -1)
+            self.rows[k] = new[k]
+            self._update(new[k], 1)
+        for i in range(kept, len(index)):
+            self.add_day(index[i], values[i])
+
+        if self.updates >= self.rebuild_every:
+            self.rebuild(index, values)
+
+    def covariance(self, tickers=None, frequency=TRADEDAYS_IN_YEAR):
+        """ Annualized pairwise sample covariance of some of the tickers.
+
+        :param tickers: Tickers to include, defaults to all of them
+        :type tickers: str[] | None
+        :param frequency: Periods per year
+        :type frequency: int
+
+        :rtype: pandas.DataFrame
+        """
+        tickers = self.tickers if tickers is None else list(tickers)
+        pos = [self.positions[t] for t in tickers]
+        block = np.ix_(pos, pos)
+        count = self.count[block]
+        sums = self.sums[block]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cov = (self.cross[block] - sums * sums.T / count) / (count - 1)
+        cov[count < 2] = np.nan
+        return pd.DataFrame(cov * frequency, index=tickers, columns=tickers)
+
+
+class CovarianceCache:
+    """ Keeps a RollingCovariance per ticker universe, least recently used evicted first
+
+    :param maxsize: Max number of universes kept
+    :type maxsize: int
+    """
+    def __init__(self, maxsize=64):
+        self.stats = LRUCache(maxsize=maxsize)
+        self.lock = Lock()
+
+    def covariance(self, prices):
+        """ Annualized sample covariance of daily returns, repaired to be
+        positive semidefinite only when it isn't. Same result as
+        pypfopt.risk_models.risk_matrix(prices), but only the days that
+        changed since the universe was last seen are processed.
+
+        A universe that is a subset of a cached one, with the same window,
+        is sliced out of that one.
+
+        :param prices: Prices, one column per ticker
+        :type prices: pandas.DataFrame, indexed by pandas.Timestamp
+
+        :rtype: pandas.DataFrame
+        """
+        returns = returns_from_prices(prices)
+        tickers = list(prices.columns)
+        key = tuple(sorted(tickers))
+        with self.lock:
+            stats = self.stats.get(key) or self._superset(key, returns)
+            if stats is None:
+                stats = RollingCovariance(returns[list(key)])
+                self.stats[key] = stats
+            elif tuple(sorted(stats.tickers)) == key:
+                stats.sync(returns)
+            cov = stats.covariance(tickers)
+        return fix_nonpositive_semidefinite(cov)
+
+    def _superset(self, key, returns):
+        """ A cached universe containing every ticker in key, with exactly
+        this window and the same returns for those tickers. """
+        days = returns.index
+        for stats in self.stats.values():
+            if set(key) <= set(stats.positions) and len(stats.days) == len(days) \
+                    and stats.days[0] == days[0] and stats.days[-1] == days[-1]:
+                cached = np.array(stats.rows)[:, [stats.positions[t] for t in key]]
+                if np.array_equal(cached, returns[list(key)].to_numpy(dtype=float),
+                                  equal_nan=True):
+                    return stats
+        return None
+
+
+class FactorCovariance:
+    """ Covariance with the factor structure B·F·Bᵀ + D, kept in factored form:
+    n×k loadings, a k×k factor covariance and n residual variances. Memory
+    and every product with weights are O(n·k) instead of O(n²).
+
+    :param tickers: Ticker of each row of loadings
+    :type tickers: str[]
+    :param loadings: Each ticker's betas on the factors, shape (n, k)
+    :type loadings: numpy.ndarray
+    :param factor_cov: Annualized factor covariance, shape (k, k)
+    :type factor_cov: numpy.ndarray
+    :param specific: Annualized residual variance of each ticker, shape (n,)
+    :type specific: numpy.ndarray
+    """
+    def __init__(self, tickers, loadings, factor_cov, specific):
+        self.tickers = list(tickers)
+        self.loadings = loadings
+        self.factor_cov = factor_cov
+        self.specific = specific
+        q, v = np.linalg.eigh(factor_cov)
+        self.factor_root = v * np.sqrt(np.clip(q, 0, None)) # root @ root.T == factor_cov
+
+    @classmethod
+    def estimate(cls, prices, factor_returns, frequency=TRADEDAYS_IN_YEAR):
+        """ Regresses each ticker's daily returns on the daily factor returns.
+
+        :param prices: Prices, one column per ticker
+        :type prices: pandas.DataFrame, indexed by pandas.Timestamp
+        :param factor_returns: Daily factor returns,
+                               see services.factors.FactorModel.daily_returns
+        :type factor_returns: pandas.DataFrame, indexed by pandas.Timestamp
+        :param frequency: Periods per year
+        :type frequency: int
+
+        :rtype: FactorCovariance
+        """
+        returns = returns_from_prices(prices)
+        days = returns.index.intersection(factor_returns.index)
+        factors = factor_returns.loc[days].to_numpy(dtype=float)
+        asset_returns = returns.loc[days].to_numpy(dtype=float)
+
+        # The intercept soaks up each ticker's mean return and is then dropped
+        design = np.column_stack([np.ones(len(days)), factors])
+        betas, residual_var, _, _ = fit_lstsq(design, asset_returns)
+        # Tickers with too little data to fit are treated as pure residual risk
+        unfit = np.isnan(residual_var)
+        loadings = np.nan_to_num(betas[:, 1:])
+        residual_var[unfit] = np.nanvar(asset_returns[:, unfit], axis=0, ddof=1)
+        return cls(prices.columns, loadings, np.cov(factors, rowvar=False) * frequency,
+                   residual_var * frequency)
+
+    def subset(self, tickers):
+        """ The covariance of some of the tickers
+
+        :type tickers: str[]
+        :rtype: FactorCovariance
+        """
+        rows = [self.tickers.index(t) for t in tickers]
+        return FactorCovariance(tickers, self.loadings[rows], self.factor_cov,
+                                self.specific[rows])
+
+    def variance(self, weights):
+        """ Portfolio variance, wᵀ(B·F·Bᵀ + D)w, without forming the n×n matrix
+
+        :param weights: Shape (n,), or (m, n) for m portfolios
+        :type weights: numpy.ndarray
+
+        :rtype: float | numpy.ndarray
+        """
+        exposure = weights @ self.loadings @ self.factor_root
+        return (exposure ** 2).sum(axis=-1) + (weights ** 2) @ self.specific
+
+    def risk_vector(self, weights):
+        """ A cvxpy expression whose 2-norm is the portfolio volatility
+
+        :param weights: Portfolio weights
+        :type weights: cvxpy.Expression
+
+        :rtype: cvxpy.Expression
+        """
+        return cp.hstack([self.factor_root.T @ (self.loadings.T @ weights),
+                          cp.multiply(np.sqrt(self.specific), weights)])
+
+    def to_frame(self):
+        """ The dense covariance matrix, for display and small universes
+
+        :rtype: pandas.DataFrame
+        """
+        cov = self.loadings @ self.factor_cov @ self.loadings.T + np.diag(self.specific)
+        return pd.DataFrame(cov, index=self.tickers, columns=self.tickers)
+
+
+covariance_cache = CovarianceCache()
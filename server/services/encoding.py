@@ -0,0 +1,101 @@
+""" Response encodings for time series.
+
+The default JSON keys every point by an ISO-8601 string. The compact
+formats send a series as parallel arrays instead: "t" (epoch seconds)
+and "value" (floats). They are chosen with ?format= or the Accept header.
+
+- columnar: JSON with parallel arrays
+- msgpack: the columnar payload as MessagePack
+- arrow: the series as an Arrow IPC stream with columns t and value; every
+  other response field is JSON in the schema metadata under "response"
+"""
+
+import json
+
+JSON = "json"
+COLUMNAR = "columnar"
+MSGPACK = "msgpack"
+ARROW = "arrow"
+
+MIMETYPES = {
+    JSON: "application/json",
+    COLUMNAR: "application/json",
+    MSGPACK: "application/msgpack",
+    ARROW: "application/vnd.apache.arrow.stream"
+    }
+
+ACCEPT_FORMATS = {
+    "application/msgpack": MSGPACK,
+    "application/x-msgpack": MSGPACK,
+    "application/vnd.apache.arrow.stream": ARROW
+    }
+
+
+def negotiate(request):
+    """ Picks the response format for a request. ?format= wins over Accept.
+
+    :type request: flask.Request
+
+    :return: One of the formats, or None if ?format= names an unknown one
+    :rtype: str | None
+    """
+    fmt = request.args.get("format")
+    if fmt is not None:
+        return fmt if fmt in MIMETYPES else None
+    for mimetype, _ in request.accept_mimetypes:
+        if mimetype in ACCEPT_FORMATS:
+            return ACCEPT_FORMATS[mimetype]
+    return JSON
+
+
+def iso_series(series):
+    """ A series as {ISO-8601 timestamp: value}, the default JSON encoding.
+
+    :type series: pandas.Series, indexed by pandas.Timestamp
+    :rtype: Dict[str, float]
+    """
+    return dict(zip(series.index.strftime("%Y-%m-%dT%H:%M:%SZ"), series.to_numpy().tolist()))
+
+
+def columnar_series(series):
+    """ A series as parallel epoch-second and value arrays.
+
+    :type series: pandas.Series, indexed by pandas.Timestamp
+    :rtype: Dict[str, list]
+    """
+    return {
+        "t": series.index.as_unit("s").asi8.tolist(),
+        "value": series.to_numpy(dtype=float).tolist()
+        }
+
+
+def encode(payload, fmt, series=None):
+    """ Serializes a response body.
+
+    :param payload: Response fields. For the columnar formats, series
+                    fields should already be columnar_series()
+    :type payload: Dict[str, Any]
+    :param fmt: Response format
+    :type fmt: str
+    :param series: For ARROW, the field holding the series to send as the table
+    :type series: str | None
+
+    :return: Body and mimetype
+    :rtype: Tuple[bytes | str, str]
+    """
+    if fmt == MSGPACK:
+        import msgpack # pylint: disable=import-outside-toplevel
+        return msgpack.packb(payload), MIMETYPES[fmt]
+    if fmt == ARROW:
+        import pyarrow as pa # pylint: disable=import-outside-toplevel
+        columns = payload[series]
+        rest = {k: v for k, v in payload.items() if k != series}
+        table = pa.table({
+            "t": pa.array(columns["t"], type=pa.timestamp("s")),
+            "value": pa.array(columns["value"], type=pa.float64())
+            }).replace_schema_metadata({"response": json.dumps(rest)})
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes(), MIMETYPES[fmt]
+    return json.dumps(payload), MIMETYPES[fmt]
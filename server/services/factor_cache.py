@@ -0,0 +1,151 @@
+""" On-disk factor snapshots, built once per trading day and shared by every worker.
+
+A snapshot is a directory <factor set>/<trading day> holding
+values.npy (factors and risk-free rate as float64 columns), index.npy
+(datetime64 row index) and columns.json, and the same three files prefixed
+with returns_ for the daily factor returns. Workers memory-map the arrays.
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+import config
+from .calendar import last_trading_day
+
+RISK_FREE_COLUMN = "Risk Free Rate"
+
+
+def snapshot_path(day, factor_set="default"):
+    """ Directory of the snapshot for a trading day.
+
+    :type day: pandas.Timestamp
+    :param factor_set: Name of the factor set the snapshot was built from
+    :type factor_set: str
+    :rtype: str
+    """
+    return os.path.join(config.FACTOR_CACHE_DIR, factor_set, day.strftime("%Y-%m-%d"))
+
+
+def save_frame(directory, frame, prefix=""):
+    """ Writes a float DataFrame as <prefix>values.npy, index.npy and columns.json
+
+    :type directory: str
+    :type frame: pandas.DataFrame, indexed by pandas.Timestamp
+    :type prefix: str
+    """
+    np.save(os.path.join(directory, f"{prefix}values.npy"), frame.to_numpy(dtype=float))
+    np.save(os.path.join(directory, f"{prefix}index.npy"),
+            frame.index.to_numpy(dtype="datetime64[ns]"))
+    with open(os.path.join(directory, f"{prefix}columns.json"), "w", encoding="utf-8") as f:
+        json.dump(list(frame.columns), f)
+
+
+def load_frame(directory, prefix=""):
+    """ Memory-maps a DataFrame written by save_frame
+
+    :type directory: str
+    :type prefix: str
+    :rtype: pandas.DataFrame, indexed by pandas.Timestamp
+    """
+    values = np.load(os.path.join(directory, f"{prefix}values.npy"), mmap_mode="r")
+    index = pd.DatetimeIndex(np.load(os.path.join(directory, f"{prefix}index.npy")))
+    with open(os.path.join(directory, f"{prefix}columns.json"), encoding="utf-8") as f:
+        columns = json.load(f)
+    return pd.DataFrame(values, index=index, columns=columns, copy=False)
+
+
+def save_snapshot(day, factors, risk_free_rates, factor_returns, factor_set="default"):
+    """ Writes a snapshot atomically, by renaming a finished temp directory.
+
+    :param day: Trading day the snapshot is valid for
+    :type day: pandas.Timestamp
+    :param factors: One column per factor
+    :type factors: pandas.DataFrame, indexed by pandas.Timestamp
+    :param risk_free_rates: Risk-free rates for the same days
+    :type risk_free_rates: pandas.Series, indexed by pandas.Timestamp
+    :param factor_returns: Daily factor returns
+    :type factor_returns: pandas.DataFrame, indexed by pandas.Timestamp
+    :type factor_set: str
+    """
+    frame = pd.concat([factors, risk_free_rates.rename(RISK_FREE_COLUMN)], axis=1)
+    path = snapshot_path(day, factor_set)
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(path))
+    save_frame(tmp, frame)
+    save_frame(tmp, factor_returns, "returns_")
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+
+
+def load_snapshot(day, factor_set="default"):
+    """ Memory-maps the snapshot for a trading day.
+
+    :type day: pandas.Timestamp
+    :type factor_set: str
+
+    :return: (factors, risk-free rates, daily factor returns),
+             or None if there is no snapshot
+    :rtype: Tuple[pandas.DataFrame, pandas.Series, pandas.DataFrame] | None
+    """
+    path = snapshot_path(day, factor_set)
+    # Snapshots written before factor returns were stored are rebuilt
+    if not os.path.exists(os.path.join(path, "returns_values.npy")):
+        return None
+    frame = load_frame(path)
+    return (frame.drop(columns=RISK_FREE_COLUMN), frame[RISK_FREE_COLUMN].dropna(),
+            load_frame(path, "returns_"))
+
+
+def get_snapshot(build, day=None, factor_set="default", keep=3):
+    """ Returns the factor snapshot for a trading day, building it if needed.
+    Only one process builds a snapshot; the others wait on a file lock
+    and then load what it wrote.
+
+    :param build: Computes (factors, risk-free rates, daily factor returns) from scratch
+    :type build: Callable[[], Tuple[pandas.DataFrame, pandas.Series, pandas.DataFrame]]
+    :param day: Trading day, defaults to the last trading day
+    :type day: pandas.Timestamp | None
+    :param factor_set: Name of the factor set build() uses
+    :type factor_set: str
+    :param keep: Number of most recent snapshots to keep on disk
+    :type keep: int
+
+    :rtype: Tuple[pandas.DataFrame, pandas.Series, pandas.DataFrame]
+    """
+    day = last_trading_day() if day is None else day
+    snapshot = load_snapshot(day, factor_set)
+    if snapshot is not None:
+        return snapshot
+
+    directory = os.path.dirname(snapshot_path(day, factor_set))
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, ".lock"), "w", encoding="utf-8") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            snapshot = load_snapshot(day, factor_set)
+            if snapshot is None:
+                save_snapshot(day, *build(), factor_set)
+                prune_snapshots(directory, keep)
+                snapshot = load_snapshot(day, factor_set)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return snapshot
+
+
+def prune_snapshots(directory, keep):
+    """ Deletes all but the most recent snapshots of a factor set.
+
+    :param directory: The factor set's snapshot directory
+    :type directory: str
+    :param keep: Number of snapshots to keep
+    :type keep: int
+    """
+    days = sorted(d for d in os.listdir(directory)
+                  if os.path.isdir(os.path.join(directory, d)) and not d.startswith("tmp"))
+    for d in days[:-keep]:
+        shutil.rmtree(os.path.join(directory, d), ignore_errors=True)
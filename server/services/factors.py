@@ -1,43 +1,104 @@
 """ Retrieves the factors used in the Carhart 4-factor model """
 
-from contextlib import closing
-import yfinance as yf
-from .sql import get_connection
+import json
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+import config
+from .sql import connection
 from .price_fetching import fetch_prices
+from .providers import get_provider
+from .calendar import trading_window, TRADEDAYS_IN_YEAR
+
+RISK_FREE_SYMBOL = "^IRX" # 13-week treasury bill rate, in percent
+MARKET_SYMBOL = "^GSPC" # S&P 500
+
+# Each factor set maps the six Carhart buckets to their constituents
+DEFAULT_FACTOR_SETS = {
+    "default": {
+        "small_value": ["EVRI", "AVD", "HDSN"],
+        "small_growth": ["ACMR", "LRN", "DGII"],
+        "big_value": ["NKE", "PFE", "UPS", "USB"],
+        "big_growth": ["AMZN", "CRM"],
+        "winners": ["NVDA", "COHR", "APP", "MSTR"],
+        "losers": ["NFE", "NYCB"]
+        }
+    }
+
+# Buckets built from other buckets, used by hml()
+COMBINED_BUCKETS = {
+    "value": ["small_value", "big_value"],
+    "growth": ["small_growth", "big_growth"]
+    }
+
+
+@lru_cache(maxsize=1)
+def factor_sets():
+    """ The named factor sets: DEFAULT_FACTOR_SETS plus any loaded from the
+    JSON file at config.FACTOR_SETS_PATH, which has the same layout.
+
+    :rtype: Dict[str, Dict[str, str[]]]
+    """
+    sets = dict(DEFAULT_FACTOR_SETS)
+    if config.FACTOR_SETS_PATH:
+        with open(config.FACTOR_SETS_PATH, encoding="utf-8") as f:
+            sets.update(json.load(f))
+    return sets
 
-TRADEDAYS_IN_YEAR = 252
 
 class FactorModel():
-    """ Produces the factors used in the Carhart 4-factor model """
-    def __init__(self, tickers=None):
-        with closing(get_connection()) as con:
-            if tickers:
-                self.tickers = tickers
-            else:
-                self.tickers = {
-                        "small_value": ["EVRI", "AVD", "HDSN"],
-                        "small_growth": ["ACMR", "LRN", "DGII"],
-                        "big_value": ["NKE", "PFE", "UPS", "USB"],
-                        "big_growth": ["AMZN", "CRM"],
-                        "winners": ["NVDA", "COHR", "APP", "MSTR"],
-                        "losers": ["NFE", "NYCB"]
-                        }
-            prices = {k: fetch_prices(con, v).dropna(axis=1) for k, v in self.tickers.items()}
+    """ Produces the factors used in the Carhart 4-factor model
+
+    :param tickers: Constituents of each bucket, overrides factor_set
+    :type tickers: Dict[str, str[]] | None
+    :param factor_set: Name of one of factor_sets()
+    :type factor_set: str
+    :param prices: 2 years of prices of every constituent, fetched if None
+    :type prices: pandas.DataFrame, indexed by pandas.Timestamp | None
+    """
+    def __init__(self, tickers=None, factor_set="default", prices=None):
+        self.tickers = tickers if tickers else factor_sets()[factor_set]
+        universe = list(dict.fromkeys(t for v in self.tickers.values() for t in v))
+        if prices is None:
+            with connection() as con:
+                prices = fetch_prices(con, universe)
+        prices = prices[universe].dropna(axis=1)
+
+        # Which tickers make up each bucket, so every bucket is summed in one product
+        buckets = {**self.tickers, **{
+            k: [t for b in v for t in self.tickers[b]] for k, v in COMBINED_BUCKETS.items()
+            }}
+        membership = np.array([[t in v for v in buckets.values()] for t in prices.columns],
+                              dtype=float)
 
         # Price history aggregated for the entire "category"
-        self.prices_agg = {k: v.sum(axis=1) for k, v in prices.items()}
-        self.rates_agg = {k: m12_return_rate(v) for k, v in self.prices_agg.items()}
+        self.prices_agg = pd.DataFrame(prices.to_numpy() @ membership,
+                                       index=prices.index, columns=list(buckets))
+        self.rates_agg = m12_return_rate(self.prices_agg)
+
+        self._smb = self.rates_agg["small_value"] - self.rates_agg["big_value"]
+        self._smb.name = "SMB"
+        self._hml = self.rates_agg["value"] - self.rates_agg["growth"]
+        self._hml.name = "HML"
+        self._umd = self.rates_agg["winners"] - self.rates_agg["losers"]
+        self._umd.name = "UMD"
 
     @staticmethod
-    def mkt_premium():
+    def mkt_premium(risk_free=None, market=None):
         """ Gives the market risk premium for every day
         over the last 12 months.
         Calculated by total market (S&P 500) 12-month returns
         minus the risk-free rate (13-wk treasury bills)
 
+        :param risk_free: Already fetched risk_free_rates(), fetched if None
+        :type risk_free: pandas.Series, indexed by pandas.Timestamp
+        :param market: Already fetched market_prices(), fetched if None
+        :type market: pandas.Series, indexed by pandas.Timestamp
+
         :rtype: pandas.Series, indexed by pandas.Timestamp
         """
-        mkt_prem = market_rates() - risk_free_rates()
+        risk_free = risk_free_rates() if risk_free is None else risk_free
+        mkt_prem = market_rates(market) - risk_free
         mkt_prem.name = "Mkt. Premium"
         return mkt_prem
 
@@ -49,9 +110,7 @@ class FactorModel():
 
         :rtype: pandas.Series, indexed by pandas.Timestamp
         """
-        smb_advantage = self.rates_agg["small_value"] - self.rates_agg["big_value"]
-        smb_advantage.name = "SMB"
-        return smb_advantage
+        return self._smb
 
     def hml(self):
         """ Gives the "high minus low" advantage for every day
@@ -61,13 +120,7 @@ class FactorModel():
 
         :rtype: pandas.Series, indexed by pandas.Timestamp
         """
-        value_prices = self.prices_agg["big_value"] + self.prices_agg["small_value"]
-        growth_prices = self.prices_agg["big_growth"] + self.prices_agg["small_growth"]
-        value_rates = m12_return_rate(value_prices)
-        growth_rates = m12_return_rate(growth_prices)
-        hml_advantage = value_rates - growth_rates
-        hml_advantage.name = "HML"
-        return hml_advantage
+        return self._hml
 
     def umd(self):
         """ Gives the "up minus down" advantage for every day
@@ -75,9 +128,28 @@ class FactorModel():
         Advantage is calculated by the winners' 12-month rate
         subtracted by the losers' 12-month rate
         """
-        umd_advantage = self.rates_agg["winners"] - self.rates_agg["losers"]
-        umd_advantage.name = "UMD"
-        return umd_advantage
+        return self._umd
+
+    def daily_returns(self, market):
+        """ Daily returns of the four factors, for factor risk models
+        (see services.covariance.FactorCovariance). The market factor is the
+        market's plain return: the risk-free rate barely moves day to day,
+        so subtracting it wouldn't change any covariance.
+        SMB, HML and UMD are the daily returns of their long-short portfolios.
+
+        :param market: Daily closes of the market, see market_prices()
+        :type market: pandas.Series, indexed by pandas.Timestamp
+
+        :return: Columns named like the factors, over the days all have data
+        :rtype: pandas.DataFrame, indexed by pandas.Timestamp
+        """
+        buckets = self.prices_agg.pct_change()
+        return pd.DataFrame({
+            "Mkt. Premium": market.pct_change(),
+            "SMB": buckets["small_value"] - buckets["big_value"],
+            "HML": buckets["value"] - buckets["growth"],
+            "UMD": buckets["winners"] - buckets["losers"]
+            }).dropna()
 
 
 def risk_free_rates():
@@ -86,43 +158,49 @@ def risk_free_rates():
 
     :rtype: pandas.Series, indexed by pandas.Timestamp
     """
-    irx = yf.Ticker("^IRX").history(period="1y")["Close"].tz_localize(None)
+    irx = get_provider().history(RISK_FREE_SYMBOL, period="1y")
     irx.name = "Risk Free Rate"
     irx = irx.map(lambda x: 1 + x / 100)
     return irx
 
 
-def market_rates():
+def market_prices():
+    """ Returns the S&P 500's daily closes over the last 2 years.
+
+    :rtype: pandas.Series, indexed by pandas.Timestamp
+    """
+    return get_provider().history(MARKET_SYMBOL, period="2y")
+
+
+def market_rates(market=None):
     """ Returns the 12-month S&P return rate for every day
     over the last 12 months.
 
+    :param market: Already fetched market_prices(), fetched if None
+    :type market: pandas.Series, indexed by pandas.Timestamp
+
     :rtype: pandas.Series, indexed by pandas.Timestamp
     """
-    snp = yf.Ticker("^GSPC").history(period="2y")["Close"].tz_localize(None)
+    snp = market_prices() if market is None else market
     market_returns = m12_return_rate(snp)
     market_returns.name = "Market Returns"
     return market_returns
 
 
 def m12_return_rate(prices):
-    """ Takes a 2yr series of returns, and gives the 12-month
-    change (return rate) for every day in the last year.
+    """ Takes 2 years of prices, and gives the 12-month change (return rate)
+    for each of the last TRADEDAYS_IN_YEAR + 1 trading days up to the last
+    price. Prices are aligned by date on the trading calendar: each day is
+    divided by the close TRADEDAYS_IN_YEAR trading days before it, and
+    trading days without a row take the last close before them.
 
     :param prices: Asset prices over the past 2 years.
-    :type prices: pandas.Series, indexed by pandas.Timestamp
+    :type prices: pandas.Series | pandas.DataFrame, indexed by pandas.Timestamp
 
     :return: The annualized asset return rate for every day of the last year.
              Contains data for 253 trading days.
-    :rtype: pandas.Series, indexed by pandas.Timestamp
+    :rtype: pandas.Series | pandas.DataFrame, indexed by pandas.Timestamp
     """
-    num_days = TRADEDAYS_IN_YEAR
-    last_year = prices.head(num_days + 1)
-    this_year = prices.tail(num_days + 1)
-
-    date_indices = this_year.index
-    last_year.index = list(range(num_days + 1))
-    this_year.index = list(range(num_days + 1))
-
-    rates = this_year / last_year
-    rates.index = date_indices
-    return rates
+    days = trading_window(prices.index[-1], 2 * TRADEDAYS_IN_YEAR + 1)
+    aligned = prices.reindex(days, method="ffill")
+    return aligned.iloc[TRADEDAYS_IN_YEAR:] / aligned.iloc[:TRADEDAYS_IN_YEAR + 1].to_numpy()
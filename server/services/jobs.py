@@ -0,0 +1,136 @@
+""" Background optimization jobs.
+
+Job and task records live in a diskcache directory so any worker process
+can answer a poll, while the computation runs on a bounded thread pool in
+the process that accepted it. Jobs for the same task key share one
+computation. Unfinished tasks record the pid of the process running them,
+so a task whose process died, e.g. a recycled uWSGI worker, counts as
+failed and is started again by the next submit.
+"""
+
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from diskcache import Cache
+from .errors import TickerException
+from .metrics import pid_alive
+
+PENDING = "PENDING"
+RUNNING = "RUNNING"
+DONE = "DONE"
+ERROR = "ERROR"
+
+
+class JobError(Exception):
+    """ A failure whose message is shown to the job's pollers as is """
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+class JobQueue:
+    """ Deduplicating job queue shared by all worker processes
+
+    :param directory: Where job records are stored
+    :type directory: str
+    :param workers: Max jobs running at once in each process
+    :type workers: int
+    :param ttl: Seconds job records and finished results are kept
+    :type ttl: float
+    """
+    def __init__(self, directory, workers, ttl):
+        self.directory = directory
+        self.workers = workers
+        self.ttl = ttl
+        self._pid = None
+        self._store = None
+        self._executor = None
+        self._tasks = set()
+        self._lock = threading.Lock()
+
+    def _open(self):
+        """ Opens the store and pool for this process; forked workers get their own. """
+        if self._pid != os.getpid():
+            self._store = Cache(self.directory)
+            self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                thread_name_prefix="model-job")
+            self._tasks = set()
+            self._pid = os.getpid()
+
+    def _abandoned(self, task, record):
+        """ Whether an unfinished task's process is gone. A task claiming this
+        process that it isn't running belonged to an earlier process with the
+        same pid. """
+        if record.get("status") not in (PENDING, RUNNING) or "pid" not in record:
+            return False
+        if record["pid"] == os.getpid():
+            with self._lock:
+                return task not in self._tasks
+        return not pid_alive(record["pid"])
+
+    def submit(self, task_key, compute, **info):
+        """ Creates a job. Starts compute() in the background unless a job with
+        the same task key is already pending, running or done.
+
+        :param task_key: Identifies the computation, e.g. a normalized ticker set
+        :type task_key: str
+        :param compute: Produces the job result, may raise TickerException
+                        or JobError
+        :type compute: Callable[[], Any]
+        :param info: Extra fields stored with the job, e.g. the portfolio value
+
+        :return: The new job's id
+        :rtype: str
+        """
+        self._open()
+        job_id = uuid.uuid4().hex
+        self._store.set(f"job:{job_id}", {**info, "task": task_key}, expire=self.ttl)
+
+        task = f"task:{task_key}"
+        pending = {"status": PENDING, "pid": os.getpid()}
+        with self._store.transact():
+            record = self._store.get(task)
+            if record is not None and record.get("status") != ERROR \
+                    and not self._abandoned(task, record):
+                return job_id
+            with self._lock:
+                self._tasks.add(task)
+            self._store.set(task, pending, expire=self.ttl)
+        self._executor.submit(self._run, task, compute)
+        return job_id
+
+    def _run(self, task, compute):
+        self._store.set(task, {"status": RUNNING, "pid": os.getpid()}, expire=self.ttl)
+        try:
+            record = {"status": DONE, "result": compute()}
+        except (TickerException, JobError) as e:
+            record = {"status": ERROR, "error": e.message}
+        except Exception: # pylint: disable=broad-exception-caught
+            record = {"status": ERROR, "error": "Portfolio optimization failed."}
+        self._store.set(task, record, expire=self.ttl)
+        with self._lock:
+            self._tasks.discard(task)
+
+    def get(self, job_id):
+        """ Looks up a job.
+
+        :param job_id: Id returned by submit()
+        :type job_id: str
+
+        :return: The job's stored fields plus "status", and "result"
+                 or "error" once finished. None if the job doesn't exist
+                 or has expired. A job whose process died has failed.
+        :rtype: Dict[str, Any] | None
+        """
+        self._open()
+        job = self._store.get(f"job:{job_id}")
+        if job is None:
+            return None
+        task = self._store.get(f"task:{job['task']}")
+        if task is None:
+            return None
+        if self._abandoned(f"task:{job['task']}", task):
+            task = {"status": ERROR, "error": "The worker running this job stopped."}
+        task.pop("pid", None)
+        return {**job, **task}
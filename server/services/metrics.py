@@ -0,0 +1,160 @@
+""" Lightweight latency histograms and counters for the hot path.
+
+Each worker process keeps its metrics in memory and periodically writes them
+to <METRICS_DIR>/<pid>.json, so any worker can report totals for all of them.
+"""
+
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+import config
+
+# Upper bounds in seconds; the last bucket catches everything slower
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+
+class Metrics:
+    """ Per-process metrics registry
+
+    :param directory: Where each process writes its metrics
+    :type directory: str
+    :param flush_interval: Min seconds between writes to disk
+    :type flush_interval: float
+    """
+    def __init__(self, directory, flush_interval=1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.lock = Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.last_flush = 0.0
+
+    def observe(self, name, seconds):
+        """ Records one latency sample. """
+        i = next((i for i, b in enumerate(BUCKETS) if seconds <= b), len(BUCKETS))
+        with self.lock:
+            hist = self.histograms.setdefault(name, {
+                "count": 0, "sum": 0.0, "buckets": [0] * (len(BUCKETS) + 1)
+                })
+            hist["count"] += 1
+            hist["sum"] += seconds
+            hist["buckets"][i] += 1
+        self.flush()
+
+    def incr(self, name, amount=1):
+        """ Adds to a counter. """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+        self.flush()
+
+    @contextmanager
+    def timer(self, name):
+        """ Records how long the with-block takes, including when it raises. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def flush(self, force=False):
+        """ Writes this process's metrics to disk, at most once per flush_interval
+        unless forced.
+        """
+        now = time.monotonic()
+        if not force and now - self.last_flush < self.flush_interval:
+            return
+        with self.lock:
+            self.last_flush = now
+            data = json.dumps({"histograms": self.histograms, "counters": self.counters})
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(self.directory, f"{os.getpid()}.json"))
+
+    def aggregate(self):
+        """ Sums the metrics of every live worker process.
+        Files left by processes that have exited are removed.
+
+        :return: "workers", "counters" and "histograms", where each histogram
+                 has its count, mean, p50/p95/p99 estimates and bucket counts
+        :rtype: Dict[str, Any]
+        """
+        self.flush(force=True)
+        histograms = {}
+        counters = {}
+        workers = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            if not pid_alive(int(name.removesuffix(".json"))):
+                os.remove(path)
+                continue
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            workers += 1
+            for key, count in data["counters"].items():
+                counters[key] = counters.get(key, 0) + count
+            for key, hist in data["histograms"].items():
+                merged = histograms.setdefault(key, {
+                    "count": 0, "sum": 0.0, "buckets": [0] * (len(BUCKETS) + 1)
+                    })
+                merged["count"] += hist["count"]
+                merged["sum"] += hist["sum"]
+                merged["buckets"] = [a + b for a, b in zip(merged["buckets"], hist["buckets"])]
+
+        return {
+            "workers": workers,
+            "counters": counters,
+            "histograms": {k: summarize(h) for k, h in histograms.items()}
+            }
+
+
+def summarize(hist):
+    """ Adds mean and percentile estimates (bucket upper bounds) to a histogram. """
+    bounds = [*BUCKETS, float("inf")]
+    summary = {
+        "count": hist["count"],
+        "sum": hist["sum"],
+        "mean": hist["sum"] / hist["count"] if hist["count"] else None,
+        "buckets": {str(b): c for b, c in zip(bounds, hist["buckets"])}
+        }
+    for q in [50, 95, 99]:
+        target = hist["count"] * q / 100
+        seen = 0
+        for bound, count in zip(bounds, hist["buckets"]):
+            seen += count
+            if seen >= target:
+                summary[f"p{q}"] = bound
+                break
+    return summary
+
+
+def pid_alive(pid):
+    """ Checks if a process exists. """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+metrics = Metrics(config.METRICS_DIR)
+
+
+def timed(name):
+    """ Decorator that records every call's latency under name. """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,15 +1,148 @@
 """ The portfolio optimization model. """
 
-from math import sqrt
-from functools import reduce
-from contextlib import closing
+import warnings
+import cvxpy as cp
 import numpy as np
 import pandas as pd
-from pypfopt.risk_models import risk_matrix, fix_nonpositive_semidefinite
 from pypfopt.efficient_frontier import EfficientFrontier
-from .sql import get_connection
+from pypfopt.exceptions import OptimizationError
+import config
+from .sql import connection, load_fits
 from .factors import m12_return_rate
+from .calendar import trading_window, TRADEDAYS_IN_YEAR
 from .price_fetching import fetch_prices
+from .metrics import metrics
+from .covariance import covariance_cache, FactorCovariance
+from . import optimizer
+from .optimizer import dense_root
+
+# Solutions of reduced accuracy are accepted, and efficient_frontier flags
+# its points that have one; cvxpy would also warn on every such solve
+warnings.filterwarnings("ignore", message="Solution may be inaccurate", category=UserWarning)
+
+
+def use_factor_covariance(num_tickers):
+    """ Whether a universe gets the factor-structured covariance,
+    per config.COVARIANCE_MODE.
+
+    :type num_tickers: int
+    :rtype: bool
+    """
+    if config.COVARIANCE_MODE == "auto":
+        return num_tickers >= config.FACTOR_COVARIANCE_MIN_TICKERS
+    return config.COVARIANCE_MODE == "factor"
+
+
+def model_inputs(model, tickers):
+    """ Loads prices and estimates the expected returns and covariance for tickers.
+    The covariance is the sample covariance, or a FactorCovariance for
+    universes use_factor_covariance() picks.
+
+    :param model: Calculates annualized return rates for assets
+    :typeof model: services.returns.Carhart4FactorModel
+    :param tickers: Tickers to estimate
+    :type tickers: str[]
+
+    :return: (prices, expected returns, covariance matrix)
+    :rtype: Tuple[pandas.DataFrame, pandas.Series, pandas.DataFrame | FactorCovariance]
+    """
+    with connection() as con:
+        prices = fetch_prices(con, tickers)
+    return estimate_inputs(model, prices)
+
+
+def stored_returns(model, tickers):
+    """ Expected returns stored by prewarm.py for a live returns model's
+    trading day and factor set. Models with fixed factors get none.
+
+    :param model: Calculates annualized return rates for assets
+    :typeof model: services.returns.Carhart4FactorModel
+    :type tickers: str[]
+
+    :return: Expected returns of the tickers that have a stored fit
+    :rtype: pandas.Series
+    """
+    if not model.auto_refresh:
+        return pd.Series(dtype=float)
+    model.refresh()
+    with connection() as con:
+        returns = load_fits(con, model.factor_set, model.trading_day, tickers)["expected_return"]
+    metrics.incr("model.stored_fits", len(returns))
+    return returns
+
+
+def estimate_inputs(model, prices):
+    """ Estimates the expected returns and covariance from given prices,
+    see model_inputs. Expected returns prewarm.py stored are reused;
+    only the other tickers are fit.
+
+    :param model: Calculates annualized return rates for assets
+    :typeof model: services.returns.Carhart4FactorModel
+    :param prices: 2 years of prices, one column per ticker
+    :type prices: pandas.DataFrame, indexed by pandas.Timestamp
+
+    :return: (prices, expected returns, covariance matrix)
+    :rtype: Tuple[pandas.DataFrame, pandas.Series, pandas.DataFrame | FactorCovariance]
+    """
+    returns = stored_returns(model, list(prices.columns))
+    unfit = [t for t in prices.columns if t not in returns.index]
+    if unfit:
+        fitted = model.fit(m12_return_rate(prices[unfit]))["expected_return"]
+        returns = pd.concat([returns, fitted]) if len(returns) else fitted
+    returns = returns.reindex(prices.columns)
+    returns.name = "Expected Returns"
+    return prices, returns, estimate_covariance(model, prices)
+
+
+def estimate_covariance(model, prices):
+    """ The covariance model_inputs() uses for a universe of prices:
+    a FactorCovariance for universes use_factor_covariance() picks,
+    else the sample covariance.
+
+    :param model: Calculates annualized return rates for assets
+    :typeof model: services.returns.Carhart4FactorModel
+    :param prices: 2 years of prices, one column per ticker
+    :type prices: pandas.DataFrame, indexed by pandas.Timestamp
+
+    :rtype: pandas.DataFrame | FactorCovariance
+    """
+    with metrics.timer("model.covariance"):
+        if use_factor_covariance(prices.shape[1]) and model.factor_returns is not None:
+            return FactorCovariance.estimate(prices, model.factor_returns)
+        return covariance_cache.covariance(prices)
+
+
+def sub_inputs(inputs, tickers):
+    """ Slices model_inputs() of a larger universe down to some of its tickers.
+
+    :param inputs: (prices, expected returns, covariance matrix)
+    :type inputs: Tuple[pandas.DataFrame, pandas.Series, pandas.DataFrame | FactorCovariance]
+    :param tickers: Tickers to keep, all present in inputs
+    :type tickers: str[]
+
+    :rtype: Tuple[pandas.DataFrame, pandas.Series, pandas.DataFrame | FactorCovariance]
+    """
+    prices, returns, cov = inputs
+    if isinstance(cov, FactorCovariance):
+        return prices[tickers], returns[tickers], cov.subset(tickers)
+    return prices[tickers], returns[tickers], cov.loc[tickers, tickers]
+
+
+def solve_checked(problem, solver=cp.CLARABEL, **options):
+    """ Solves a cvxpy problem, raising if it has no optimal solution.
+    Solutions the solver marks inaccurate are accepted, see problem.status.
+
+    :type problem: cvxpy.Problem
+    :param options: Passed on to problem.solve, e.g. warm_start
+    :raises OptimizationError: if the solver fails or the problem is
+                               infeasible or unbounded
+    """
+    try:
+        problem.solve(solver=solver, **options)
+    except cp.SolverError as e:
+        raise OptimizationError(str(e)) from e
+    if problem.status not in (cp.OPTIMAL, cp.OPTIMAL_INACCURATE):
+        raise OptimizationError(f"Solver status: {problem.status}")
 
 
 class Model(EfficientFrontier):
@@ -19,59 +152,142 @@ class Model(EfficientFrontier):
     :typeof model: services.returns.Carhart4FactorModel
     :param tickers: Tickers to optimize a portfolio over
     :type tickers: str[]
+    :param inputs: Precomputed model_inputs() for exactly these tickers
+    :type inputs: Tuple[pandas.DataFrame, pandas.Series,
+                        pandas.DataFrame | FactorCovariance] | None
+
+    With a FactorCovariance, max_sharpe, min_volatility, portfolio_risk and
+    efficient_frontier all use its factored form; the dense matrix is never built.
     """
-    def __init__(self, model, tickers):
-        with closing(get_connection()) as con:
-            self.prices = fetch_prices(con, tickers)
+    def __init__(self, model, tickers, inputs=None):
+        if inputs is None:
+            inputs = model_inputs(model, tickers)
 
-        rates = {t: m12_return_rate(self.prices[t]) for t in self.prices}
+        self.prices, self.returns, self.risk_matrix = inputs
         self.curr_prices = self.prices.tail(1)
-        self.returns = pd.Series({t: model(r) for t, r in rates.items()})
-        self.returns.name = "Expected Returns"
         self.risk_free_rate = model.risk_free_rates.iloc[-1]
-        self.risk_matrix = fix_nonpositive_semidefinite(risk_matrix(self.prices))
-        super().__init__(self.returns, self.risk_matrix)
+        self.factored = isinstance(self.risk_matrix, FactorCovariance)
+        if self.factored:
+            # pypfopt only checks the covariance's shape; a zero-stride view
+            # passes that without allocating n² entries
+            n = len(self.returns)
+            super().__init__(self.returns, np.broadcast_to(np.float64(0), (n, n)))
+        else:
+            super().__init__(self.returns, self.risk_matrix)
 
     def __str__(self):
         returns = f"Returns:\n{self.returns}"
+        if self.factored:
+            loadings = pd.DataFrame(self.risk_matrix.loadings, index=self.risk_matrix.tickers)
+            return f"{returns}\n\nFactor Loadings:\n{loadings}"
         risk = f"Var-Covar Matrix:\n{self.risk_matrix}"
         return f"{returns}\n\n{risk}"
 
+    def weights_array(self, weights):
+        """ Converts portfolio weights into an array ordered like self.prices.columns
+
+        :param weights: The weight of each asset in the portfolio, or many
+                        portfolios as rows of an array already in column order
+        :type weights: OrderedDict[str, float] | numpy.ndarray
+
+        :return: Shape (n,) for a single portfolio, (m, n) for m portfolios
+        :rtype: numpy.ndarray
+        """
+        if isinstance(weights, dict):
+            return np.array([weights[t] for t in self.prices.columns])
+        return np.asarray(weights, dtype=float)
+
     def portfolio_returns(self, weights):
         """ Predicts total portfolio return given portfolio weights
 
-        :param weights: The weight of each asset in the portfolio
-        :type weights: OrderedDict[str, float]
+        :param weights: The weight of each asset in the portfolio,
+                        or an (m, n) array of m portfolios
+        :type weights: OrderedDict[str, float] | numpy.ndarray
 
-        :return: Annualized portfolio returns
-        :rtype: float
+        :return: Annualized portfolio returns, one per portfolio for an array
+        :rtype: float | numpy.ndarray
         """
-        return reduce(lambda acc, t: acc + weights[t] * self.returns[t], weights.keys(), 0)
+        return self.weights_array(weights) @ self.returns.to_numpy()
 
     def portfolio_risk(self, weights):
         """ Determines total portfolio volatility given portfolio weights
 
-        :param weights: The weight of each asset in the portfolio
-                        ORDER MATTERS! DO NOT CHANGE THE ORDER OF THE
-                        ENTRIES FROM WHAT WAS ORIGINALLY CALCULATED AFTER
-                        RUNNING THE PORTFOLIO OPTIMIZER
-        :type weights: OrderedDict[str, float]
+        :param weights: The weight of each asset in the portfolio,
+                        or an (m, n) array of m portfolios
+        :type weights: OrderedDict[str, float] | numpy.ndarray
 
         :return: Annualized portfolio risk
-                 (one stddev of total value variation as fraction of total weight)
-        :rtype: float
+                 (one stddev of total value variation as fraction of total weight),
+                 one per portfolio for an array
+        :rtype: float | numpy.ndarray
+        """
+        w = self.weights_array(weights)
+        if self.factored:
+            return np.sqrt(self.risk_matrix.variance(w))
+        return np.sqrt(np.einsum("...i,ij,...j->...", w, self.risk_matrix.to_numpy(), w))
+
+    def risk_vector(self, weights):
+        """ A cvxpy expression whose 2-norm is the annualized portfolio volatility
+
+        :param weights: Portfolio weights
+        :type weights: cvxpy.Expression
+
+        :rtype: cvxpy.Expression
         """
-        w = np.array([weights[t] for t in self.prices.columns])
-        return sqrt((w[None, :] @ self.risk_matrix.to_numpy() @ w)[0])
+        if self.factored:
+            return self.risk_matrix.risk_vector(weights)
+        return dense_root(self.risk_matrix.to_numpy()).T @ weights
+
+    def max_sharpe(self, risk_free_rate=0.02, constraints=None):
+        """ pypfopt's max_sharpe, solved on a cached compiled problem (see
+        services.optimizer) and on the factored covariance when there is one.
+
+        :param risk_free_rate: Risk-free rate, same period as self.returns
+        :type risk_free_rate: float
+        :param constraints: Weight bounds, sector caps and turnover limit
+        :type constraints: services.optimizer.PortfolioConstraints | None
+
+        :raises OptimizationError: if the constraints can't be met
+        :rtype: OrderedDict[str, float]
+        """
+        self._risk_free_rate = risk_free_rate
+        weights = optimizer.max_sharpe(list(self.prices.columns), self.returns.to_numpy(),
+                                       self.risk_matrix, risk_free_rate, self._lower_bounds,
+                                       self._upper_bounds, constraints)
+        self.weights = weights.round(16) + 0.0
+        return self._make_output_weights()
+
+    def min_volatility(self):
+        """ pypfopt's min_volatility, solved on the factored covariance when there is one.
+
+        :rtype: OrderedDict[str, float]
+        """
+        if not self.factored:
+            return super().min_volatility()
+        w = cp.Variable(self.n_assets)
+        self.solve_factored(w, [cp.sum(w) == 1, w >= self._lower_bounds, w <= self._upper_bounds])
+        self.weights = w.value.round(16) + 0.0
+        return self._make_output_weights()
+
+    def solve_factored(self, w, constraints):
+        """ Minimizes the variance of w, given as the squared norm of risk_vector(w)
+
+        :type w: cvxpy.Variable
+        :type constraints: cvxpy.Constraint[]
+        """
+        # OSQP, cvxpy's default for QPs, stalls on the badly scaled max_sharpe
+        # transform of large universes; the interior point solver doesn't
+        solve_checked(cp.Problem(cp.Minimize(cp.sum_squares(self.risk_vector(w))), constraints))
 
     def sharpe_ratio(self, weights):
         """ Determines portfolio sharpe ratio given portfolio weights
 
-        :param weights: The weight of each asset in the portfolio
-        :type weights: OrderedDict[str, float]
+        :param weights: The weight of each asset in the portfolio,
+                        or an (m, n) array of m portfolios
+        :type weights: OrderedDict[str, float] | numpy.ndarray
 
-        :return: sharpe ratio number
-        :rtype: float
+        :return: sharpe ratio number, one per portfolio for an array
+        :rtype: float | numpy.ndarray
         """
         excess_returns = self.portfolio_returns(weights) - self.risk_free_rate
         return excess_returns / self.portfolio_risk(weights)
@@ -90,24 +306,118 @@ class Model(EfficientFrontier):
         """
         return {k: int(((v * total) / self.curr_prices[k]).iloc[0]) for k, v in weights.items()}
 
+    def growth_curves(self, days=TRADEDAYS_IN_YEAR + 1):
+        """ Compounds each asset's daily returns over the last year
+
+        :param days: Number of trading days to compound over, ending on the last price
+        :type days: int
+
+        :return: Value of 1 unit of each asset at every time step,
+                 starting at 1 on the first day
+        :rtype: pandas.DataFrame, indexed by pandas.Timestamp
+        """
+        first = trading_window(self.prices.index[-1], days)[0]
+        daily_returns = self.prices.loc[first:].pct_change().fillna(0)
+        return (1 + daily_returns).cumprod()
+
     def historical_performance(self, weights):
         """ Calculates portfolio performance over the past year
         for the given portfolio weights
 
-        :param weights: The weight of each asset in the portfolio
-        :type weights: OrderedDict[str, float]
+        :param weights: The weight of each asset in the portfolio,
+                        or an (m, n) array of m portfolios
+        :type weights: OrderedDict[str, float] | numpy.ndarray
 
         :return: The value of the portfolio at every time step
                  The starting portfolio has a value of 1
-        :rtype: pandas.Series, indexed by pandas.Timestamp
+                 For an array, one column per portfolio
+        :rtype: pandas.Series | pandas.DataFrame, indexed by pandas.Timestamp
         """
-        trade_days_in_year = 253
-        year_performance = self.prices.tail(trade_days_in_year).pct_change()
-        weights_array = np.array([weights[t] for t in self.prices.columns])
-        year_performance.iloc[0] = weights_array
-
-        # require percent changes
-        for i in range(1, len(year_performance.index)):
-            year_performance.iloc[i] = (1 + year_performance.iloc[i]) * year_performance.iloc[i - 1]
-        portfolio_perf = year_performance.apply(sum, axis=1)
-        return portfolio_perf
+        growth = self.growth_curves()
+        w = self.weights_array(weights)
+        if w.ndim == 1:
+            return pd.Series(growth.to_numpy() @ w, index=growth.index)
+        return pd.DataFrame(growth.to_numpy() @ w.T, index=growth.index)
+
+    def evaluate_portfolios(self, weights):
+        """ Evaluates many candidate portfolios in one pass
+
+        :param weights: An (m, n) array of m portfolios, columns ordered
+                        like self.prices.columns
+        :type weights: numpy.ndarray
+
+        :return: Stats with one row per portfolio and columns
+                 "return", "volatility" and "sharpe", and the
+                 historical performance with one column per portfolio
+        :rtype: Tuple[pandas.DataFrame, pandas.DataFrame]
+        """
+        w = np.atleast_2d(self.weights_array(weights))
+        returns = self.portfolio_returns(w)
+        volatility = self.portfolio_risk(w)
+        stats = pd.DataFrame({
+            "return": returns,
+            "volatility": volatility,
+            "sharpe": (returns - self.risk_free_rate) / volatility
+            })
+        return stats, self.historical_performance(w)
+
+    def efficient_frontier(self, points=100, target="return"):
+        """ Sweeps the efficient frontier. The optimization problem is built
+        once with the target as a parameter and re-solved for each point,
+        warm-starting from the previous solution.
+
+        :param points: Number of frontier portfolios
+        :type points: int
+        :param target: "return" minimizes volatility for evenly spaced target
+                       returns, "risk" maximizes return for evenly spaced
+                       target volatilities
+        :type target: str
+
+        :return: Stats with one row per point and columns "target", "return",
+                 "volatility", "sharpe" and "inaccurate", whether the solver
+                 only reached reduced accuracy; weights with one row per point
+                 and one column per ticker; and the number of points left out
+                 because the solver failed or couldn't reach them
+        :raises OptimizationError: if either end of the frontier can't be solved
+        :rtype: Tuple[pandas.DataFrame, pandas.DataFrame, int]
+        """
+        mu = self.returns.to_numpy()
+        w = cp.Variable(len(mu))
+        risk = self.risk_vector(w)
+        level = cp.Parameter()
+        constraints = [cp.sum(w) == 1, w >= self._lower_bounds, w <= self._upper_bounds]
+        volatility = cp.norm(risk, 2)
+        if target == "return":
+            problem = cp.Problem(cp.Minimize(cp.sum_squares(risk)),
+                                 [*constraints, mu @ w >= level])
+            solver = cp.OSQP # QP solver that keeps its factorization between solves
+        else:
+            problem = cp.Problem(cp.Maximize(mu @ w), [*constraints, volatility <= level])
+            solver = cp.CLARABEL
+
+        # Ends of the frontier: the min volatility and the max return portfolios
+        ends = []
+        for objective in (cp.Minimize(cp.sum_squares(risk)), cp.Maximize(mu @ w)):
+            solve_checked(cp.Problem(objective, constraints))
+            ends.append(self.portfolio_returns(w.value) if target == "return"
+                        else self.portfolio_risk(w.value))
+
+        levels = np.linspace(*ends, points)
+        found = []
+        weights = []
+        inaccurate = []
+        for x in levels:
+            level.value = x
+            try:
+                solve_checked(problem, solver, warm_start=True)
+            except OptimizationError:
+                continue
+            found.append(x)
+            weights.append(w.value)
+            inaccurate.append(problem.status == cp.OPTIMAL_INACCURATE)
+
+        weights = pd.DataFrame(weights, columns=self.prices.columns)
+        stats, _ = self.evaluate_portfolios(weights.to_numpy())
+        stats.insert(0, "target", found)
+        stats["inaccurate"] = inaccurate
+        return stats, weights, len(levels) - len(found)
@@ -0,0 +1,273 @@
+""" Max sharpe portfolios under portfolio constraints, solved on cached,
+parameterized cvxpy problems.
+
+Turning a cvxpy problem into solver input (canonicalization) costs more
+than solving it for small universes. The problems here are written so every
+input enters as a cvxpy Parameter in DPP form, which lets cvxpy compile a
+problem once and only substitute new values on later solves. Compiled
+problems are cached per worker by shape: universe size, covariance form,
+number of capped sectors and whether turnover is limited.
+
+The max sharpe problem uses pypfopt's variable transformation: minimize the
+variance of y subject to (mu - rf)ᵀy = 1 and sum(y) = k, with weights y / k.
+Every weight constraint a ≤ g(w) ≤ b becomes a·k ≤ g(y) ≤ b·k.
+"""
+
+import warnings
+from contextlib import contextmanager
+from threading import Lock
+import cvxpy as cp
+import numpy as np
+from cachetools import LRUCache
+from pypfopt.exceptions import OptimizationError
+import config
+from .covariance import FactorCovariance
+from .metrics import metrics
+
+# Compiling a dense covariance's n² parameters is slow, and cvxpy warns so on
+# every compile; that cost is paid once per cached shape
+warnings.filterwarnings("ignore", message="Your problem has too many parameters",
+                        category=UserWarning)
+
+
+class PortfolioConstraints:
+    """ Constraints on max sharpe portfolios beyond the default weight bounds
+
+    :param bounds: (min, max) weight of some tickers; the others keep the
+                   model's bounds
+    :type bounds: Dict[str, Tuple[float, float]] | None
+    :param sectors: Each ticker's sector; tickers without one are uncapped
+    :type sectors: Dict[str, str] | None
+    :param sector_caps: Max total weight of each sector
+    :type sector_caps: Dict[str, float] | None
+    :param holdings: Current weights; tickers missing from it are held at 0
+                     and tickers outside the universe are sold
+    :type holdings: Dict[str, float] | None
+    :param max_turnover: Max sum of |new weight - current weight| over all tickers
+    :type max_turnover: float | None
+    """
+    def __init__(self, bounds=None, sectors=None, sector_caps=None, holdings=None,
+                 max_turnover=None):
+        self.bounds = bounds or {}
+        self.sectors = sectors or {}
+        self.sector_caps = sector_caps or {}
+        self.holdings = holdings or {}
+        self.max_turnover = max_turnover
+
+    def key(self):
+        """ Hashable form, for result cache keys
+
+        :rtype: Tuple
+        """
+        return (tuple(sorted((t, tuple(b)) for t, b in self.bounds.items())),
+                tuple(sorted(self.sectors.items())), tuple(sorted(self.sector_caps.items())),
+                tuple(sorted(self.holdings.items())), self.max_turnover)
+
+    def weight_bounds(self, tickers, lower, upper):
+        """ Lower and upper weight of each ticker
+
+        :type tickers: str[]
+        :param lower: Default lower bounds, ordered like tickers
+        :type lower: numpy.ndarray
+        :param upper: Default upper bounds, ordered like tickers
+        :type upper: numpy.ndarray
+        :rtype: Tuple[numpy.ndarray, numpy.ndarray]
+        """
+        lower, upper = np.array(lower, dtype=float), np.array(upper, dtype=float)
+        for i, t in enumerate(tickers):
+            if t in self.bounds:
+                lower[i], upper[i] = self.bounds[t]
+        return lower, upper
+
+    def sector_matrix(self, tickers):
+        """ Membership of tickers in the capped sectors, and the caps
+
+        :type tickers: str[]
+        :return: Shape (sectors, tickers) 0/1 matrix, and each row's cap
+        :rtype: Tuple[numpy.ndarray, numpy.ndarray]
+        """
+        capped = sorted(self.sector_caps)
+        members = np.array([[self.sectors.get(t) == s for t in tickers] for s in capped],
+                           dtype=float).reshape(len(capped), len(tickers))
+        return members, np.array([self.sector_caps[s] for s in capped], dtype=float)
+
+    def turnover(self, tickers):
+        """ Current weight of each ticker, and the turnover left once the
+        holdings outside the universe are sold
+
+        :type tickers: str[]
+        :rtype: Tuple[numpy.ndarray, float]
+        """
+        current = np.array([self.holdings.get(t, 0.0) for t in tickers], dtype=float)
+        universe = set(tickers)
+        sold = sum(abs(w) for t, w in self.holdings.items() if t not in universe)
+        return current, self.max_turnover - sold
+
+
+class MaxSharpeProblem:
+    """ A parameterized max sharpe problem for one shape. Not thread-safe:
+    each solve needs the problem to itself, see ProblemCache.
+
+    :param n: Number of assets
+    :type n: int
+    :param factors: Factors of a factored covariance, None for a dense one
+    :type factors: int | None
+    :param sectors: Number of capped sectors
+    :type sectors: int
+    :param turnover: Whether turnover is limited
+    :type turnover: bool
+    """
+    def __init__(self, n, factors=None, sectors=0, turnover=False):
+        self.y = cp.Variable(n)
+        self.k = cp.Variable(nonneg=True)
+        self.excess = cp.Parameter(n)
+        self.lower = cp.Parameter(n)
+        self.upper = cp.Parameter(n)
+        if factors is None:
+            # risk_root @ risk_rootᵀ == covariance
+            self.risk_root = cp.Parameter((n, n))
+            risk = self.risk_root.T @ self.y
+        else:
+            # (loadings @ factor_root)ᵀ and the residual volatilities
+            self.factor_exposure = cp.Parameter((factors, n))
+            self.specific_vol = cp.Parameter(n, nonneg=True)
+            risk = cp.hstack([self.factor_exposure @ self.y,
+                              cp.multiply(self.specific_vol, self.y)])
+        constraints = [
+            self.excess @ self.y == 1,
+            cp.sum(self.y) == self.k,
+            self.y >= cp.multiply(self.lower, self.k),
+            self.y <= cp.multiply(self.upper, self.k)
+            ]
+        if sectors:
+            self.members = cp.Parameter((sectors, n), nonneg=True)
+            self.caps = cp.Parameter(sectors)
+            constraints.append(self.members @ self.y <= self.caps * self.k)
+        if turnover:
+            self.current = cp.Parameter(n)
+            self.max_turnover = cp.Parameter()
+            constraints.append(cp.sum(cp.abs(self.y - self.current * self.k))
+                               <= self.max_turnover * self.k)
+        self.problem = cp.Problem(cp.Minimize(cp.sum_squares(risk)), constraints)
+
+    def solve(self):
+        """ Solves with the parameters' current values
+
+        :return: Weights
+        :rtype: numpy.ndarray
+        """
+        try:
+            # Same interior point solver as Model.solve_factored; OSQP stalls
+            # on the badly scaled transform of large universes
+            self.problem.solve(solver=cp.CLARABEL)
+        except cp.SolverError as e:
+            raise OptimizationError(str(e)) from e
+        if self.problem.status not in (cp.OPTIMAL, cp.OPTIMAL_INACCURATE):
+            raise OptimizationError(f"Solver status: {self.problem.status}")
+        return self.y.value / self.k.value
+
+
+def problem_shape(cov, constraints=None):
+    """ Cache key of the problem for a covariance and constraints
+
+    :type cov: pandas.DataFrame | FactorCovariance
+    :type constraints: PortfolioConstraints | None
+    :rtype: Tuple[int, int | None, int, bool]
+    """
+    n = len(cov.tickers) if isinstance(cov, FactorCovariance) else len(cov)
+    factors = cov.factor_cov.shape[0] if isinstance(cov, FactorCovariance) else None
+    if constraints is None:
+        return n, factors, 0, False
+    return n, factors, len(constraints.sector_caps), constraints.max_turnover is not None
+
+
+class ProblemCache:
+    """ Compiled MaxSharpeProblems by shape, least recently used shapes evicted first.
+    Each shape keeps a stack of idle problems, so concurrent solves of the
+    same shape each get their own.
+
+    :param maxsize: Max number of shapes kept
+    :type maxsize: int
+    """
+    def __init__(self, maxsize=64):
+        self.idle = LRUCache(maxsize=maxsize)
+        self.lock = Lock()
+
+    @contextmanager
+    def problem(self, shape):
+        """ Borrows an idle problem of a shape, building one if there is none
+
+        :type shape: Tuple[int, int | None, int, bool]
+        :rtype: MaxSharpeProblem
+        """
+        with self.lock:
+            stack = self.idle.get(shape)
+            problem = stack.pop() if stack else None
+        metrics.incr(f"cache.optimizer.{'miss' if problem is None else 'hit'}")
+        if problem is None:
+            problem = MaxSharpeProblem(*shape)
+        try:
+            yield problem
+        finally:
+            # Infeasible constraints leave the problem as reusable as a solve does
+            with self.lock:
+                stack = self.idle.get(shape)
+                if stack is None:
+                    stack = self.idle[shape] = []
+                stack.append(problem)
+
+
+problem_cache = ProblemCache(config.OPTIMIZER_CACHE_SIZE)
+
+
+def dense_root(cov):
+    """ A matrix root of a covariance, with negative eigenvalues clipped to 0
+
+    :type cov: numpy.ndarray
+    :return: risk_root with risk_root @ risk_rootᵀ == cov
+    :rtype: numpy.ndarray
+    """
+    q, v = np.linalg.eigh(cov)
+    return v * np.sqrt(np.clip(q, 0, None))
+
+
+def max_sharpe(tickers, returns, cov, risk_free_rate, lower, upper, constraints=None):
+    """ Weights of the max sharpe portfolio
+
+    :param tickers: Ticker of each asset
+    :type tickers: str[]
+    :param returns: Expected returns, ordered like tickers
+    :type returns: numpy.ndarray
+    :param cov: Covariance, ordered like tickers
+    :type cov: pandas.DataFrame | FactorCovariance
+    :param risk_free_rate: Risk-free rate, same period as returns
+    :type risk_free_rate: float
+    :param lower: Lower weight bounds, ordered like tickers
+    :type lower: numpy.ndarray
+    :param upper: Upper weight bounds, ordered like tickers
+    :type upper: numpy.ndarray
+    :type constraints: PortfolioConstraints | None
+
+    :raises ValueError: if no asset's expected return exceeds the risk-free rate
+    :raises OptimizationError: if the constraints can't be met
+    :rtype: numpy.ndarray
+    """
+    if max(returns) <= risk_free_rate:
+        raise ValueError("at least one of the assets must have an expected return "
+                         "exceeding the risk-free rate")
+    if constraints is not None:
+        lower, upper = constraints.weight_bounds(tickers, lower, upper)
+    with problem_cache.problem(problem_shape(cov, constraints)) as problem:
+        problem.excess.value = returns - risk_free_rate
+        problem.lower.value = lower
+        problem.upper.value = upper
+        if isinstance(cov, FactorCovariance):
+            problem.factor_exposure.value = (cov.loadings @ cov.factor_root).T
+            problem.specific_vol.value = np.sqrt(cov.specific)
+        else:
+            problem.risk_root.value = dense_root(cov.to_numpy())
+        if constraints is not None and constraints.sector_caps:
+            problem.members.value, problem.caps.value = constraints.sector_matrix(tickers)
+        if constraints is not None and constraints.max_turnover is not None:
+            problem.current.value, problem.max_turnover.value = constraints.turnover(tickers)
+        return problem.solve()
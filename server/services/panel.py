@@ -0,0 +1,343 @@
+""" A read-only matrix of every cached price, memory-mapped by all workers.
+
+The matrix holds trading days x tickers as float64, column-major, so each
+ticker's history is one contiguous column. A version is a directory under
+<DB_PATH>.panel holding values.npy, index.npy (datetime64 days), last.npy
+(each ticker's latest day with a price) and columns.json. The "current"
+symlink names the live version.
+
+Versions are never modified. After the price writer commits, it merges the
+new prices into a copy, writes that as a new version and swaps the symlink
+with an atomic rename. Readers notice the new version on their next read,
+and until then keep using the pages they already mapped. The pages are
+shared with every other worker through the page cache.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from contextlib import closing
+from functools import reduce
+import numpy as np
+import pandas as pd
+import config
+from . import sql
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+CURRENT = "current"
+
+
+def panel_dir():
+    """ Directory of the panel of config.DB_PATH
+
+    :rtype: str
+    """
+    return f"{config.DB_PATH}.panel"
+
+
+class PricePanel:
+    """ One memory-mapped version of the price matrix
+
+    :param version: Name of the version's directory
+    :type version: str
+    :param values: Prices, NaN where a ticker has no close
+    :type values: numpy.ndarray, shape (days, tickers), Fortran order
+    :param index: Trading days, ascending
+    :type index: pandas.DatetimeIndex
+    :param columns: Tickers, in column order
+    :type columns: str[]
+    :param last: Latest day with a price for each ticker
+    :type last: numpy.ndarray of datetime64[ns]
+    """
+    def __init__(self, version, values, index, columns, last):
+        self.version = version
+        self.values = values
+        self.index = index
+        self.columns = columns
+        self.last = last
+        self.positions = {t: i for i, t in enumerate(columns)}
+
+    @classmethod
+    def load(cls, directory, version):
+        """ Memory-maps a version written by save().
+
+        :type directory: str
+        :type version: str
+        :rtype: PricePanel
+        """
+        path = os.path.join(directory, version)
+        with open(os.path.join(path, "columns.json"), encoding="utf-8") as f:
+            columns = json.load(f)
+        return cls(version, np.load(os.path.join(path, "values.npy"), mmap_mode="r"),
+                   pd.DatetimeIndex(np.load(os.path.join(path, "index.npy"))),
+                   columns, np.load(os.path.join(path, "last.npy")))
+
+    @classmethod
+    def from_frame(cls, frame):
+        """ An unsaved panel of a price DataFrame
+
+        :type frame: pandas.DataFrame, indexed by pandas.Timestamp
+        :rtype: PricePanel
+        """
+        values = np.asfortranarray(frame.to_numpy(dtype=float))
+        has = ~np.isnan(values)
+        # Row of each column's last price. Every column must have one.
+        rows = len(values) - 1 - np.argmax(has[::-1], axis=0)
+        index = pd.DatetimeIndex(frame.index)
+        return cls(None, values, index, list(frame.columns),
+                   index.to_numpy(dtype="datetime64[ns]")[rows] if len(index)
+                   else np.empty(0, dtype="datetime64[ns]"))
+
+    def to_frame(self):
+        """ The whole matrix as a DataFrame backed by it
+
+        :rtype: pandas.DataFrame, indexed by pandas.Timestamp
+        """
+        return pd.DataFrame(self.values, index=self.index, columns=self.columns, copy=False)
+
+    def save(self, directory):
+        """ Writes this panel as a new version, without making it current.
+
+        :type directory: str
+        :return: The version's name
+        :rtype: str
+        """
+        tmp = tempfile.mkdtemp(dir=directory, prefix="tmp")
+        np.save(os.path.join(tmp, "values.npy"), np.asfortranarray(self.values))
+        np.save(os.path.join(tmp, "index.npy"), self.index.to_numpy(dtype="datetime64[ns]"))
+        np.save(os.path.join(tmp, "last.npy"), self.last)
+        with open(os.path.join(tmp, "columns.json"), "w", encoding="utf-8") as f:
+            json.dump(self.columns, f)
+        version = f"{time.time_ns()}"
+        os.rename(tmp, os.path.join(directory, version))
+        return version
+
+    def column(self, ticker):
+        """ Zero-copy view of one ticker's prices over every day of the panel
+
+        :rtype: numpy.ndarray
+        """
+        return self.values[:, self.positions[ticker]]
+
+    def stale(self, recent_entries):
+        """ Tickers the panel is missing or holds fewer days of than the database
+
+        :param recent_entries: Each ticker mapped to its latest stored day,
+                               see sql.find_recent_entries
+        :type recent_entries: Dict[str, pandas.Timestamp | None]
+        :rtype: str[]
+        """
+        return [t for t, recent in recent_entries.items()
+                if recent is not None and (t not in self.positions
+                                           or self.last[self.positions[t]] < recent)]
+
+    def frame(self, tickers, start=None, end=None):
+        """ Prices of some tickers, like sql.get_price_panel: days where none
+        of them has a price are left out. A run of adjacent columns is
+        returned as a view of the mapping; other selections are gathered
+        into one new array.
+
+        :param tickers: Tickers, all in the panel
+        :type tickers: str[]
+        :param start: First day to include, unbounded if None
+        :type start: pandas.Timestamp | None
+        :param end: Last day to include, unbounded if None
+        :type end: pandas.Timestamp | None
+
+        :rtype: pandas.DataFrame, indexed by pandas.Timestamp
+        """
+        lo = self.index.searchsorted(start) if start is not None else 0
+        hi = self.index.searchsorted(end, side="right") if end is not None else len(self.index)
+        cols = np.array([self.positions[t] for t in tickers], dtype=int)
+        if len(cols) and np.array_equal(cols, np.arange(cols[0], cols[0] + len(cols))):
+            values = self.values[lo:hi, cols[0]:cols[0] + len(cols)]
+        else:
+            values = self.values[lo:hi].take(cols, axis=1)
+        index = self.index[lo:hi]
+
+        has = ~np.isnan(values).all(axis=1)
+        if not has.all():
+            values, index = values[has], index[has]
+        return pd.DataFrame(values, index=index, columns=list(tickers), copy=False)
+
+
+def merged(panel, frames):
+    """ A new panel with the prices of frames written over a panel's,
+    like INSERT OR REPLACE: NaN entries in frames keep the old price.
+
+    :type panel: PricePanel | None
+    :type frames: pandas.DataFrame[], indexed by pandas.Timestamp
+    :rtype: PricePanel
+    """
+    frames = [df.dropna(axis=1, how="all") for df in frames]
+    old = panel.to_frame() if panel is not None else pd.DataFrame(dtype=float)
+    index = reduce(pd.Index.union, [df.index for df in frames], pd.DatetimeIndex(old.index))
+    columns = list(dict.fromkeys([*old.columns, *(t for df in frames for t in df.columns)]))
+    combined = old.reindex(index=index, columns=columns).astype(float)
+    for df in frames:
+        combined.update(df)
+    return PricePanel.from_frame(combined)
+
+
+def publish(directory, panel):
+    """ Saves a panel and makes it current, deleting older versions.
+    Must hold the panel lock.
+
+    :type directory: str
+    :type panel: PricePanel
+    """
+    version = panel.save(directory)
+    link = os.path.join(directory, f"tmp-{version}")
+    os.symlink(version, link)
+    os.replace(link, os.path.join(directory, CURRENT))
+    # Workers that still map an old version keep its pages until they reload
+    for old in os.listdir(directory):
+        path = os.path.join(directory, old)
+        if old != version and os.path.isdir(path) and not os.path.islink(path) \
+                and not old.startswith("tmp"):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class PanelLock:
+    """ Exclusive lock on a panel directory, across threads and processes """
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, ".lock")
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, "w", encoding="utf-8")
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+def current_version(directory):
+    """ Name of the live version, or None if there is no panel
+
+    :type directory: str
+    :rtype: str | None
+    """
+    try:
+        return os.readlink(os.path.join(directory, CURRENT))
+    except FileNotFoundError:
+        return None
+
+
+_panel = None
+_panel_key = None
+
+
+def get_panel():
+    """ The current panel of config.DB_PATH, reloaded when a new version is published
+
+    :return: The panel, or None if there is none yet
+    :rtype: PricePanel | None
+    """
+    directory = panel_dir()
+    version = current_version(directory)
+    if version is None:
+        return None
+    global _panel, _panel_key
+    panel = _panel
+    if _panel_key != (directory, version):
+        try:
+            panel = PricePanel.load(directory, version)
+        except FileNotFoundError:
+            # Replaced and deleted since readlink; the next read loads the newer one
+            return None
+        _panel, _panel_key = panel, (directory, version)
+    return panel
+
+
+def rebuild(con):
+    """ Builds the panel from every price in the database, unless another
+    process just did.
+
+    :param con: Active database connection.
+    :type con: sqlite3.Connection
+    """
+    directory = panel_dir()
+    with PanelLock(directory):
+        if current_version(directory) is not None:
+            return
+        with metrics.timer("panel.rebuild"), closing(con.cursor()) as cur:
+            cur.execute(f"SELECT ticker, t, close FROM {sql.PRICE_TABLE}")
+            long = pd.DataFrame(cur.fetchall(), columns=["ticker", "t", "close"])
+            frame = long.pivot(index="t", columns="ticker", values="close")
+            frame.index = pd.to_datetime(frame.index, unit="s")
+            publish(directory, PricePanel.from_frame(frame))
+
+
+def merge(frames):
+    """ Publishes the panel with newly committed prices merged in. Called by
+    the price writer after each commit. Without a panel, nothing is done:
+    the next read builds one from the database. If merging fails, the panel
+    is dropped rather than left stale.
+
+    :param frames: Prices just written to the database
+    :type frames: pandas.DataFrame[], indexed by pandas.Timestamp
+    """
+    if not config.PRICE_PANEL:
+        return
+    directory = panel_dir()
+    try:
+        with PanelLock(directory), metrics.timer("panel.merge"):
+            version = current_version(directory)
+            if version is None:
+                return
+            publish(directory, merged(PricePanel.load(directory, version), frames))
+    except Exception: # pylint: disable=broad-except
+        logger.exception("Merging prices into the panel failed, dropping it")
+        try:
+            os.remove(os.path.join(directory, CURRENT))
+        except FileNotFoundError:
+            pass
+
+
+def read_prices(con, tickers, start=None, end=None):
+    """ Prices of tickers from the panel, like sql.get_price_panel.
+    Tickers the panel lacks or has fewer days of than the database are
+    read from the database and merged into the panel.
+
+    :param con: Active database connection.
+    :type con: sqlite3.Connection
+    :param tickers: Ticker names, all uppercase
+    :type tickers: str[]
+    :param start: First day to include, unbounded if None
+    :type start: pandas.Timestamp | None
+    :param end: Last day to include, unbounded if None
+    :type end: pandas.Timestamp | None
+
+    :rtype: pandas.DataFrame, indexed by pandas.Timestamp
+    """
+    if not config.PRICE_PANEL:
+        return sql.get_price_panel(con, tickers, start, end)
+
+    panel = get_panel()
+    if panel is None:
+        rebuild(con)
+        panel = get_panel()
+    stale = panel.stale(sql.find_recent_entries(con, tickers)) if panel is not None \
+        else tickers
+    if stale:
+        metrics.incr("panel.misses", len(stale))
+        # Whole histories, so merging them leaves no gaps in the panel
+        merge([sql.get_price_panel(con, stale)])
+        panel = get_panel()
+        if panel is None or panel.stale(sql.find_recent_entries(con, stale)):
+            return sql.get_price_panel(con, tickers, start, end)
+    metrics.incr("panel.hits")
+    present = [t for t in tickers if t in panel.positions]
+    frame = panel.frame(present, start, end)
+    # Tickers without any price stay NaN columns, as from the database
+    return frame if len(present) == len(tickers) else frame.reindex(columns=list(tickers))
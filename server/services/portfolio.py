@@ -0,0 +1,160 @@
+""" Runs the full optimization pipeline and shapes its output for responses. """
+
+import logging
+from .model import Model, estimate_inputs
+from .returns import Carhart4FactorModel, factors_from_prices
+from .backtest import load_panel, ESTIMATION_DAYS
+from .errors import TickerException
+from .metrics import metrics
+from .encoding import iso_series, columnar_series
+from . import risk
+
+logger = logging.getLogger(__name__)
+
+
+class PortfolioResult:
+    """ Everything about an optimized portfolio that doesn't depend on
+    the portfolio's dollar value, so it can be reused across requests.
+
+    :param weights: The weight of each asset in the portfolio
+    :type weights: OrderedDict[str, float]
+    :param expected_return: Annualized gross return rate, e.g. 1.08
+    :type expected_return: float
+    :param volatility: Annualized portfolio volatility
+    :type volatility: float
+    :param sharpe: Portfolio sharpe ratio
+    :type sharpe: float
+    :param performance: Portfolio value over the past year, starting at 1
+    :type performance: pandas.Series, indexed by pandas.Timestamp
+    :param curr_prices: Latest price of each asset
+    :type curr_prices: Dict[str, float]
+    :param daily_returns: The portfolio's daily returns over the whole price history
+    :type daily_returns: numpy.ndarray | None
+    """
+    def __init__(self, weights, expected_return, volatility, sharpe, performance, curr_prices,
+                 daily_returns=None):
+        self.weights = weights
+        self.expected_return = expected_return
+        self.volatility = volatility
+        self.sharpe = sharpe
+        self.performance = performance
+        self.curr_prices = curr_prices
+        self.daily_returns = daily_returns
+
+    @classmethod
+    def from_model(cls, model, weights):
+        """ Evaluates optimized weights on the model they came from.
+
+        :type model: services.model.Model
+        :type weights: OrderedDict[str, float]
+        :rtype: PortfolioResult
+        """
+        return cls(
+            weights,
+            float(model.portfolio_returns(weights)),
+            float(model.portfolio_risk(weights)),
+            float(model.sharpe_ratio(weights)),
+            model.historical_performance(weights),
+            model.curr_prices.iloc[0].to_dict(),
+            risk.daily_returns(model.prices, model.weights_array(weights))
+            )
+
+    def share_count(self, total):
+        """ Determines integer number of shares that should be bought
+
+        :param total: Total portfolio value
+        :type total: float
+
+        :return: Each asset mapped to how many shares should be bought
+        :rtype: Dict[str, int]
+        """
+        return {k: int((v * total) / self.curr_prices[k]) for k, v in self.weights.items()}
+
+    def risk(self, **options):
+        """ VaR, CVaR and max drawdown of the portfolio, see services.risk.risk_report
+
+        :param options: Keyword arguments of risk_report
+        :rtype: Dict[str, Dict[str, float]]
+        """
+        with metrics.timer("model.risk"):
+            return risk.risk_report(self.daily_returns, self.volatility, **options)
+
+    def to_response(self, tickers, value, columnar=False):
+        """ The /model response body for a portfolio value.
+
+        :param tickers: Tickers in the order they were requested
+        :type tickers: str[]
+        :param value: The total value of the portfolio in USD
+        :type value: float
+        :param columnar: Send the performance series as parallel arrays
+                         (see services.encoding) instead of keyed by date
+        :type columnar: bool
+
+        :rtype: Dict[str, Any]
+        """
+        encode_series = columnar_series if columnar else iso_series
+        return {
+            "status": "OK",
+            "tickers": tickers,
+            "value": value,
+            "weights": {t: self.weights[t] for t in tickers},
+            "shares": self.share_count(value),
+            "return": (self.expected_return - 1) * value,
+            "volatility": self.volatility,
+            "sharpe": self.sharpe,
+            "performance": encode_series(self.performance)
+            }
+
+
+def optimize(returns_model, tickers, constraints=None):
+    """ Builds the model for a ticker universe and finds the max sharpe portfolio.
+
+    :param returns_model: Calculates annualized return rates for assets
+    :type returns_model: services.returns.Carhart4FactorModel
+    :param tickers: Tickers to optimize a portfolio over
+    :type tickers: str[]
+    :param constraints: Weight bounds, sector caps and turnover limit
+    :type constraints: services.optimizer.PortfolioConstraints | None
+
+    :rtype: PortfolioResult
+    """
+    model = Model(returns_model, tickers)
+    logger.debug("%s", model)
+    with metrics.timer("model.solver"):
+        portfolio = model.max_sharpe(risk_free_rate=model.risk_free_rate,
+                                     constraints=constraints)
+    return PortfolioResult.from_model(model, portfolio)
+
+
+def optimize_as_of(tickers, day, factor_set="default", constraints=None):
+    """ Same as optimize, but as of the close of a past trading day: the
+    factors, betas and covariance are estimated from the stored prices up
+    to that day only. Only prices that aren't stored yet are downloaded,
+    so re-running a day gives the same portfolio.
+
+    :param tickers: Tickers to optimize a portfolio over, all uppercase
+    :type tickers: str[]
+    :param day: Trading day to optimize as of
+    :type day: pandas.Timestamp
+    :param factor_set: Factor set to estimate returns with
+    :type factor_set: str
+    :param constraints: Weight bounds, sector caps and turnover limit
+    :type constraints: services.optimizer.PortfolioConstraints | None
+
+    :rtype: PortfolioResult
+    """
+    with metrics.timer("model.as_of.load"):
+        window = load_panel(tickers, day, factor_set, end=day).iloc[-ESTIMATION_DAYS:]
+    missing = [t for t in tickers if window[t].isna().all()]
+    if missing:
+        raise TickerException(f"Price data for ticker ${missing[0]} is missing "
+                              f"as of {day:%Y-%m-%d}.", missing[0])
+
+    factors, risk_free, factor_returns = factors_from_prices(window, factor_set)
+    returns_model = Carhart4FactorModel(factors=factors, risk_free_rates=risk_free,
+                                        factor_returns=factor_returns)
+    model = Model(returns_model, tickers, estimate_inputs(returns_model, window[tickers]))
+    with metrics.timer("model.solver"):
+        portfolio = model.max_sharpe(risk_free_rate=model.risk_free_rate,
+                                     constraints=constraints)
+    return PortfolioResult.from_model(model, portfolio)
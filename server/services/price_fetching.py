@@ -1,46 +1,193 @@
-""" Utility function to get price data from both yfinance and preexisting data in sql. """
+""" Utility function to get price data from both a price provider and preexisting data in sql. """
 
-import datetime
-import yfinance as yf
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-from . import sql
+import config
+from . import sql, panel
 from .errors import TickerException
+from .providers import get_provider
+from .calendar import last_trading_day, trading_day_on_or_before, trading_days_before
+from .metrics import metrics
+from .singleflight import coalesce
 
-def fetch_prices(con, symbols):
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_pid = None
+
+
+def download_executor():
+    """ Returns this process's bounded download thread pool.
+    Created lazily so forked workers don't inherit a dead pool.
+
+    :rtype: concurrent.futures.ThreadPoolExecutor
+    """
+    global _executor, _executor_pid
+    if _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(max_workers=config.FETCH_WORKERS,
+                                       thread_name_prefix="price-download")
+        _executor_pid = os.getpid()
+    return _executor
+
+
+def missing_ranges(recent_entries, today=None, last_close=None):
+    """ Groups tickers by the first day of data they are missing.
+
+    :param recent_entries: Each ticker mapped to its latest stored day, or None
+    :type recent_entries: Dict[str, pandas.Timestamp | None]
+    :param today: Defaults to today
+    :param last_close: Last settled close, which downloads must stop at,
+                       defaults to the one of today
+    :type last_close: pandas.Timestamp | None
+
+    :return: First missing day mapped to the tickers that need data from it,
+             in batches of at most FETCH_BATCH_SIZE tickers.
+             Tickers that have the last settled close (see
+             services.calendar.last_trading_day) are left out, so nothing is
+             downloaded during the trading day once the previous close is stored.
+    :rtype: List[Tuple[pandas.Timestamp, str[]]]
+    """
+    if last_close is None:
+        last_close = last_trading_day() if today is None else trading_day_on_or_before(today)
+    today = pd.Timestamp.today().normalize() if today is None else today
+    gaps = {}
+    for ticker, recent in recent_entries.items():
+        if recent is None:
+            start = trading_days_before(today, sql.HISTORY_DAYS)
+        elif recent >= last_close:
+            continue
+        else:
+            start = recent + pd.Timedelta(1, "d")
+        gaps.setdefault(start, []).append(ticker)
+
+    size = config.FETCH_BATCH_SIZE
+    return [(start, tickers[i:i + size])
+            for start, tickers in sorted(gaps.items())
+            for i in range(0, len(tickers), size)]
+
+
+def timed_download(provider, symbols, start, end=None):
+    """ provider.download, recording its latency and the rows it returned. """
+    with metrics.timer("provider.download"):
+        data = provider.download(symbols, start, end)
+    metrics.incr("provider.rows_downloaded", int(data.notna().to_numpy().sum()))
+    return data
+
+
+def download_missing(con, symbols, provider):
+    """ Downloads the days each symbol is missing since its latest stored day,
+    up to the last settled close, batching symbols with the same gap and
+    running batches concurrently.
+
+    :param con: Active database connection.
+    :type con: sqlite3.Connection
+    :type symbols: str[]
+    :type provider: services.providers.PriceProvider
+    """
+    # During the trading day providers return the day's latest price as its
+    # close; the next fetch starts after it, so it would never be corrected.
+    # The same cutoff decides which tickers are missing days
+    last_close = last_trading_day()
+    end = last_close + pd.Timedelta(1, "d")
+    recent_entries = sql.find_recent_entries(con, symbols)
+    batches = missing_ranges(recent_entries, last_close=last_close)
+
+    futures = [(tickers, download_executor().submit(
+                    timed_download, provider, tickers, start, end))
+               for start, tickers in batches]
+    for tickers, future in futures:
+        try:
+            logger.info("Downloading price data for %s", tickers)
+            new_data = future.result()
+        except Exception as e:
+            raise TickerException(f"Fetching price data for {tickers} failed", tickers) from e
+
+        new_data = new_data.loc[new_data.index <= last_close]
+        # Stored first, so the batch's other tickers aren't downloaded again
+        sql.write_prices(new_data)
+        for ticker in tickers:
+            if recent_entries[ticker] is None and new_data[ticker].isna().all():
+                raise TickerException(f"Price data for ticker ${ticker.upper()} is missing.",
+                                      ticker)
+
+
+def fetch_prices(con, symbols, provider=None):
     """ Gets the last 2 years of price data for a symbol.
-    First checks sql db if the data already exists; then fetches
-    all the necessary missing data from yfinance to complete the
-    2 year period.
+    First checks sql db for the latest stored day of every symbol; then
+    downloads only each symbol's missing days. Concurrent callers missing
+    the same symbol, in this process or another, share one download of it
+    (see services.singleflight).
 
     :param con: Active database connection.
     :type con: sqlite3.Connection
     :param symbols: Tickers to fetch price data for.
     :type symbols: str[]
+    :param provider: Market data source, defaults to the configured provider
+    :type provider: services.providers.PriceProvider | None
 
     :return: DataFrame where each column is the ticker
     :rtype: pandas.DataFrame, indexed by pandas.Timestamp
     """
-    recent_entries = list(map(lambda t: sql.find_recent_entry(con, t), symbols))
-    if None in recent_entries:
-        start_date = datetime.date.today() - datetime.timedelta(days=730)
+    provider = provider or get_provider()
+    missing = [ticker for _, tickers in missing_ranges(sql.find_recent_entries(con, symbols))
+               for ticker in tickers]
+    if missing:
+        # Rechecks the db, so tickers another caller just downloaded are skipped
+        coalesce(missing, lambda tickers: download_missing(con, tickers, provider))
+
+    today = pd.Timestamp.today().normalize()
+    return panel.read_prices(con, symbols, trading_days_before(today, sql.HISTORY_DAYS), today)
+
+
+def backfill_prices(con, symbols, start, provider=None, end=None):
+    """ Gets price data for symbols from start until end. Like fetch_prices,
+    but also downloads the days before each symbol's oldest stored day, for
+    history longer than fetch_prices keeps. Symbols that didn't trade yet
+    on start have no data before their first day.
+
+    :param con: Active database connection.
+    :type con: sqlite3.Connection
+    :param symbols: Tickers to fetch price data for.
+    :type symbols: str[]
+    :param start: First day needed
+    :type start: pandas.Timestamp
+    :param provider: Market data source, defaults to the configured provider
+    :type provider: services.providers.PriceProvider | None
+    :param end: Last day needed, defaults to today. Symbols whose stored
+                prices already reach end aren't updated, so a past range
+                that is stored is read without any download.
+    :type end: pandas.Timestamp | None
+
+    :return: DataFrame where each column is the ticker
+    :rtype: pandas.DataFrame, indexed by pandas.Timestamp
+    """
+    provider = provider or get_provider()
+    if end is None:
+        fetch_prices(con, symbols, provider)
     else:
-        start_date = min(recent_entries)
-
-    try:
-        print(f"\nDownloading price data for {symbols}")
-        new_data = yf.download(symbols, start=start_date)["Close"].tz_localize(None)
-    except Exception as e:
-        raise TickerException(f"Fetching price data for {symbols} failed", symbols) from e
-
-    # If only one ticker is requested, yfinance returns pd.Series instead of pd.DataFrame
-    if len(symbols) == 1:
-        new_data = pd.DataFrame(new_data)
-        new_data.columns = symbols
-
-    print(new_data)
-    for ticker in new_data:
-        if new_data[ticker].empty or new_data[ticker].isna().any():
-            raise TickerException(f"Price data for ticker ${ticker.upper()} is missing.", ticker)
-
-    sql.insert_price_data(con, new_data)
-    return pd.concat(map(lambda t: sql.get_price_data(con, t), symbols), axis=1)
+        last = trading_day_on_or_before(end)
+        behind = [s for s, recent in sql.find_recent_entries(con, symbols).items()
+                  if recent is None or recent < last]
+        if behind:
+            fetch_prices(con, behind, provider)
+    # A week of slack so weekends and holidays around start don't trigger downloads
+    gaps = {}
+    for ticker, first in sql.find_first_entries(con, symbols).items():
+        if first is not None and first > start + pd.Timedelta(7, "d"):
+            gaps.setdefault(first, []).append(ticker)
+
+    size = config.FETCH_BATCH_SIZE
+    futures = [(tickers[i:i + size], first, download_executor().submit(
+                    provider.download, tickers[i:i + size], start, first))
+               for first, tickers in gaps.items() for i in range(0, len(tickers), size)]
+    for tickers, first, future in futures:
+        logger.info("Backfilling price data for %s", tickers)
+        try:
+            new_data = future.result()
+        except Exception as e:
+            raise TickerException(f"Fetching price data for {tickers} failed", tickers) from e
+        sql.write_prices(new_data.loc[new_data.index < first])
+
+    return panel.read_prices(con, symbols, start, end)
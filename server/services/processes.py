@@ -0,0 +1,38 @@
+""" Process pools for CPU-bound work, such as risk simulations and backtests.
+
+Pool processes are started by a forkserver instead of being forked from the
+worker that uses them. A forked child would inherit the worker's threads'
+locks in whatever state they were in and run every at-fork hook the worker
+registered (see services.warmup). Forkserver children start from a clean
+interpreter and only import what the functions sent to them need.
+"""
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+
+START_METHOD = "forkserver"
+
+_executors = {}
+_lock = Lock()
+
+
+def process_executor(name, workers):
+    """ Returns this process's pool of a name, e.g. "risk".
+    Created lazily so forked workers don't inherit a dead pool.
+
+    :param name: Which pool, so unrelated work doesn't queue behind each other
+    :type name: str
+    :param workers: Number of processes, used when the pool is created
+    :type workers: int
+
+    :rtype: concurrent.futures.ProcessPoolExecutor
+    """
+    with _lock:
+        pid, executor = _executors.get(name, (None, None))
+        if pid != os.getpid():
+            executor = ProcessPoolExecutor(max_workers=workers,
+                                           mp_context=multiprocessing.get_context(START_METHOD))
+            _executors[name] = (os.getpid(), executor)
+        return executor
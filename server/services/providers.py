@@ -0,0 +1,134 @@
+""" Market data providers. Everything that downloads prices goes through a
+PriceProvider, so the network source can be swapped for local files.
+"""
+
+import os
+import time
+import pandas as pd
+import config
+
+
+class PriceProvider:
+    """ Interface for a source of daily close prices. """
+    def download(self, symbols, start, end=None):
+        """ Downloads daily closes for many symbols.
+
+        :param symbols: Tickers to download, all uppercase
+        :type symbols: str[]
+        :param start: First day to download
+        :type start: pandas.Timestamp | datetime.date
+        :param end: Day after the last day to download, defaults to today
+        :type end: pandas.Timestamp | datetime.date | None
+
+        :return: DataFrame where each column is a requested ticker
+        :rtype: pandas.DataFrame, indexed by pandas.Timestamp
+        """
+        raise NotImplementedError
+
+    def history(self, symbol, period="1y"):
+        """ Gets the daily closes of a single symbol over a trailing period.
+
+        :param symbol: Ticker or index symbol, e.g. ^IRX
+        :type symbol: str
+        :param period: Trailing period in years, e.g. 1y
+        :type period: str
+
+        :rtype: pandas.Series, indexed by pandas.Timestamp
+        """
+        start = pd.Timestamp.today().normalize() - pd.DateOffset(years=int(period.rstrip("y")))
+        return self.download([symbol], start)[symbol]
+
+
+class YFinanceProvider(PriceProvider):
+    """ Downloads prices from Yahoo Finance """
+    def download(self, symbols, start, end=None):
+        import yfinance as yf
+        data = yf.download(symbols, start=start, end=end, progress=False)["Close"]
+        # If only one ticker is requested, yfinance may return pd.Series instead of pd.DataFrame
+        if isinstance(data, pd.Series):
+            data = data.to_frame(symbols[0])
+        return data.tz_localize(None).reindex(columns=symbols)
+
+    def history(self, symbol, period="1y"):
+        import yfinance as yf
+        closes = yf.Ticker(symbol).history(period=period)["Close"].tz_localize(None)
+        closes.name = symbol
+        return closes
+
+
+class ReplayProvider(PriceProvider):
+    """ Serves prices from local data instead of the network.
+
+    :param source: Directory with one <TICKER>.csv file (date, close) per
+                   symbol, or a DataFrame with a column per symbol
+    :type source: str | pandas.DataFrame
+    :param latency: Seconds each download waits, to stand in for the network
+    :type latency: float
+    """
+    def __init__(self, source, latency=0.0):
+        self.latency = latency
+        self.directory = None
+        self.frame = None
+        if isinstance(source, pd.DataFrame):
+            self.frame = source.sort_index()
+        else:
+            self.directory = source
+
+    def _closes(self, symbol):
+        if self.frame is not None:
+            return self.frame[symbol] if symbol in self.frame else pd.Series(dtype=float)
+        path = os.path.join(self.directory, f"{symbol}.csv")
+        if not os.path.exists(path):
+            return pd.Series(dtype=float)
+        return pd.read_csv(path, index_col=0, parse_dates=True).iloc[:, 0]
+
+    def download(self, symbols, start, end=None):
+        if self.latency:
+            time.sleep(self.latency)
+        start = pd.Timestamp(start)
+        end = pd.Timestamp(end) if end is not None else pd.Timestamp.today().normalize()
+        data = pd.concat({s: self._closes(s) for s in symbols}, axis=1)
+        data.index = pd.DatetimeIndex(data.index)
+        return data.loc[(data.index >= start) & (data.index < end)].reindex(columns=symbols)
+
+
+def write_replay_files(directory, prices):
+    """ Saves a price panel in the layout ReplayProvider reads.
+
+    :param directory: Directory to write <TICKER>.csv files to
+    :type directory: str
+    :param prices: DataFrame where each column is a ticker
+    :type prices: pandas.DataFrame, indexed by pandas.Timestamp
+    """
+    os.makedirs(directory, exist_ok=True)
+    for symbol in prices:
+        closes = prices[symbol].dropna()
+        closes.index.name = "date"
+        closes.rename("close").to_csv(os.path.join(directory, f"{symbol}.csv"))
+
+
+_provider = None
+
+
+def get_provider():
+    """ Returns the process-wide provider configured by PRICE_PROVIDER.
+
+    :rtype: PriceProvider
+    """
+    global _provider
+    if _provider is None:
+        if config.PRICE_PROVIDER == "replay":
+            _provider = ReplayProvider(config.PRICE_REPLAY_DIR, config.PRICE_REPLAY_LATENCY)
+        else:
+            _provider = YFinanceProvider()
+    return _provider
+
+
+def set_provider(provider):
+    """ Overrides the process-wide provider.
+
+    :param provider: Provider used by every later download
+    :type provider: PriceProvider
+    """
+    global _provider
+    _provider = provider
@@ -1,14 +1,62 @@
 """ The custom asset returns model. """
 
-import cvxpy as cp
+from threading import Lock
+import numpy as np
 import pandas as pd
-from .factors import FactorModel, risk_free_rates
+from .factors import FactorModel, risk_free_rates, market_prices, m12_return_rate, \
+    TRADEDAYS_IN_YEAR, RISK_FREE_SYMBOL, MARKET_SYMBOL
+from .factor_cache import get_snapshot
+from .calendar import last_trading_day, trading_window
+from .metrics import timed
+
+BETAS = ["bCAPM", "bSMB", "bHML", "bUMD"]
 
 
 class Carhart4FactorModel:
-    """ Custom Carhart 4-factor model """
-    def __init__(self):
-        self.reconstruct_factors()
+    """ Custom Carhart 4-factor model
+
+    :param method: "lstsq" fits every asset in one closed-form least-squares
+                   solve, "cvxpy" fits each asset as its own cvxpy problem
+    :type method: str
+    :param beta_bounds: (lower, upper) bounds on each beta, only used by "cvxpy"
+    :type beta_bounds: Tuple[float, float] | None
+    :param factors: Fixed factors. If None, the shared snapshot for the
+                    last trading day is used and refreshed automatically.
+    :type factors: pandas.DataFrame, indexed by pandas.Timestamp
+    :param risk_free_rates: Fixed risk-free rates matching factors
+    :type risk_free_rates: pandas.Series, indexed by pandas.Timestamp
+    :param factor_returns: Fixed daily factor returns matching factors,
+                           see services.factors.FactorModel.daily_returns
+    :type factor_returns: pandas.DataFrame, indexed by pandas.Timestamp | None
+    :param factor_set: Name of the factor set to build factors from,
+                       one of services.factors.factor_sets()
+    :type factor_set: str
+    """
+    def __init__(self, method="lstsq", beta_bounds=None, factors=None, risk_free_rates=None,
+                 factor_set="default", factor_returns=None):
+        self.method = method
+        self.factor_set = factor_set
+        self.beta_bounds = beta_bounds
+        self.auto_refresh = factors is None
+        self.trading_day = None
+        self._refresh_lock = Lock()
+        self.factors = factors
+        self.risk_free_rates = risk_free_rates
+        self.factor_returns = factor_returns
+        self.refresh()
+
+    def refresh(self):
+        """ Loads the factor snapshot for the last trading day if the current
+        factors are older. Does nothing for fixed factors.
+        """
+        if not self.auto_refresh:
+            return
+        day = last_trading_day()
+        with self._refresh_lock:
+            if self.trading_day != day:
+                self.factors, self.risk_free_rates, self.factor_returns = get_snapshot(
+                    lambda: build_factors(self.factor_set), day, self.factor_set)
+                self.trading_day = day
 
     def __call__(self, rates):
         """ Applies the Carhart model onto the given asset.
@@ -19,29 +67,146 @@ class Carhart4FactorModel:
         :return: Expected future rate of return for the asset
         :rtype: float
         """
-        days_with_data = rates.index.intersection(self.factors.index)
-        factors = self.factors.loc[days_with_data].to_numpy()
-        asset_returns = rates.loc[days_with_data].to_numpy()
-        risk_free = self.risk_free_rates.loc[days_with_data].to_numpy()
+        return self.fit(rates.to_frame())["expected_return"].iloc[0]
 
-        betas = cp.Variable(4) # [ bCAPM, bSMB, bHML, bUMD ]
-        objective = cp.Minimize(cp.sum_squares(factors @ betas + risk_free - asset_returns))
-        cp.Problem(objective).solve()
+    @timed("model.regression")
+    def fit(self, rates):
+        """ Applies the Carhart model onto every asset in a return panel.
+
+        :param rates: Annualized return rates, one column per asset.
+                      Each asset is fit over the days it has data for.
+        :type rates: pandas.DataFrame, indexed by pandas.Timestamp
+
+        :return: One row per asset with the betas, "residual_var", "r2"
+                 and "expected_return" (expected future rate of return)
+        :rtype: pandas.DataFrame
+        """
+        self.refresh()
+        days = rates.index.intersection(self.factors.dropna().index)
+        days = days.intersection(self.risk_free_rates.index)
+        factors = self.factors.loc[days].to_numpy()
+        risk_free = self.risk_free_rates.loc[days].to_numpy()
+        excess = rates.loc[days].to_numpy() - risk_free[:, None]
 
-        curr_factors = factors[-1]
-        curr_rfrate = risk_free[-1]
-        return betas.value.dot(curr_factors) + curr_rfrate
+        fit_betas = fit_lstsq if self.method == "lstsq" else self.fit_cvxpy
+        betas, residual_var, r2, last_day = fit_betas(factors, excess)
+
+        fits = pd.DataFrame(betas, index=rates.columns, columns=BETAS)
+        fits["residual_var"] = residual_var
+        fits["r2"] = r2
+        fits["expected_return"] = (betas * factors[last_day]).sum(axis=1) + risk_free[last_day]
+        return fits
+
+    def fit_cvxpy(self, factors, excess):
+        """ Fits each asset as a separate cvxpy problem, honoring beta_bounds.
+        Same arguments and return value as fit_lstsq.
+        """
+        import cvxpy as cp
+        num_assets = excess.shape[1]
+        betas = np.full((num_assets, factors.shape[1]), np.nan)
+        for i in range(num_assets):
+            has_data = ~np.isnan(excess[:, i])
+            b = cp.Variable(factors.shape[1])
+            constraints = []
+            if self.beta_bounds is not None:
+                constraints = [b >= self.beta_bounds[0], b <= self.beta_bounds[1]]
+            objective = cp.Minimize(cp.sum_squares(factors[has_data] @ b - excess[has_data, i]))
+            cp.Problem(objective, constraints).solve()
+            betas[i] = b.value
+        return (betas, *fit_stats(factors, excess, betas))
 
     def reconstruct_factors(self):
-        """ Constructs the factors used in the 4-factor model.
-        Each factor has 253 entries corresponding to the last 253 trading days.
-        Should only be used when we have a new trading day the old model didn't account for.
+        """ Rebuilds this trading day's factors from scratch, ignoring the shared snapshot.
         """
-        updated_model = FactorModel()
-        self.factors = pd.concat([
-            updated_model.mkt_premium(),
-            updated_model.smb(),
-            updated_model.hml(),
-            updated_model.umd()
-            ], axis=1)
-        self.risk_free_rates = risk_free_rates()
+        self.factors, self.risk_free_rates, self.factor_returns = \
+            build_factors(self.factor_set)
+        self.trading_day = last_trading_day()
+
+
+def build_factors(factor_set="default"):
+    """ Constructs the factors used in the 4-factor model.
+    Each factor has 253 entries corresponding to the last 253 trading days.
+
+    :param factor_set: Name of the factor set to build from
+    :type factor_set: str
+
+    :return: (factors, risk-free rates, daily factor returns)
+    :rtype: Tuple[pandas.DataFrame, pandas.Series, pandas.DataFrame]
+    """
+    updated_model = FactorModel(factor_set=factor_set)
+    risk_free = risk_free_rates()
+    market = market_prices()
+    factors = pd.concat([
+        updated_model.mkt_premium(risk_free, market),
+        updated_model.smb(),
+        updated_model.hml(),
+        updated_model.umd()
+        ], axis=1)
+    return factors, risk_free, updated_model.daily_returns(market)
+
+
+def factors_from_prices(prices, factor_set="default"):
+    """ Same as build_factors, but as of the last day of a price panel
+    instead of today, using nothing after it.
+
+    :param prices: 2 years of prices ending on the day, with columns for the
+                   factor set's constituents, RISK_FREE_SYMBOL and MARKET_SYMBOL
+    :type prices: pandas.DataFrame, indexed by pandas.Timestamp
+    :param factor_set: Name of the factor set to build from
+    :type factor_set: str
+
+    :return: (factors, risk-free rates, daily factor returns)
+    :rtype: Tuple[pandas.DataFrame, pandas.Series, pandas.DataFrame]
+    """
+    model = FactorModel(factor_set=factor_set, prices=prices)
+    days = trading_window(prices.index[-1], TRADEDAYS_IN_YEAR + 1)
+    risk_free = 1 + prices[RISK_FREE_SYMBOL].reindex(days, method="ffill") / 100
+    risk_free.name = "Risk Free Rate"
+    mkt_prem = m12_return_rate(prices[MARKET_SYMBOL]) - risk_free
+    mkt_prem.name = "Mkt. Premium"
+    factors = pd.concat([mkt_prem, model.smb(), model.hml(), model.umd()], axis=1)
+    return factors, risk_free, model.daily_returns(prices[MARKET_SYMBOL])
+
+
+def fit_lstsq(factors, excess):
+    """ Regresses every column of excess onto the shared factor matrix.
+    Assets with the same missing days are solved together in one
+    multi-target least-squares call.
+
+    :param factors: Factor values, shape (days, k)
+    :type factors: numpy.ndarray
+    :param excess: Asset returns above the risk-free rate, shape (days, n),
+                   NaN on days an asset has no data
+    :type excess: numpy.ndarray
+
+    :return: betas (n, k), residual variance (n,), R² (n,)
+             and the index of each asset's last day with data (n,)
+    :rtype: Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray]
+    """
+    has_data = ~np.isnan(excess)
+    betas = np.full((excess.shape[1], factors.shape[1]), np.nan)
+    masks, groups = np.unique(has_data.T, axis=0, return_inverse=True)
+    for g, mask in enumerate(masks):
+        cols = np.flatnonzero(groups.ravel() == g)
+        if mask.sum() >= factors.shape[1]:
+            betas[cols] = np.linalg.lstsq(factors[mask], excess[mask][:, cols], rcond=None)[0].T
+    return (betas, *fit_stats(factors, excess, betas))
+
+
+def fit_stats(factors, excess, betas):
+    """ Goodness of fit for betas found by fit_lstsq or fit_cvxpy.
+
+    :return: residual variance (n,), R² (n,) and the index of each asset's
+             last day with data (n,)
+    :rtype: Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]
+    """
+    has_data = ~np.isnan(excess)
+    num_obs = has_data.sum(axis=0)
+    residuals = np.where(has_data, excess - factors @ betas.T, 0)
+    ss_res = (residuals ** 2).sum(axis=0)
+    centered = np.where(has_data, excess - np.nanmean(excess, axis=0), 0)
+    ss_tot = (centered ** 2).sum(axis=0)
+    residual_var = ss_res / np.maximum(num_obs - factors.shape[1], 1)
+    r2 = 1 - ss_res / ss_tot
+    last_day = len(excess) - 1 - np.argmax(has_data[::-1], axis=0)
+    return residual_var, r2, last_day
@@ -0,0 +1,211 @@
+""" Value at risk, expected shortfall and drawdown of a fixed-weight portfolio.
+
+Every method produces a matrix of simulated daily portfolio returns with one
+row per path, and the statistics are computed over whole arrays at once:
+  - "historical" uses every window of the portfolio's actual daily returns
+  - "bootstrap" resamples blocks of consecutive days, keeping short-term
+    autocorrelation and volatility clustering
+  - "normal" draws from the multivariate normal with the assets' mean daily
+    returns and the model covariance. The weights are fixed over the horizon,
+    so the portfolio return is exactly normal with mean w·μ and variance
+    wᵀΣw, and only that projection is drawn instead of every asset.
+
+Monte Carlo paths are simulated in chunks of CHUNK_PATHS, each with its own
+seed spawned from the request's seed, so results don't depend on how the
+chunks are spread over processes.
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from .processes import process_executor
+from .calendar import TRADEDAYS_IN_YEAR
+
+METHODS = ["historical", "bootstrap", "normal"]
+CHUNK_PATHS = 25_000
+
+
+def daily_returns(prices, weights):
+    """ Daily returns of a portfolio rebalanced to constant weights.
+
+    :param prices: Closing prices, one column per asset
+    :type prices: pandas.DataFrame, indexed by pandas.Timestamp
+    :param weights: The weight of each asset, ordered like prices.columns
+    :type weights: numpy.ndarray
+
+    :rtype: numpy.ndarray
+    """
+    asset_returns = prices.pct_change().iloc[1:].to_numpy()
+    return np.nan_to_num(asset_returns) @ weights
+
+
+def historical_paths(returns, horizon):
+    """ Every window of horizon consecutive days, as a read-only view.
+
+    :param returns: Daily portfolio returns
+    :type returns: numpy.ndarray
+    :type horizon: int
+
+    :return: Shape (len(returns) - horizon + 1, horizon)
+    :rtype: numpy.ndarray
+    """
+    return sliding_window_view(returns, horizon)
+
+
+def bootstrap_paths(returns, paths, horizon, block, rng):
+    """ Circular block bootstrap: each path joins randomly placed runs of
+    block consecutive days, wrapping around the end of the history.
+
+    :param returns: Daily portfolio returns
+    :type returns: numpy.ndarray
+    :type paths: int
+    :type horizon: int
+    :param block: Days per block
+    :type block: int
+    :type rng: numpy.random.Generator
+
+    :return: Shape (paths, horizon)
+    :rtype: numpy.ndarray
+    """
+    blocks = -(-horizon // block)
+    starts = rng.integers(0, len(returns), size=(paths, blocks, 1))
+    days = (starts + np.arange(block)) % len(returns)
+    return returns[days.reshape(paths, -1)[:, :horizon]]
+
+
+def normal_paths(mean, std, paths, horizon, rng):
+    """ Normally distributed daily portfolio returns.
+
+    :param mean: Mean daily portfolio return
+    :type mean: float
+    :param std: Standard deviation of the daily portfolio return
+    :type std: float
+    :type paths: int
+    :type horizon: int
+    :type rng: numpy.random.Generator
+
+    :return: Shape (paths, horizon)
+    :rtype: numpy.ndarray
+    """
+    return rng.normal(mean, std, size=(paths, horizon))
+
+
+def path_stats(paths):
+    """ Loss at the end of each path and the largest drop from a peak along it.
+
+    :param paths: Daily portfolio returns, one row per path
+    :type paths: numpy.ndarray
+
+    :return: (losses, max drawdowns), as fractions of the starting value
+    :rtype: Tuple[numpy.ndarray, numpy.ndarray]
+    """
+    wealth = 1 + paths
+    np.cumprod(wealth, axis=1, out=wealth)
+    peak = np.maximum.accumulate(wealth, axis=1)
+    np.maximum(peak, 1, out=peak)
+    np.divide(wealth, peak, out=peak)
+    return 1 - wealth[:, -1], 1 - peak.min(axis=1)
+
+
+def simulate_chunk(method, returns, mean, std, paths, horizon, block, seed):
+    """ Simulates one chunk of paths. Module level so process pools can run it.
+
+    :param seed: Seed for this chunk
+    :type seed: numpy.random.SeedSequence
+
+    :return: (losses, max drawdowns)
+    :rtype: Tuple[numpy.ndarray, numpy.ndarray]
+    """
+    rng = np.random.default_rng(seed)
+    if method == "bootstrap":
+        return path_stats(bootstrap_paths(returns, paths, horizon, block, rng))
+    return path_stats(normal_paths(mean, std, paths, horizon, rng))
+
+
+def simulate(method, returns, mean, std, paths, horizon, block=5, seed=None, workers=0):
+    """ Simulates paths in chunks of CHUNK_PATHS.
+
+    :param method: "bootstrap" or "normal"
+    :type method: str
+    :param returns: Daily portfolio returns to resample
+    :type returns: numpy.ndarray
+    :param mean: Mean daily portfolio return
+    :type mean: float
+    :param std: Standard deviation of the daily portfolio return
+    :type std: float
+    :param workers: Processes to spread chunks over, 0 or 1 to run them here
+    :type workers: int
+
+    :return: (losses, max drawdowns), one per path
+    :rtype: Tuple[numpy.ndarray, numpy.ndarray]
+    """
+    sizes = [CHUNK_PATHS] * (paths // CHUNK_PATHS)
+    if paths % CHUNK_PATHS:
+        sizes.append(paths % CHUNK_PATHS)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    args = [(method, returns, mean, std, n, horizon, block, s) for n, s in zip(sizes, seeds)]
+
+    if workers > 1 and len(sizes) > 1:
+        chunks = list(process_executor("risk", workers).map(simulate_chunk, *zip(*args)))
+    else:
+        chunks = [simulate_chunk(*a) for a in args]
+    return (np.concatenate([c[0] for c in chunks]),
+            np.concatenate([c[1] for c in chunks]))
+
+
+def summarize(losses, drawdowns, confidence):
+    """ VaR, CVaR and drawdown at a confidence level.
+
+    :type losses: numpy.ndarray
+    :type drawdowns: numpy.ndarray
+    :param confidence: e.g. 0.95
+    :type confidence: float
+
+    :rtype: Dict[str, float]
+    """
+    var = np.quantile(losses, confidence)
+    return {
+        "paths": len(losses),
+        "var": float(var),
+        "cvar": float(losses[losses >= var].mean()),
+        "max_drawdown": float(np.quantile(drawdowns, confidence)),
+        "mean_max_drawdown": float(drawdowns.mean())
+        }
+
+
+def risk_report(returns, volatility, methods=None, paths=100_000, horizon=21,
+                confidence=0.95, block=5, seed=None, workers=0):
+    """ Runs each risk method on a portfolio.
+
+    :param returns: Daily portfolio returns, see daily_returns()
+    :type returns: numpy.ndarray
+    :param volatility: Annualized portfolio volatility from the model covariance
+    :type volatility: float
+    :param methods: Some of METHODS, defaults to all of them
+    :type methods: str[] | None
+    :param paths: Simulated paths for "bootstrap" and "normal"
+    :type paths: int
+    :param horizon: Trading days each path covers
+    :type horizon: int
+    :param confidence: Confidence level of VaR, CVaR and max drawdown
+    :type confidence: float
+    :param block: Days per bootstrap block
+    :type block: int
+    :param seed: Seed for reproducible simulations
+    :type seed: int | None
+    :param workers: Processes to spread simulations over, 0 or 1 to run them here
+    :type workers: int
+
+    :return: Each method mapped to its summarize() stats, all losses
+             as fractions of the portfolio value over the horizon
+    :rtype: Dict[str, Dict[str, float]]
+    """
+    mean = returns.mean()
+    std = volatility / np.sqrt(TRADEDAYS_IN_YEAR)
+    report = {}
+    for method in methods or METHODS:
+        if method == "historical":
+            stats = path_stats(historical_paths(returns, horizon))
+        else:
+            stats = simulate(method, returns, mean, std, paths, horizon, block, seed, workers)
+        report[method] = summarize(*stats, confidence)
+    return report
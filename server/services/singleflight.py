@@ -0,0 +1,165 @@
+""" Single-flight coalescing of work keyed by ticker, such as price downloads.
+
+Only one caller works on a ticker at a time. Threads of one process find
+each other through an in-memory registry of flights; processes through a
+lease, an exclusive flock on <FETCH_LOCK_DIR>/<ticker>.lock that the kernel
+drops if its holder dies. A caller that finds a ticker taken waits for the
+holder to finish and then reruns the work itself, which is expected to
+find it already done (e.g. the prices are now in the database) and return
+without downloading anything.
+"""
+
+import fcntl
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+import config
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.05
+
+_flights = {}
+_flights_pid = None
+_flights_lock = threading.Lock()
+
+
+def claim(keys):
+    """ Registers a flight for the keys no other thread of this process is
+    working on.
+
+    :type keys: str[]
+
+    :return: The flight, the keys it claimed, and the flights of other
+             threads to wait for
+    :rtype: Tuple[concurrent.futures.Future, str[], Set[concurrent.futures.Future]]
+    """
+    global _flights, _flights_pid
+    flight = Future()
+    claimed, others = [], set()
+    with _flights_lock:
+        if _flights_pid != os.getpid():
+            _flights = {}
+            _flights_pid = os.getpid()
+        for key in keys:
+            if key in _flights:
+                others.add(_flights[key])
+            else:
+                _flights[key] = flight
+                claimed.append(key)
+    return flight, claimed, others
+
+
+def land(flight, keys):
+    """ Unregisters a flight from claim() and wakes the threads waiting on it. """
+    with _flights_lock:
+        for key in keys:
+            if _flights.get(key) is flight:
+                del _flights[key]
+    flight.set_result(None)
+
+
+def lease_file(key):
+    """ Opens the lease file of a key.
+
+    :rtype: io.TextIOWrapper
+    """
+    os.makedirs(config.FETCH_LOCK_DIR, exist_ok=True)
+    name = key.replace(os.sep, "_") + ".lock"
+    return open(os.path.join(config.FETCH_LOCK_DIR, name), "a", encoding="utf-8")
+
+
+def try_lease(key):
+    """ Takes the lease of a key if no process holds it.
+
+    :return: The locked lease file, or None if another process holds it
+    :rtype: io.TextIOWrapper | None
+    """
+    lease = lease_file(key)
+    try:
+        fcntl.flock(lease, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lease.close()
+        return None
+    return lease
+
+
+def wait_lease(key, deadline):
+    """ Waits for another process to release the lease of a key, and takes it.
+
+    :param deadline: time.monotonic() after which to give up
+    :type deadline: float
+
+    :return: The locked lease file, or None on timeout
+    :rtype: io.TextIOWrapper | None
+    """
+    while True:
+        lease = try_lease(key)
+        if lease is not None or time.monotonic() >= deadline:
+            return lease
+        time.sleep(POLL_INTERVAL)
+
+
+def release(leases):
+    """ Releases leases from try_lease() or wait_lease(). """
+    for lease in leases:
+        fcntl.flock(lease, fcntl.LOCK_UN)
+        lease.close()
+
+
+def coalesce(keys, work):
+    """ Runs work over keys, with at most one caller per key at a time across
+    all threads and processes.
+
+    Keys nobody else holds are worked on right away. Then, for the keys
+    another process holds, this waits for its lease and works on them;
+    for the keys another thread holds, this waits for that thread and works
+    on them. work must skip whatever those callers already finished.
+    Waits for other processes give up after FETCH_LEASE_TIMEOUT seconds.
+
+    :param keys: Tickers to work on
+    :type keys: str[]
+    :param work: Does the work for a list of keys
+    :type work: Callable[[str[]], None]
+    """
+    flight, claimed, others = claim(keys)
+    try:
+        leases = {key: try_lease(key) for key in claimed}
+        held = [key for key, lease in leases.items() if lease is not None]
+        busy = sorted(key for key, lease in leases.items() if lease is None)
+        try:
+            if held:
+                work(held)
+        finally:
+            # Released before waiting on anyone else, so waits can't deadlock
+            release(leases[key] for key in held)
+
+        if busy:
+            metrics.incr("fetch.coalesced", len(busy))
+            deadline = time.monotonic() + config.FETCH_LEASE_TIMEOUT
+            waited = []
+            try:
+                # Sorted, so processes waiting on overlapping keys take them in the same order
+                with metrics.timer("fetch.lease_wait"):
+                    for key in busy:
+                        lease = wait_lease(key, deadline)
+                        if lease is None:
+                            logger.warning("Timed out waiting for another process on %s", key)
+                        else:
+                            waited.append(lease)
+                work(busy)
+            finally:
+                release(waited)
+    finally:
+        land(flight, claimed)
+
+    if others:
+        rest = [key for key in keys if key not in claimed]
+        metrics.incr("fetch.coalesced", len(rest))
+        with metrics.timer("fetch.flight_wait"):
+            for other in others:
+                other.result()
+        work(rest)
@@ -1,106 +1,439 @@
-""" Database services, mainly to store price data. """
+""" Database services, mainly to store price data.
 
+All prices live in one long-format table keyed by (ticker, t), so every
+lookup is an index range scan instead of a probe per calendar day.
+
+The database runs in WAL mode, so readers never wait for a writer. Each
+thread reuses one connection (connection()), and every write from a process
+goes through one writer thread (write_prices()) that commits whatever is
+queued in a single transaction, so threads don't compete for the write lock.
+"""
+
+import os
+import queue
 import sqlite3
-from contextlib import closing
+import threading
+from concurrent.futures import Future
+from contextlib import closing, contextmanager
+from time import perf_counter
+import numpy as np
 import pandas as pd
+import config
+from .metrics import metrics, timed
+from .calendar import trading_days_before, TRADEDAYS_IN_YEAR
+
+PRICE_TABLE = "prices"
+# Factor fits precomputed per trading day, see save_fits
+FITS_TABLE = "fits"
+FIT_COLUMNS = ["bCAPM", "bSMB", "bHML", "bUMD", "residual_var", "r2", "expected_return"]
+# Trading days of history kept per ticker: the two years m12_return_rate needs, plus slack
+HISTORY_DAYS = 2 * TRADEDAYS_IN_YEAR + 10
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL", # WAL stays consistent; only the last commits can be lost on power loss
+    "temp_store": "MEMORY",
+    "cache_size": -16 * 1024, # KiB
+    "mmap_size": 256 * 2**20
+    }
+
+_local = threading.local()
+
+
+def get_connection(path=None):
+    """ Returns a new db connection with the price table ready to use.
+
+    :param path: Database file, defaults to config.DB_PATH
+    :type path: str | None
+
+    :rtype: sqlite3.Connection
+    """
+    con = sqlite3.connect(path or config.DB_PATH, timeout=config.DB_BUSY_TIMEOUT)
+    with closing(con.cursor()) as cur:
+        for pragma, value in PRAGMAS.items():
+            cur.execute(f"PRAGMA {pragma}={value}")
+    init_db(con)
+    return con
+
+
+@contextmanager
+def connection():
+    """ This thread's connection to config.DB_PATH, opened on first use and
+    kept open. Forked processes and a changed DB_PATH get a new one.
+
+    :rtype: Iterator[sqlite3.Connection]
+    """
+    key = (os.getpid(), config.DB_PATH)
+    if getattr(_local, "key", None) != key:
+        _local.con = get_connection()
+        _local.key = key
+    yield _local.con
 
-def get_connection():
-    """ Returns a new db connection. """
-    return sqlite3.connect("prices.db")
 
-def check_table(con, ticker):
-    """ Checks if the ticker has an existing db table.
+def init_db(con):
+    """ Creates the price and fit tables if they don't exist yet, and moves
+    any legacy per-ticker tables into the price table.
+
+    :param con: Active database connection.
+    :type con: sqlite3.Connection
+    """
+    with closing(con.cursor()) as cur:
+        cur.execute(f"""CREATE TABLE IF NOT EXISTS {PRICE_TABLE} (
+            ticker TEXT NOT NULL,
+            t INTEGER NOT NULL,
+            close REAL NOT NULL,
+            PRIMARY KEY (ticker, t)
+            ) WITHOUT ROWID""")
+        cur.execute(f"""CREATE TABLE IF NOT EXISTS {FITS_TABLE} (
+            factor_set TEXT NOT NULL,
+            day INTEGER NOT NULL,
+            ticker TEXT NOT NULL,
+            {", ".join(f"{c} REAL" for c in FIT_COLUMNS)},
+            PRIMARY KEY (factor_set, day, ticker)
+            ) WITHOUT ROWID""")
+        con.commit()
+    migrate_legacy_tables(con)
+
+
+def legacy_tables(con):
+    """ Lists the old one-table-per-ticker price tables, with (t, price) columns.
+
+    :param con: Active database connection.
+    :type con: sqlite3.Connection
+
+    :rtype: str[]
+    """
+    with closing(con.cursor()) as cur:
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name != ?",
+                    (PRICE_TABLE,))
+        tables = [row[0] for row in cur.fetchall()]
+        legacy = []
+        for table in tables:
+            cur.execute(f'PRAGMA table_info("{table}")')
+            if [col[1] for col in cur.fetchall()] == ["t", "price"]:
+                legacy.append(table)
+        return legacy
+
+
+def migrate_legacy_tables(con):
+    """ Copies every legacy per-ticker table into the price table,
+    then drops it. Runs in a single transaction.
 
     :param con: Active database connection.
     :type con: sqlite3.Connection
-    :param ticker: Ticker name, all uppercase
-    :type ticker: str
 
-    :rtype: bool
+    :return: Tickers that were migrated
+    :rtype: str[]
     """
-    cur = con.cursor()
-    cur.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{ticker}'")
-    res = cur.fetchone()
-    cur.close()
-    return bool(res)
+    tables = legacy_tables(con)
+    if not tables:
+        return tables
+
+    with con, closing(con.cursor()) as cur:
+        for table in tables:
+            cur.execute(f"""INSERT OR IGNORE INTO {PRICE_TABLE} (ticker, t, close)
+                SELECT ?, t, price FROM "{table}" WHERE price IS NOT NULL""", (table,))
+            cur.execute(f'DROP TABLE "{table}"')
+    return tables
 
 
-def find_recent_entry(con, ticker, limit=750):
+def find_recent_entry(con, ticker):
     """ Finds the most recent existing data entry for a ticker.
 
     :param con: Active database connection.
     :type con: sqlite3.Connection
     :param ticker: Ticker name, all uppercase
     :type ticker: str
-    :param limit: Max number of days to check for until the program times out
-    :type limit: int
 
-    :return: The timestmap of the first date that has data for the ticker.
-             Returns None if the table has no data or limit was reached
-             before data was found.
+    :return: The timestamp of the latest date that has data for the ticker.
+             Returns None if there is no data for the ticker.
     :rtype: pandas.Timestamp | None
     """
-    with closing(con.cursor()) as cur:
-        if not check_table(con, ticker):
-            return None
+    return find_recent_entries(con, [ticker])[ticker]
+
+
+@timed("db.read.recent")
+def find_recent_entries(con, tickers):
+    """ Finds the most recent existing data entry for many tickers at once.
+
+    :param con: Active database connection.
+    :type con: sqlite3.Connection
+    :param tickers: Ticker names, all uppercase
+    :type tickers: str[]
+
+    :return: Each ticker mapped to its latest timestamp, or None if it has no data
+    :rtype: Dict[str, pandas.Timestamp | None]
+    """
+    recent = dict.fromkeys(tickers)
+    if not tickers:
+        return recent
 
-        today = pd.Timestamp.today().round(freq="d")
-        while limit > 0:
-            timestamp = int(today.timestamp())
-            cur.execute(f"SELECT price FROM {ticker} WHERE t={timestamp}")
-            if cur.fetchone():
-                return today
-            today = today - pd.Timedelta(1, "day")
-            limit -= 1
-        return None
+    placeholders = ",".join("?" * len(recent))
+    with closing(con.cursor()) as cur:
+        cur.execute(f"""SELECT ticker, MAX(t) FROM {PRICE_TABLE}
+            WHERE ticker IN ({placeholders}) GROUP BY ticker""", list(recent))
+        for ticker, t in cur.fetchall():
+            recent[ticker] = pd.Timestamp(t, unit="s")
+    return recent
 
 
-def insert_price_data(con, df):
-    """ Inserts a dataframe of price data into the database.
+def find_first_entries(con, tickers):
+    """ Finds the oldest existing data entry for many tickers at once.
 
     :param con: Active database connection.
     :type con: sqlite3.Connection
-    :param df: DataFrame with ticker columns and price entries.
+    :param tickers: Ticker names, all uppercase
+    :type tickers: str[]
+
+    :return: Each ticker mapped to its first timestamp, or None if it has no data
+    :rtype: Dict[str, pandas.Timestamp | None]
+    """
+    first = dict.fromkeys(tickers)
+    if not tickers:
+        return first
+
+    placeholders = ",".join("?" * len(first))
+    with closing(con.cursor()) as cur:
+        cur.execute(f"""SELECT ticker, MIN(t) FROM {PRICE_TABLE}
+            WHERE ticker IN ({placeholders}) GROUP BY ticker""", list(first))
+        for ticker, t in cur.fetchall():
+            first[ticker] = pd.Timestamp(t, unit="s")
+    return first
+
+
+def price_rows(df):
+    """ The (ticker, t, close) rows of a price DataFrame, skipping NaN entries.
+
+    :type df: pandas.DataFrame, indexed by pandas.Timestamp
+    :rtype: List[Tuple[str, int, float]]
+    """
+    values = df.to_numpy(dtype=float)
+    days, cols = np.nonzero(~np.isnan(values))
+    timestamps = df.index.as_unit("s").asi8[days]
+    tickers = df.columns.to_numpy()[cols]
+    return list(zip(tickers.tolist(), timestamps.tolist(), values[days, cols].tolist()))
+
+
+@timed("db.write")
+def insert_price_data(con, *frames):
+    """ Inserts dataframes of price data into the database, in one transaction.
+    Existing entries for the same ticker and day are overwritten,
+    missing (NaN) entries are skipped.
+
+    Requests handle writes through write_prices() instead, so they are
+    serialized per process.
+
+    :param con: Active database connection, not in a transaction.
+    :type con: sqlite3.Connection
+    :param frames: DataFrames with ticker columns and price entries.
+    :type frames: pandas.DataFrame, indexed by pandas.Timestamp
+    """
+    rows = [row for df in frames for row in price_rows(df)]
+    if not rows:
+        return
+
+    with closing(con.cursor()) as cur:
+        # Take the write lock up front, so waiting for it is measured here
+        # instead of inside the first insert
+        start = perf_counter()
+        cur.execute("BEGIN IMMEDIATE")
+        metrics.observe("db.lock_wait", perf_counter() - start)
+        try:
+            cur.executemany(f"INSERT OR REPLACE INTO {PRICE_TABLE} VALUES (?, ?, ?)", rows)
+        except Exception:
+            con.rollback()
+            raise
+        con.commit()
+    metrics.incr("db.rows_written", len(rows))
+
+
+class PriceWriter:
+    """ Serializes every price write of this process through one thread.
+    Writes queued while a transaction runs are committed together in the next.
+
+    :param path: Database file
+    :type path: str
+    :param max_batch: Most queued writes to commit in one transaction
+    :type max_batch: int
+    """
+    def __init__(self, path, max_batch=64):
+        self.path = path
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="price-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, df):
+        """ Queues a price DataFrame for writing.
+
+        :type df: pandas.DataFrame, indexed by pandas.Timestamp
+        :return: Resolves once the prices are committed
+        :rtype: concurrent.futures.Future
+        """
+        future = Future()
+        self.queue.put((df, future))
+        return future
+
+    def run(self):
+        """ Writer thread: commits queued writes in batches, forever, and
+        merges each batch into the shared price panel before waking its writers.
+        """
+        from . import panel # pylint: disable=import-outside-toplevel # panel imports this module
+        con = get_connection(self.path)
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                frames = [df for df, _ in batch]
+                insert_price_data(con, *frames)
+                panel.merge(frames)
+            except Exception as e: # pylint: disable=broad-except
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for _, future in batch:
+                    future.set_result(None)
+            metrics.incr("db.write_batches")
+
+
+_writer = None
+_writer_key = None
+_writer_lock = threading.Lock()
+
+
+def price_writer():
+    """ Returns this process's PriceWriter for config.DB_PATH.
+    Created lazily so forked workers don't inherit a dead thread.
+
+    :rtype: PriceWriter
+    """
+    global _writer, _writer_key
+    key = (os.getpid(), config.DB_PATH)
+    with _writer_lock:
+        if _writer_key != key:
+            _writer = PriceWriter(config.DB_PATH)
+            _writer_key = key
+    return _writer
+
+
+def write_prices(df):
+    """ Writes price data through this process's writer thread, waiting until
+    it is committed. See insert_price_data.
+
     :type df: pandas.DataFrame, indexed by pandas.Timestamp
     """
+    price_writer().submit(df).result()
+
+
+def save_fits(con, factor_set, day, fits, keep=3):
+    """ Stores the factor fits of many tickers for a trading day, replacing
+    earlier fits of the same day, and deletes all but the last keep days.
+
+    :param con: Active database connection, not in a transaction.
+    :type con: sqlite3.Connection
+    :type factor_set: str
+    :param day: Trading day the fits are as of
+    :type day: pandas.Timestamp
+    :param fits: One row per ticker with FIT_COLUMNS,
+                 see services.returns.Carhart4FactorModel.fit
+    :type fits: pandas.DataFrame
+    :type keep: int
+    """
+    t = int(day.timestamp())
+    fits = fits[FIT_COLUMNS].dropna(subset=["expected_return"])
+    rows = [(factor_set, t, ticker, *map(float, values))
+            for ticker, values in zip(fits.index, fits.to_numpy())]
+    placeholders = ",".join("?" * (3 + len(FIT_COLUMNS)))
+    with closing(con.cursor()) as cur:
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            cur.executemany(f"INSERT OR REPLACE INTO {FITS_TABLE} VALUES ({placeholders})", rows)
+            cur.execute(f"""DELETE FROM {FITS_TABLE} WHERE factor_set = ? AND day NOT IN (
+                SELECT DISTINCT day FROM {FITS_TABLE} WHERE factor_set = ?
+                ORDER BY day DESC LIMIT ?)""", (factor_set, factor_set, keep))
+        except Exception:
+            con.rollback()
+            raise
+        con.commit()
+
+
+@timed("db.read.fits")
+def load_fits(con, factor_set, day, tickers):
+    """ Gets the stored factor fits of tickers for a trading day.
+
+    :param con: Active database connection.
+    :type con: sqlite3.Connection
+    :type factor_set: str
+    :type day: pandas.Timestamp
+    :param tickers: Ticker names, all uppercase
+    :type tickers: str[]
+
+    :return: One row per ticker that has a stored fit, with FIT_COLUMNS
+    :rtype: pandas.DataFrame
+    """
+    tickers = list(tickers)
+    placeholders = ",".join("?" * len(tickers))
     with closing(con.cursor()) as cur:
-        for ticker in df:
-            cur.execute(f"CREATE TABLE IF NOT EXISTS {ticker} (t INTEGER PRIMARY KEY, price REAL)")
-            prices = df[ticker]
-            for t, price in prices.items():
-                timestamp = int(t.timestamp())
-                cur.execute(f"INSERT OR REPLACE INTO {ticker} VALUES (?, ?)", (timestamp, price))
-            con.commit()
+        cur.execute(f"""SELECT ticker, {", ".join(FIT_COLUMNS)} FROM {FITS_TABLE}
+            WHERE factor_set = ? AND day = ? AND ticker IN ({placeholders})""",
+                    [factor_set, int(day.timestamp()), *tickers])
+        rows = cur.fetchall()
+    return pd.DataFrame([row[1:] for row in rows], index=[row[0] for row in rows],
+                        columns=FIT_COLUMNS)
 
 
-def get_price_data(con, ticker, start=pd.Timestamp.today().round(freq="d"), days=750):
-    """ Gets all price entries within a day range.
+def get_price_data(con, ticker, start=None, days=HISTORY_DAYS):
+    """ Gets all price entries within a range of trading days.
 
     :param con: Active database connection.
     :type con: sqlite3.Connection
-    :param ticker: Ticker name, all uppercase, table to query
+    :param ticker: Ticker name, all uppercase
     :type ticker: str
-    :param start: The first day to get db data for
-    :type start: pandas.Tiemstamp
-    :param days: Number of days to get db data for
+    :param start: The last day to get db data for, defaults to today
+    :type start: pandas.Timestamp
+    :param days: Number of trading days before start to get db data for
     :type days: int
 
     :return: Time series with all available data for the period
     :rtype: pandas.Series, indexed by pandas.Timestamp
     """
+    end = start if start is not None else pd.Timestamp.today().normalize()
+    panel = get_price_panel(con, [ticker], trading_days_before(end, days), end)
+    return panel[ticker]
+
+
+@timed("db.read.panel")
+def get_price_panel(con, tickers, start=None, end=None):
+    """ Gets the price history of many tickers in a single range query.
+
+    :param con: Active database connection.
+    :type con: sqlite3.Connection
+    :param tickers: Ticker names, all uppercase
+    :type tickers: str[]
+    :param start: First day to include, unbounded if None
+    :type start: pandas.Timestamp | None
+    :param end: Last day to include, unbounded if None
+    :type end: pandas.Timestamp | None
+
+    :return: DataFrame where each column is a ticker, in the requested order.
+             Days where a ticker has no data are NaN.
+    :rtype: pandas.DataFrame, indexed by pandas.Timestamp
+    """
+    tickers = list(tickers)
+    lo = int(start.timestamp()) if start is not None else -2**62
+    hi = int(end.timestamp()) if end is not None else 2**62
+    placeholders = ",".join("?" * len(tickers))
     with closing(con.cursor()) as cur:
-        if not check_table(con, ticker):
-            return pd.Series()
-
-        day_to_get = start - pd.Timedelta(days, "d")
-        data = pd.Series()
-        while day_to_get <= start:
-            time = day_to_get.timestamp()
-            res = cur.execute(f"SELECT * FROM {ticker} WHERE t={time}").fetchone()
-            if res:
-                t, price = res
-                t = pd.Timestamp.utcfromtimestamp(t).tz_convert(None)
-                data[t] = price
-            day_to_get = day_to_get + pd.Timedelta(1, "day")
-        data.name = ticker
-        return data
+        cur.execute(f"""SELECT ticker, t, close FROM {PRICE_TABLE}
+            WHERE ticker IN ({placeholders}) AND t BETWEEN ? AND ?""", [*tickers, lo, hi])
+        rows = cur.fetchall()
+
+    long = pd.DataFrame(rows, columns=["ticker", "t", "close"])
+    panel = long.pivot(index="t", columns="ticker", values="close")
+    panel.index = pd.to_datetime(panel.index, unit="s")
+    panel.index.name = None
+    panel.columns.name = None
+    return panel.reindex(columns=tickers).sort_index()
@@ -0,0 +1,139 @@
+""" Deferred loading of the heavy modules and the factor model.
+
+Importing routes stays cheap so the server can answer health checks right
+away; the returns model is built on first use, in a background thread, or
+before uWSGI forks its workers, depending on config.WARMUP.
+"""
+
+import importlib
+import logging
+import os
+from threading import Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+HEAVY_MODULES = [
+    "numpy", "pandas", "cvxpy", "pypfopt.efficient_frontier",
+    "services.portfolio", "services.batch", "services.returns"
+    ]
+
+_lock = Lock()
+_returns_models = {}
+_error = None
+
+
+def get_returns_model(factor_set="default"):
+    """ Returns the shared returns model for a factor set, building it if this
+    is the first call. Concurrent callers wait for the same build.
+
+    :param factor_set: Name of one of services.factors.factor_sets()
+    :type factor_set: str
+
+    :rtype: services.returns.Carhart4FactorModel
+    """
+    global _error
+    if factor_set not in _returns_models:
+        with _lock:
+            if factor_set not in _returns_models:
+                from .returns import Carhart4FactorModel # pylint: disable=import-outside-toplevel
+                try:
+                    _returns_models[factor_set] = Carhart4FactorModel(factor_set=factor_set)
+                    _error = None
+                except Exception as e:
+                    _error = e
+                    raise
+    return _returns_models[factor_set]
+
+
+def warmup():
+    """ Imports every heavy module, precomputes the trading calendar and
+    builds the returns model. """
+    for module in HEAVY_MODULES:
+        importlib.import_module(module)
+    importlib.import_module("services.calendar").trading_days()
+    get_returns_model()
+
+
+def _background_warmup():
+    try:
+        warmup()
+    except Exception: # pylint: disable=broad-exception-caught
+        logger.exception("Warmup failed, the model will be built on first use")
+
+
+def start_background_warmup():
+    """ Runs warmup() in a daemon thread of this process. """
+    Thread(target=_background_warmup, name="warmup", daemon=True).start()
+
+
+def _uwsgi():
+    """ The uwsgi module, or None outside uWSGI. """
+    try:
+        import uwsgi # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return None
+    return uwsgi
+
+
+def _uwsgi_option(name):
+    """ Whether a uWSGI flag is set; False outside uWSGI. """
+    uwsgi = _uwsgi()
+    if uwsgi is None:
+        return False
+    value = uwsgi.opt.get(name)
+    if isinstance(value, bytes):
+        return value.lower() not in (b"", b"0", b"false", b"no", b"off")
+    return bool(value)
+
+
+# The uWSGI master that loaded the app, whose forked workers warm up
+_master_pid = None
+
+
+def _after_fork():
+    # Every fork of the master and of its children runs this, including
+    # process pools, mules and subprocesses; only workers forked by the
+    # master serve requests
+    uwsgi = _uwsgi()
+    if uwsgi is not None and os.getppid() == _master_pid and uwsgi.worker_id() > 0:
+        start_background_warmup()
+
+
+def start(mode):
+    """ Starts warming up according to a WARMUP mode.
+
+    :param mode: "lazy" builds on first use, "prefork" warms up now in this
+                 process so forked workers inherit it, and "background" warms
+                 up in a thread of this process, and of every uWSGI worker
+                 the master forks when it loads the app itself.
+                 "prefork" falls back to "background" under uWSGI's lazy-apps,
+                 which loads the app after forking, so there is nothing to inherit
+    :type mode: str
+    """
+    global _master_pid
+    if mode == "prefork" and (_uwsgi_option("lazy-apps") or _uwsgi_option("lazy")):
+        logger.warning("WARMUP=prefork needs uWSGI's lazy-apps off; warming up in "
+                       "the background instead")
+        mode = "background"
+    if mode == "prefork":
+        warmup()
+    elif mode == "background":
+        uwsgi = _uwsgi()
+        if uwsgi is not None and uwsgi.worker_id() == 0 and _master_pid is None:
+            # Threads don't survive the fork, so each worker starts its own
+            _master_pid = os.getpid()
+            os.register_at_fork(after_in_child=_after_fork)
+        start_background_warmup()
+
+
+def status():
+    """ Readiness of this worker process.
+
+    :return: "ready", and "error" if the last build failed
+    :rtype: Dict[str, Any]
+    """
+    if "default" in _returns_models:
+        return {"ready": True, "factor_sets": list(_returns_models)}
+    if _error is not None:
+        return {"ready": False, "error": str(_error)}
+    return {"ready": False}
@@ -0,0 +1,30 @@
+""" Points every on-disk store at a temporary directory and puts the server
+modules on the import path. Runs before config is first imported. """
+
+import os
+import sys
+import tempfile
+import pytest
+
+STATE_DIR = tempfile.mkdtemp(prefix="server-tests-")
+for name, path in {
+        "PRICE_DB": "prices.db",
+        "FETCH_LOCK_DIR": "fetch_locks",
+        "FACTOR_CACHE_DIR": "factor_cache",
+        "JOB_DIR": "jobs",
+        "METRICS_DIR": "metrics"
+        }.items():
+    os.environ.setdefault(name, os.path.join(STATE_DIR, path))
+os.environ.setdefault("PRICE_PANEL", "off")
+os.environ.setdefault("JWT_SECRET", "test")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """ A fresh price database and lease directory for one test """
+    import config # pylint: disable=import-outside-toplevel
+    monkeypatch.setattr(config, "DB_PATH", str(tmp_path / "prices.db"))
+    monkeypatch.setattr(config, "FETCH_LOCK_DIR", str(tmp_path / "locks"))
+    return tmp_path
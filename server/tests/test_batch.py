@@ -0,0 +1,119 @@
+import types
+import cvxpy as cp
+import numpy as np
+import pandas as pd
+import pytest
+import config
+from services import batch
+from services.covariance import CovarianceCache, FactorCovariance
+from services.errors import TickerException
+
+FACTORS = ["Mkt. Premium", "SMB", "HML", "UMD"]
+
+
+def make_inputs(tickers, days=300, seed=0):
+    """ Prices driven by four factors plus noise, their factor returns,
+    and expected returns all above a 1.0 risk-free rate """
+    rng = np.random.default_rng(seed)
+    index = pd.bdate_range(end="2024-01-31", periods=days)
+    factor_returns = pd.DataFrame(rng.normal(0, 0.01, (days, len(FACTORS))),
+                                  index=index, columns=FACTORS)
+    returns = factor_returns.to_numpy() @ rng.normal(1, 0.5, (len(FACTORS), len(tickers))) \
+        + rng.normal(0, 0.015, (days, len(tickers)))
+    prices = pd.DataFrame(100 * np.cumprod(1 + returns, axis=0), index=index, columns=tickers)
+    expected = pd.Series(1.1 + rng.uniform(0, 0.1, len(tickers)), index=tickers)
+    return prices, factor_returns, expected
+
+
+def failing_inputs(bad, limit=10):
+    """ A model_inputs() stand-in that raises for every call holding a bad
+    ticker, and gives up after limit calls instead of looping forever """
+    calls = []
+
+    def model_inputs(_, tickers):
+        calls.append(list(tickers))
+        if len(calls) > limit:
+            raise RuntimeError("union_inputs keeps retrying")
+        failing = [t for t in bad if t in tickers]
+        if failing:
+            raise TickerException(f"Price data for ticker ${failing[0]} is missing.",
+                                  failing[0])
+        return tickers
+    return model_inputs, calls
+
+
+def test_union_inputs_drops_failing_tickers(monkeypatch):
+    model_inputs, calls = failing_inputs(["B", "D"])
+    monkeypatch.setattr(batch, "model_inputs", model_inputs)
+
+    inputs, failed = batch.union_inputs(None, ["A", "B", "C", "D"])
+
+    assert inputs == ["A", "C"]
+    assert sorted(failed) == ["B", "D"]
+    assert len(calls) == 3
+
+
+def test_union_inputs_raises_when_unrequested_ticker_fails(monkeypatch):
+    def model_inputs(_, tickers):
+        model_inputs.calls += 1
+        if model_inputs.calls > 10:
+            raise RuntimeError("union_inputs keeps retrying")
+        # A factor constituent failing while the model refreshes
+        raise TickerException("Fetching price data for ['SPY'] failed", ["SPY"])
+    model_inputs.calls = 0
+    monkeypatch.setattr(batch, "model_inputs", model_inputs)
+
+    with pytest.raises(TickerException) as e:
+        batch.union_inputs(None, ["A", "B"])
+    assert e.value.ticker == ["SPY"]
+    assert model_inputs.calls == 1
+
+
+def test_optimize_batch_picks_covariance_mode_per_universe(monkeypatch):
+    union = [f"T{i}" for i in range(6)]
+    prices, factor_returns, expected = make_inputs(union)
+    returns_model = types.SimpleNamespace(risk_free_rates=pd.Series([1.0]),
+                                          factor_returns=factor_returns)
+    monkeypatch.setattr(config, "COVARIANCE_MODE", "auto")
+    monkeypatch.setattr(config, "FACTOR_COVARIANCE_MIN_TICKERS", 5)
+    monkeypatch.setattr(batch, "model_inputs", lambda _, tickers: (
+        prices[tickers], expected[tickers], FactorCovariance.estimate(prices[tickers],
+                                                                      factor_returns)))
+    covariances = {}
+    model = batch.Model
+
+    def recording_model(returns_model, tickers, inputs):
+        covariances[tuple(tickers)] = inputs[2]
+        return model(returns_model, tickers, inputs)
+    monkeypatch.setattr(batch, "Model", recording_model)
+
+    small, large = union[:3], union[1:]
+    results = batch.optimize_batch(returns_model, [small, large], workers=2)
+
+    assert not any(isinstance(r, Exception) for r in results)
+    assert isinstance(covariances[tuple(large)], FactorCovariance)
+    dense = covariances[tuple(small)]
+    assert isinstance(dense, pd.DataFrame)
+    pd.testing.assert_frame_equal(dense, CovarianceCache().covariance(prices[small]))
+
+
+def test_optimize_batch_returns_solver_errors_per_universe(monkeypatch):
+    tickers = ["A", "B", "C"]
+    prices, factor_returns, expected = make_inputs(tickers)
+    returns_model = types.SimpleNamespace(risk_free_rates=pd.Series([1.0]),
+                                          factor_returns=factor_returns)
+    monkeypatch.setattr(config, "COVARIANCE_MODE", "sample")
+    monkeypatch.setattr(batch, "model_inputs", lambda _, t: (
+        prices[t], expected[t], CovarianceCache().covariance(prices[t])))
+    model = batch.Model
+
+    def failing_model(returns_model, universe, inputs):
+        if "C" in universe:
+            raise cp.SolverError("Solver 'CLARABEL' failed.")
+        return model(returns_model, universe, inputs)
+    monkeypatch.setattr(batch, "Model", failing_model)
+
+    solved, failed = batch.optimize_batch(returns_model, [["A", "B"], ["B", "C"]])
+
+    assert not isinstance(solved, Exception)
+    assert isinstance(failed, cp.SolverError)
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pypfopt.expected_returns import returns_from_prices
+from pypfopt.risk_models import risk_matrix
+from services.covariance import CovarianceCache, RollingCovariance
+
+
+@pytest.fixture
+def prices():
+    rng = np.random.default_rng(0)
+    index = pd.bdate_range(end="2024-01-31", periods=120)
+    prices = pd.DataFrame(100 * np.cumprod(1 + rng.normal(0, 0.01, (120, 5)), axis=0),
+                          index=index, columns=list("ABCDE"))
+    prices.iloc[:10, 3] = np.nan
+    return prices
+
+
+def test_sync_slides_window(prices):
+    stats = RollingCovariance(returns_from_prices(prices.iloc[:100]))
+    returns = returns_from_prices(prices.iloc[10:])
+
+    stats.sync(returns)
+
+    pd.testing.assert_frame_equal(stats.covariance(), returns.cov() * 252)
+
+
+def test_sync_picks_up_corrected_past_close(prices):
+    stats = RollingCovariance(returns_from_prices(prices.iloc[:100]))
+    corrected = prices.iloc[5:].copy()
+    corrected.iloc[40, 1] *= 1.2
+    corrected.iloc[50, 3] = np.nan
+    returns = returns_from_prices(corrected)
+
+    stats.sync(returns)
+
+    pd.testing.assert_frame_equal(stats.covariance(), RollingCovariance(returns).covariance())
+    pd.testing.assert_frame_equal(stats.covariance(), returns.cov() * 252)
+
+
+def test_cache_picks_up_corrected_past_close(prices):
+    cache = CovarianceCache()
+    cache.covariance(prices)
+    corrected = prices.copy()
+    corrected.iloc[30, 0] *= 0.9
+
+    pd.testing.assert_frame_equal(cache.covariance(corrected), risk_matrix(corrected))
+    # A subset is sliced out of the cached universe only while it matches
+    pd.testing.assert_frame_equal(cache.covariance(prices[["A", "B"]]),
+                                  risk_matrix(prices[["A", "B"]]))
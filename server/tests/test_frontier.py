@@ -0,0 +1,58 @@
+import types
+import cvxpy as cp
+import numpy as np
+import pandas as pd
+import pytest
+from pypfopt.exceptions import OptimizationError
+from services.covariance import CovarianceCache
+from services import model as model_module
+from services.model import Model
+
+
+@pytest.fixture
+def model():
+    rng = np.random.default_rng(0)
+    tickers = ["A", "B", "C", "D"]
+    index = pd.bdate_range(end="2024-01-31", periods=300)
+    prices = pd.DataFrame(100 * np.cumprod(1 + rng.normal(0.0005, 0.01, (300, 4)), axis=0),
+                          index=index, columns=tickers)
+    expected = pd.Series([1.05, 1.08, 1.1, 1.12], index=tickers)
+    returns_model = types.SimpleNamespace(risk_free_rates=pd.Series([1.0]))
+    return Model(returns_model, tickers, (prices, expected, CovarianceCache().covariance(prices)))
+
+
+@pytest.mark.parametrize("target", ["return", "risk"])
+def test_frontier_spans_min_volatility_to_max_return(model, target):
+    stats, weights, dropped = model.efficient_frontier(10, target)
+
+    assert len(stats) == len(weights) == 10 - dropped > 0
+    assert np.allclose(weights.sum(axis=1), 1, atol=1e-4)
+    assert stats["return"].iloc[-1] == pytest.approx(1.12, abs=1e-3)
+
+
+@pytest.mark.parametrize("target", ["return", "risk"])
+def test_frontier_raises_when_ends_are_infeasible(model, target):
+    # Four tickers capped at 10% each can't be fully invested
+    model._upper_bounds = np.full(4, 0.1)
+
+    with pytest.raises(OptimizationError):
+        model.efficient_frontier(10, target)
+
+
+def test_frontier_drops_points_the_solver_fails_on(model, monkeypatch):
+    solve_checked = model_module.solve_checked
+    sweeps = []
+
+    def failing_sweep(problem, solver=cp.CLARABEL, **options):
+        if options.get("warm_start"):
+            sweeps.append(problem)
+            if len(sweeps) % 3 == 0:
+                raise OptimizationError("Solver 'OSQP' failed.")
+        return solve_checked(problem, solver, **options)
+    monkeypatch.setattr(model_module, "solve_checked", failing_sweep)
+
+    stats, weights, dropped = model.efficient_frontier(9, "return")
+
+    assert dropped == 3
+    assert len(stats) == len(weights) == 6
+    assert not stats["inaccurate"].any()
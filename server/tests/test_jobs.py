@@ -0,0 +1,62 @@
+import subprocess
+import sys
+import threading
+import time
+import pytest
+from services.jobs import JobQueue, DONE, ERROR, RUNNING
+
+
+@pytest.fixture
+def jobs(tmp_path):
+    return JobQueue(str(tmp_path / "jobs"), workers=2, ttl=60)
+
+
+def wait_for(jobs, job_id, statuses, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = jobs.get(job_id)
+        if job["status"] in statuses:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} is still {job['status']}")
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def test_submits_of_a_running_task_share_it(jobs):
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(True)
+        release.wait(5)
+        return 42
+
+    first = jobs.submit("AAA,BBB", compute)
+    wait_for(jobs, first, [RUNNING])
+    second = jobs.submit("AAA,BBB", compute)
+    release.set()
+
+    assert wait_for(jobs, first, [DONE])["result"] == 42
+    assert wait_for(jobs, second, [DONE])["result"] == 42
+    assert calls == [True]
+
+
+@pytest.mark.parametrize("owner", ["dead", "earlier process with this pid"])
+def test_task_of_a_stopped_process_fails_and_restarts(jobs, owner):
+    jobs._open()
+    pid = dead_pid() if owner == "dead" else jobs._pid
+    jobs._store.set("job:stale", {"task": "AAA,BBB"})
+    jobs._store.set("task:AAA,BBB", {"status": RUNNING, "pid": pid})
+
+    stale = jobs.get("stale")
+    assert stale["status"] == ERROR
+    assert "pid" not in stale
+
+    job_id = jobs.submit("AAA,BBB", lambda: 42)
+    assert wait_for(jobs, job_id, [DONE])["result"] == 42
+    assert jobs.get("stale")["status"] == DONE
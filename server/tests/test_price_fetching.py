@@ -0,0 +1,117 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import config
+from services import sql
+from services import price_fetching
+from services.price_fetching import fetch_prices, download_missing, missing_ranges
+from benchmarks.synthetic import SyntheticProvider
+
+TICKERS = ["AAA", "BBB", "CCC"]
+
+
+class CountingProvider(SyntheticProvider):
+    """ Synthetic prices behind some latency, recording every download """
+    def __init__(self, latency=0.2):
+        super().__init__()
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.downloads = []
+
+    def download(self, symbols, start, end=None):
+        with self.lock:
+            self.downloads.append(list(symbols))
+        time.sleep(self.latency)
+        return super().download(symbols, start, end)
+
+
+def fetch_together(provider, callers):
+    """ Calls fetch_prices for TICKERS from many threads at once """
+    barrier = threading.Barrier(callers)
+    results = [None] * callers
+
+    def call(i):
+        barrier.wait()
+        with sql.connection() as con:
+            results[i] = fetch_prices(con, TICKERS, provider)
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(callers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_concurrent_threads_share_one_download(store):
+    provider = CountingProvider()
+
+    results = fetch_together(provider, 8)
+
+    assert provider.downloads == [TICKERS]
+    assert list(results[0].columns) == TICKERS
+    assert len(results[0]) > 0
+    for result in results[1:]:
+        pd.testing.assert_frame_equal(result, results[0])
+
+
+def fetch_in_process(tmp, start_at):
+    """ Runs fetch_together in a pool process, from start_at on """
+    config.DB_PATH = os.path.join(tmp, "prices.db")
+    config.FETCH_LOCK_DIR = os.path.join(tmp, "locks")
+    provider = CountingProvider()
+    time.sleep(max(start_at - time.time(), 0))
+    results = fetch_together(provider, 4)
+    return provider.downloads, results
+
+
+def test_concurrent_processes_share_one_download(store):
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(3, mp_context=context) as pool:
+        # Leave time for the pool to start, so every caller fires together
+        start_at = time.time() + 3
+        runs = list(pool.map(fetch_in_process, [str(store)] * 3, [start_at] * 3))
+
+    downloads = [d for process_downloads, _ in runs for d in process_downloads]
+    assert downloads == [TICKERS]
+    results = [r for _, process_results in runs for r in process_results]
+    for result in results[1:]:
+        pd.testing.assert_frame_equal(result, results[0])
+
+
+class IntradayProvider(SyntheticProvider):
+    """ Ignores end, like a provider returning the trading day's latest
+    price as a bar dated today """
+    def __init__(self):
+        super().__init__()
+        self.ends = []
+
+    def download(self, symbols, start, end=None):
+        self.ends.append(end)
+        return super().download(symbols, start)
+
+
+def test_bars_after_last_settled_close_are_not_stored(store, monkeypatch):
+    provider = IntradayProvider()
+    today, last_close = provider.index[-1], provider.index[-2]
+    monkeypatch.setattr(price_fetching, "last_trading_day", lambda: last_close)
+
+    with sql.connection() as con:
+        download_missing(con, TICKERS, provider)
+        stored = sql.find_recent_entries(con, TICKERS)
+
+    assert provider.ends == [last_close + pd.Timedelta(1, "d")]
+    assert stored == dict.fromkeys(TICKERS, last_close)
+    assert today not in stored.values()
+
+
+def test_missing_ranges_uses_given_settled_close():
+    last_close = pd.Timestamp("2024-01-10")
+    recent = {"AAA": last_close, "BBB": pd.Timestamp("2024-01-05")}
+
+    ranges = missing_ranges(recent, today=pd.Timestamp("2024-01-11"), last_close=last_close)
+
+    assert ranges == [(pd.Timestamp("2024-01-06"), ["BBB"])]
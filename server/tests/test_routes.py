@@ -0,0 +1,130 @@
+import time
+import types
+import numpy as np
+import pandas as pd
+import pytest
+from flask import Flask
+from pypfopt.exceptions import OptimizationError
+import routes
+from services import batch, optimizer
+from services import model as model_module
+from services.cache import ResultCache
+from services.jobs import JobQueue
+from services.auth import create_jwt
+from services.covariance import CovarianceCache
+
+TICKERS = ["AAA", "BBB", "CCC", "DDD"]
+
+
+@pytest.fixture
+def inputs():
+    """ Model inputs for TICKERS, in place of downloaded prices """
+    rng = np.random.default_rng(0)
+    index = pd.bdate_range(end="2024-01-31", periods=300)
+    prices = pd.DataFrame(100 * np.cumprod(1 + rng.normal(0.0005, 0.01, (300, 4)), axis=0),
+                          index=index, columns=TICKERS)
+    expected = pd.Series([1.05, 1.08, 1.1, 1.12], index=TICKERS)
+    return prices, expected
+
+
+@pytest.fixture
+def returns_model():
+    return types.SimpleNamespace(risk_free_rates=pd.Series([1.0]), factor_returns=None)
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path, inputs, returns_model):
+    prices, expected = inputs
+    monkeypatch.setattr(routes, "get_returns_model", lambda factor_set="default": returns_model)
+    model_inputs = lambda _, tickers: (
+        prices[tickers], expected[tickers], CovarianceCache().covariance(prices[tickers]))
+    monkeypatch.setattr(model_module, "model_inputs", model_inputs)
+    monkeypatch.setattr(batch, "model_inputs", model_inputs)
+    monkeypatch.setattr(routes, "result_cache", ResultCache(16, 60))
+    monkeypatch.setattr(routes, "job_queue", JobQueue(str(tmp_path / "jobs"), 1, 60))
+    app = Flask(__name__)
+    app.register_blueprint(routes.core_blueprint)
+    client = app.test_client()
+    client.environ_base["HTTP_AUTHORIZATION"] = create_jwt()
+    return client
+
+
+def test_frontier_reports_dropped_points(client, monkeypatch):
+    solve_checked = model_module.solve_checked
+    sweeps = []
+
+    def failing_sweep(problem, *args, **options):
+        if options.get("warm_start"):
+            sweeps.append(problem)
+            if len(sweeps) == 2:
+                raise OptimizationError("Solver 'OSQP' failed.")
+        return solve_checked(problem, *args, **options)
+    monkeypatch.setattr(model_module, "solve_checked", failing_sweep)
+
+    response = client.put("/frontier", json={"tickers": TICKERS, "points": 5})
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["dropped"] == 1
+    assert len(body["frontier"]) == 4
+    assert all(point["inaccurate"] is False for point in body["frontier"])
+
+
+def test_frontier_answers_unsolvable_ends_with_400(client, monkeypatch):
+    def failing(*args, **options):
+        raise OptimizationError("Solver status: infeasible")
+    monkeypatch.setattr(model_module, "solve_checked", failing)
+
+    response = client.put("/frontier", json={"tickers": TICKERS, "points": 5})
+
+    assert response.status_code == 400
+    assert response.get_json()["status"] == "ERROR"
+
+
+def unsolvable(*args, **kwargs):
+    raise OptimizationError("Solver status: infeasible")
+
+
+def no_excess_return(returns_model):
+    # Every expected return is at most 1.12
+    returns_model.risk_free_rates = pd.Series([1.5])
+
+
+def poll(client, job_id, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        response = client.get(f"/jobs/{job_id}")
+        if response.status_code != 202:
+            return response
+        time.sleep(0.02)
+    raise AssertionError(f"job {job_id} didn't finish")
+
+
+@pytest.mark.parametrize("path", ["/model", "/batch", "/jobs"])
+@pytest.mark.parametrize("cause", ["infeasible", "no excess return"])
+def test_unoptimizable_portfolios_get_the_same_error_everywhere(client, monkeypatch,
+                                                                returns_model, path, cause):
+    if cause == "infeasible":
+        monkeypatch.setattr(optimizer, "max_sharpe", unsolvable)
+        error = "No portfolio could be optimized over these tickers."
+    else:
+        no_excess_return(returns_model)
+        error = "at least one of the assets must have an expected return " \
+                "exceeding the risk-free rate"
+    portfolio = {"value": 1000, "tickers": TICKERS}
+
+    if path == "/model":
+        response = client.put("/model", json=portfolio)
+        status, body = response.status_code, response.get_json()
+    elif path == "/batch":
+        response = client.put("/batch", json={"portfolios": [portfolio]})
+        assert response.status_code == 200
+        status, body = 400, response.get_json()["results"][0]
+    else:
+        job_id = client.post("/jobs", json=portfolio).get_json()["job"]
+        response = poll(client, job_id)
+        status, body = response.status_code, response.get_json()
+
+    assert status == 400
+    assert body["status"] == "ERROR"
+    assert body["error"] == error
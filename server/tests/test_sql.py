@@ -0,0 +1,81 @@
+import multiprocessing
+import os
+import random
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+import config
+from services import sql
+from services.metrics import metrics
+from benchmarks.sql_store import make_prices
+
+
+def hammer(prices, readers, writers, seconds):
+    """ Runs get_price_panel readers and write_prices writers together
+
+    :return: Reads and writes done, and every sqlite3 error raised
+    """
+    deadline = perf_counter() + seconds
+    done = {"read": 0, "write": 0}
+    errors = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(readers + writers)
+
+    def loop(kind, seed):
+        rng = random.Random(seed)
+        count = 0
+        barrier.wait()
+        while perf_counter() < deadline:
+            names = rng.sample(list(prices.columns), 10)
+            try:
+                if kind == "read":
+                    with sql.connection() as con:
+                        sql.get_price_panel(con, names)
+                else:
+                    # Overwrite a few recent days, like a price refresh does
+                    sql.write_prices(prices[names].tail(5) * rng.uniform(0.99, 1.01))
+            except sqlite3.Error as e:
+                with lock:
+                    errors.append(e)
+                continue
+            count += 1
+        with lock:
+            done[kind] += count
+
+    threads = [threading.Thread(target=loop, args=("read", i)) for i in range(readers)]
+    threads += [threading.Thread(target=loop, args=("write", readers + i))
+                for i in range(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return done, errors
+
+
+def hammer_in_process(path, seconds):
+    """ Runs hammer in another process, like a second uWSGI worker """
+    config.DB_PATH = path
+    done, errors = hammer(make_prices(50, 60, seed=1), readers=3, writers=2, seconds=seconds)
+    return done, [str(e) for e in errors]
+
+
+def test_readers_and_writers_never_hit_a_locked_database(store):
+    prices = make_prices(50, 60)
+    with sql.connection() as con:
+        sql.insert_price_data(con, prices)
+    waits = metrics.histograms.get("db.lock_wait", {}).get("count", 0)
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(1, mp_context=context) as pool:
+        other = pool.submit(hammer_in_process, os.path.join(store, "prices.db"), 4)
+        done, errors = hammer(prices, readers=6, writers=3, seconds=4)
+        other_done, other_errors = other.result()
+
+    assert errors == [] and other_errors == []
+    assert done["read"] > 0 and done["write"] > 0 and other_done["write"] > 0
+    # Every write batch takes the write lock, and records how long that took
+    assert metrics.histograms["db.lock_wait"]["count"] > waits
+    with sql.connection() as con:
+        stored = sql.get_price_panel(con, list(prices.columns))
+    assert stored.shape == prices.shape
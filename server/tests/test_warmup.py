@@ -0,0 +1,84 @@
+import os
+import sys
+import types
+import pytest
+from services import warmup
+
+
+@pytest.fixture
+def started(monkeypatch):
+    """ Records background warmups instead of starting them """
+    calls = []
+    monkeypatch.setattr(warmup, "start_background_warmup", lambda: calls.append(True))
+    return calls
+
+
+def fake_uwsgi(monkeypatch, worker_id, **opt):
+    monkeypatch.setitem(sys.modules, "uwsgi",
+                        types.SimpleNamespace(worker_id=lambda: worker_id, opt=opt))
+
+
+@pytest.fixture
+def hooks(monkeypatch):
+    """ Records fork hooks instead of registering them """
+    registered = []
+    monkeypatch.setattr(warmup.os, "register_at_fork", lambda **hooks: registered.append(hooks))
+    monkeypatch.setattr(warmup, "_master_pid", None)
+    return registered
+
+
+def test_master_registers_the_fork_hook_once(monkeypatch, started, hooks):
+    fake_uwsgi(monkeypatch, 0)
+    warmup.start("background")
+    warmup.start("background")
+    assert hooks == [{"after_in_child": warmup._after_fork}]
+    assert warmup._master_pid == os.getpid()
+
+
+def test_lazy_loaded_worker_registers_no_fork_hook(monkeypatch, started, hooks):
+    # Processes a worker forks, like process pools, would inherit the hook
+    fake_uwsgi(monkeypatch, 3, **{"lazy-apps": True})
+    warmup.start("background")
+    assert hooks == []
+    assert started == [True]
+
+
+def test_fork_hook_warms_up_workers_of_the_master(monkeypatch, started, hooks):
+    fake_uwsgi(monkeypatch, 2)
+    monkeypatch.setattr(warmup, "_master_pid", os.getppid())
+    warmup._after_fork()
+    assert started == [True]
+
+
+@pytest.mark.parametrize("child", ["outside uwsgi", "mule", "forked by a worker"])
+def test_fork_hook_skips_other_children(monkeypatch, started, hooks, child):
+    monkeypatch.setattr(warmup, "_master_pid", os.getppid())
+    if child == "outside uwsgi":
+        monkeypatch.setitem(sys.modules, "uwsgi", None)
+    elif child == "mule":
+        fake_uwsgi(monkeypatch, 0)
+    else:
+        # A worker's process pool inherits its worker id, not its parent
+        fake_uwsgi(monkeypatch, 2)
+        monkeypatch.setattr(warmup, "_master_pid", os.getppid() + 1)
+    warmup._after_fork()
+    assert started == []
+
+
+@pytest.mark.parametrize("opt", [{"lazy-apps": True}, {"lazy-apps": b"true"}, {"lazy": b"1"}])
+def test_prefork_falls_back_to_background_under_lazy_apps(monkeypatch, started, opt):
+    fake_uwsgi(monkeypatch, 1, **opt)
+    monkeypatch.setattr(warmup, "warmup", lambda: pytest.fail("warmed up in the worker"))
+    monkeypatch.setattr(warmup.os, "register_at_fork", lambda **hooks: None)
+    warmup.start("prefork")
+    assert started == [True]
+
+
+@pytest.mark.parametrize("opt", [{}, {"lazy-apps": b"false"}])
+def test_prefork_warms_up_without_lazy_apps(monkeypatch, started, opt):
+    fake_uwsgi(monkeypatch, 0, **opt)
+    warmed = []
+    monkeypatch.setattr(warmup, "warmup", lambda: warmed.append(True))
+    warmup.start("prefork")
+    assert warmed == [True]
+    assert started == []
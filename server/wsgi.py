@@ -3,7 +3,8 @@
 from flask import Flask
 from flask_cors import CORS
 from routes import core_blueprint
-from config import PORT
+from services import warmup
+from config import PORT, WARMUP
 
 def init_app():
     """ Creates a flask server instance. """
@@ -13,6 +14,10 @@ def init_app():
     return app
 
 server = init_app()
+# Process pools re-import the script that started them as __mp_main__ in
+# each pool process (see services.processes); those never serve requests
+if __name__ != "__mp_main__":
+    warmup.start(WARMUP)
 
 if __name__ == "__main__":
     server.run(host="0.0.0.0", port=PORT)